@@ -13,4 +13,17 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'PB.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# imported once Django is set up
+from django.conf import settings
+from studios.streams import AVAILABILITY_STREAM_PATH, availability_stream
+
+stream_enabled = getattr(settings, 'STUDIOS_AVAILABILITY_STREAM', False)
+
+
+async def application(scope, receive, send):
+    # long lived event streams are served without going through Django's request handling
+    if stream_enabled and scope['type'] == 'http' and scope['method'] == 'GET' and AVAILABILITY_STREAM_PATH.match(scope['path']):
+        return await availability_stream(scope, receive, send)
+    return await django_application(scope, receive, send)
@@ -156,11 +156,60 @@ REST_FRAMEWORK = {
         'rest_framework.authentication.BasicAuthentication',
     ),
     'DEFAULT_FILTER_BACKENDS': ['django_filters.rest_framework.DjangoFilterBackend'],
+    'DEFAULT_RENDERER_CLASSES': [
+        'studios.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.LimitOffsetPagination',
     'PAGE_SIZE': 100,
     'DEFAULT_SCHEMA_CLASS': 'drf_spectacular.openapi.AutoSchema',
 }
 
+# /studios/all/ answers location queries from an in-memory index of studio points,
+# each process reloads it from the database every MAX_AGE seconds to pick up other workers' changes
+STUDIOS_NEAREST_INDEX = True
+STUDIOS_NEAREST_INDEX_MAX_AGE = 300
+
+# occurrences of recurring classes are written this many days ahead by extend_class_schedules
+STUDIOS_SCHEDULE_HORIZON_DAYS = 28
+
+# availability event stream served by PB.asgi, off until STUDIOS_RESPONSE_CACHE is shared
+# between processes, streams would miss the enrolments of other workers (check studios.W001)
+STUDIOS_AVAILABILITY_STREAM = False
+
+# seconds between checks for seat changes, made once per studio and process, and between
+# keep-alive comments of the stream
+STUDIOS_AVAILABILITY_POLL_INTERVAL = 1
+STUDIOS_AVAILABILITY_HEARTBEAT = 15
+
+# a billing worker that has not committed a chunk for this many seconds loses its
+# partition to the next run_billing
+BILLING_LEASE_SECONDS = 300
+
+# stored responses of requests sent with an Idempotency-Key header are kept this long,
+# sweep_idempotency_keys deletes the older ones
+IDEMPOTENCY_KEY_TTL_HOURS = 24
+
+# a request still in progress after this many seconds was killed (longer than the gunicorn
+# worker timeout), a retry with its Idempotency-Key runs it again instead of getting 409
+IDEMPOTENCY_KEY_ABANDONED_SECONDS = 120
+
+# CACHES alias holding users' booking entitlements, it must be shared between processes
+# (e.g. redis or memcached) so subscription changes and billing reach every worker,
+# with a process-local cache entitlements are read from the database on every booking
+STUDIOS_ENTITLEMENT_CACHE = 'default'
+STUDIOS_ENTITLEMENT_CACHE_TIMEOUT = 300
+
+# cache for studio detail and plan responses, use studios.cache.DjangoCacheBackend
+# with OPTIONS {'alias': ..., 'timeout': ...} to share it between processes
+STUDIOS_RESPONSE_CACHE = {
+    'BACKEND': 'studios.cache.LocMemLRUBackend',
+    'OPTIONS': {
+        'max_entries': 1024,
+        'timeout': 300,
+    },
+}
+
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(minutes=1440),
 }
@@ -1,3 +1,102 @@
+from datetime import date, timedelta
+
+from django.db.models import F
 from django.test import TestCase
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from accounts.models import User
+from studios.models import Card, ClassBooking, Payment, StudioClass, Subscription
+from studios.tests import QueryBudgetTestCase, create_classes, create_studio_details, create_studios
+
+
+class AccountQueryBudgetTests(QueryBudgetTestCase):
+  def setUp(self):
+    super().setUp()
+    self.user = User.objects.create(username='member')
+    self.card = Card.objects.create(
+      user=self.user, last_name='last', first_name='first', address='address', phone_number='1',
+      card_number=4111111111111111, card_expiry=date(2030, 1, 1), card_cvv=123,
+    )
+    self.subscription = Subscription.objects.create(user=self.user, start_date=date.today(), next_date=date.today() + timedelta(days=30), price=10, duration=30)
+    self.studio = create_studios(1)[0]
+    create_studio_details(self.studio)
+    self.add_history(2)
+    self.client.force_authenticate(self.user)
+
+  def add_history(self, count):
+    now = timezone.now()
+    for i in range(count):
+      Payment.objects.create(user=self.user, card=self.card, amount=10, date=now - timedelta(days=31 * i))
+    for studio_class in create_classes(self.studio, count):
+      ClassBooking.objects.create(studio_class=studio_class, user=self.user)
+    past = create_classes(self.studio, count)
+    for studio_class in past:
+      studio_class.start_time -= timedelta(days=365)
+      studio_class.save()
+      ClassBooking.objects.create(studio_class=studio_class, user=self.user)
+
+  def grow(self):
+    self.add_history(30)
+    Subscription.objects.create(user=self.user, start_date=date.today(), next_date=date.today(), price=10, duration=30, status='cancelled')
+
+  def test_budgets(self):
+    budgets = {
+      '/accounts/profile/': 1,
+      '/accounts/card/view/': 2,
+      # payments with their card
+      '/accounts/payments-history/': 1,
+      '/accounts/payments-history/summary/': 2,
+      '/accounts/payments-future/': 1,
+      '/accounts/subscription/view/': 1,
+      # ETag validator, bookings with their class
+      '/accounts/class-bookings-list/': 2,
+      '/accounts/class-bookings-list/upcoming/': 2,
+      '/accounts/class-bookings-list/past/': 2,
+      '/accounts/class-bookings-list/?expand=studio_class.studio': 2,
+    }
+    self.assertQueryBudget(budgets, self.grow)
+
+
+class CursorPaginationTests(TestCase):
+  """
+  Pages continue from the previous page's position, rows sharing the ordering value at a page
+  boundary are neither skipped nor repeated
+  """
+  def setUp(self):
+    self.user = User.objects.create(username='member')
+    self.client = APIClient()
+    self.client.force_authenticate(self.user)
+
+  def walk(self, url, field='id'):
+    values = []
+    while url:
+      response = self.client.get(url).json()
+      self.assertLessEqual(len(response['results']), 3)
+      values += [row[field] for row in response['results']]
+      url = response['next']
+    return values
+
+  def test_payment_ties(self):
+    card = Card.objects.create(
+      user=self.user, last_name='last', first_name='first', address='address', phone_number='1',
+      card_number=4111111111111111, card_expiry=date(2030, 1, 1), card_cvv=123,
+    )
+    now = timezone.now()
+    dates = [now] * 5 + [now - timedelta(days=1)] * 4 + [now - timedelta(days=2)]
+    # amounts tell the payments apart, the history doesn't list ids
+    Payment.objects.bulk_create([Payment(user=self.user, card=card, amount=i, date=value) for i, value in enumerate(dates)])
+    expected = list(Payment.objects.order_by('-date', '-id').values_list('amount', flat=True))
+    self.assertEqual(self.walk('/accounts/payments-history/?page_size=3', 'amount'), expected)
 
-# Create your tests here.
+  def test_booking_ties(self):
+    studio = create_studios(1)[0]
+    classes = create_classes(studio, 10)
+    # classes starting together, the bookings copy their start time
+    StudioClass.objects.filter(pk__in=[studio_class.pk for studio_class in classes[:7]]).update(start_time=classes[0].start_time)
+    bookings = [ClassBooking.objects.create(studio_class_id=studio_class.pk, user=self.user) for studio_class in classes]
+    expected = list(ClassBooking.objects.order_by('start_time', 'id').values_list('id', flat=True))
+    self.assertEqual(len(expected), len(bookings))
+    self.assertEqual(self.walk('/accounts/class-bookings-list/upcoming/?page_size=3'), expected)
+    ClassBooking.objects.update(start_time=F('start_time') - timedelta(days=365))
+    self.assertEqual(self.walk('/accounts/class-bookings-list/past/?page_size=3'), expected[::-1])
@@ -1,7 +1,7 @@
 from django.urls import path, include
 from accounts import views
 
-from .views import UserSubscriptionView, UserCardView, UserClassBookingsView, RegisterUserAPIView, UserProfileView, UserProfileEditView, UserCardCreateView, UserCardUpdateView, UserPaymentHistoryView, UserFuturePaymentView, UserUpdateSubscriptionView
+from .views import UserSubscriptionView, UserCardView, UserClassBookingsView, UserUpcomingClassBookingsView, UserPastClassBookingsView, RegisterUserAPIView, UserProfileView, UserProfileEditView, UserCardCreateView, UserCardUpdateView, UserPaymentHistoryView, UserPaymentSummaryView, UserFuturePaymentView, UserUpdateSubscriptionView
 
 
 app_name = 'accounts'
@@ -14,8 +14,11 @@ urlpatterns = [
   path('card/create/', UserCardCreateView.as_view(), name='user-card-create'),
   path('card/update/', UserCardUpdateView.as_view(), name='user-card-update'),
   path('payments-history/', UserPaymentHistoryView.as_view(), name='payments-history'),
+  path('payments-history/summary/', UserPaymentSummaryView.as_view(), name='payments-summary'),
   path('payments-future/', UserFuturePaymentView.as_view(), name='payments-future'),
   path('update-subscription/', UserUpdateSubscriptionView.as_view(), name='update-subscription'),
   path('subscription/view/', UserSubscriptionView.as_view(), name='view-subscription'),
-  path('class-bookings-list/', UserClassBookingsView.as_view(), name='class-bookings-view')
+  path('class-bookings-list/', UserClassBookingsView.as_view(), name='class-bookings-view'),
+  path('class-bookings-list/upcoming/', UserUpcomingClassBookingsView.as_view(), name='class-bookings-upcoming'),
+  path('class-bookings-list/past/', UserPastClassBookingsView.as_view(), name='class-bookings-past')
 ]
\ No newline at end of file
@@ -6,10 +6,15 @@ from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework_simplejwt.exceptions import InvalidToken
 from rest_framework_simplejwt.tokens import AccessToken
+from django.db.models import Count, Max
+from django.utils import timezone
 from accounts.models import User
-from studios.models import Card, Payment, Subscription, ClassBooking
+from studios.models import Card, Payment, PaymentMonthlySummary, Subscription, ClassBooking
 from .serializers import RegisterSerializer, UserProfileSerializer, UserCardSerializer
-from studios.serializers import PaymentsSerializer, SubscriptionSubscribeSerializer, ClassBookingUserSerializer
+from studios.fast_serializers import ValuesListMixin
+from studios.pagination import BookingCursorPagination, PastBookingCursorPagination, PaymentCursorPagination
+from studios.mixins import ConditionalGetMixin, EagerLoadingMixin, IdempotentCreateMixin, StreamingListMixin
+from studios.serializers import PaymentsSerializer, PaymentMonthlySummarySerializer, SubscriptionSubscribeSerializer, ClassBookingUserSerializer
 
 # Create your views here.
 
@@ -40,7 +45,7 @@ class UserCardView(RetrieveAPIView):
     current_user = User.objects.filter(id=self.request.user.id)[0]
     return get_object_or_404(Card, user=current_user)
 
-class UserCardCreateView(CreateAPIView):
+class UserCardCreateView(IdempotentCreateMixin, CreateAPIView):
   serializer_class = UserCardSerializer
   permission_classes = [IsAuthenticated]
 
@@ -52,65 +57,67 @@ class UserCardUpdateView(UpdateAPIView):
     current_user = User.objects.filter(id=self.request.user.id)[0]
     return get_object_or_404(Card, user=current_user)
 
-class UserPaymentHistoryView(ListAPIView):
+class UserPaymentHistoryView(StreamingListMixin, ValuesListMixin, EagerLoadingMixin, ListAPIView):
   serializer_class = PaymentsSerializer
   permission_classes = [IsAuthenticated]
+  pagination_class = PaymentCursorPagination
 
   def get_queryset(self):
-    current_user = User.objects.filter(id=self.request.user.id)[0]
-    return Payment.objects.filter(user=current_user)
+    # the paginator's order, streamed lists come out newest first too
+    return self.setup_eager_loading(Payment.objects.filter(user=self.request.user).order_by('-date', '-id'))
+
+class UserPaymentSummaryView(ListAPIView):
+  serializer_class = PaymentMonthlySummarySerializer
+  permission_classes = [IsAuthenticated]
+
+  def get_queryset(self):
+    return PaymentMonthlySummary.objects.filter(user=self.request.user).order_by('-month')
 
 class UserFuturePaymentView(RetrieveAPIView):
   serializer_class = SubscriptionSubscribeSerializer
   permission_classes = [IsAuthenticated]
   
   def get_object(self):
-    current_user = User.objects.filter(id=self.request.user.id)[0]
-    
-    has_subscription = Subscription.objects.filter(user=current_user)
-    nextSub = None
-    if has_subscription:
-      for subscription in has_subscription:
-        if subscription.status == 'active':
-          nextSub = subscription
-    return nextSub
+    return Subscription.objects.current_for(self.request.user)
 
 class UserSubscriptionView(RetrieveAPIView):
   serializer_class = SubscriptionSubscribeSerializer
   permission_classes = [IsAuthenticated]
 
   def get_object(self):
-    current_user = User.objects.filter(id=self.request.user.id)[0]
-    has_subscription = Subscription.objects.filter(user=current_user)
-    activeSub = None
-    if has_subscription:
-      for subscription in has_subscription:
-        if subscription.status == 'active':
-          activeSub = subscription
-    return activeSub
+    return Subscription.objects.current_for(self.request.user)
 
 class UserUpdateSubscriptionView(UpdateAPIView):
   serializer_class = SubscriptionSubscribeSerializer
   permission_classes = [IsAuthenticated]
 
   def get_object(self):
-    current_user = User.objects.filter(id=self.request.user.id)[0]
-    has_subscription = Subscription.objects.filter(user=current_user)
-    activeSub = None
-    if has_subscription:
-      for subscription in has_subscription:
-        if subscription.status == 'active':
-          activeSub = subscription
-    return activeSub
-
-class UserClassBookingsView(ListAPIView):
+    return Subscription.objects.current_for(self.request.user)
+
+class UserClassBookingsView(ConditionalGetMixin, EagerLoadingMixin, ListAPIView):
   serializer_class = ClassBookingUserSerializer
   permission_classes = [IsAuthenticated]
+  pagination_class = BookingCursorPagination
+
+  def get_bookings(self):
+    return ClassBooking.objects.filter(user=self.request.user)
 
   def get_queryset(self):
-    current_user = User.objects.filter(id=self.request.user.id)[0]
-    return ClassBooking.objects.filter(user=current_user).order_by('studio_class__start_date')
+    # ordered by the paginator
+    return self.setup_eager_loading(self.get_bookings())
 
+  def get_etag_validator(self):
+    # the count also moves as bookings go from upcoming to past
+    return self.get_bookings().aggregate(
+      Max('last_modified'), Max('studio_class__last_modified'), Max('studio_class__studio__last_modified'), Count('pk')
+    )
 
+class UserUpcomingClassBookingsView(UserClassBookingsView):
+  def get_bookings(self):
+    return super().get_bookings().filter(start_time__gte=timezone.now())
 
-  
+class UserPastClassBookingsView(UserClassBookingsView):
+  pagination_class = PastBookingCursorPagination
+
+  def get_bookings(self):
+    return super().get_bookings().filter(start_time__lt=timezone.now())
@@ -1,6 +1,8 @@
 from django.contrib import admin
+from django.db import transaction
 
-from studios.models import Studio, Point, Image, Amenity, Keyword, StudioClass, SubscriptionPlan, Subscription, Payment, Card, ClassBooking
+from studios.models import Studio, Point, Image, Amenity, Keyword, ClassSeries, StudioClass, SubscriptionPlan, Subscription, Payment, PaymentMonthlySummary, Card, ClassBooking, WaitlistEntry
+from studios.schedules import cancel_series, materialize
 
 # Register your models here.
 
@@ -29,17 +31,57 @@ class StudioClassAdmin(admin.ModelAdmin):
   #readonly_fields=('start_time', 'end_time', 'recurrence_end')
   search_fields = ('name',)
   inlines = (KeywordInline,)
+  actions = ('cancel_classes',)
+
+  @admin.action(description='Cancel selected classes')
+  def cancel_classes(self, request, queryset):
+    for studio_class in queryset:
+      studio_class.cancel()
+
+class ClassSeriesAdmin(admin.ModelAdmin):
+  search_fields = ('name',)
+  list_display = ('name', 'studio', 'interval_days', 'status', 'materialized_until')
+  actions = ('cancel', 'extend')
+
+  @admin.action(description='Cancel selected series and their upcoming classes')
+  def cancel(self, request, queryset):
+    for series in queryset:
+      cancel_series(series)
+
+  @admin.action(description='Write upcoming classes of selected series')
+  def extend(self, request, queryset):
+    created = materialize(queryset.filter(status='active'))
+    self.message_user(request, f'{created} classes written')
+
+class ClassBookingAdmin(admin.ModelAdmin):
+  # deleted bookings hand their seat to the waitlist or back to the class
+
+  def delete_model(self, request, obj):
+    with transaction.atomic():
+      deleted, _ = obj.delete()
+      if deleted:
+        obj.studio_class.free_seat()
+
+  def delete_queryset(self, request, queryset):
+    with transaction.atomic():
+      bookings = list(queryset)
+      super().delete_queryset(request, queryset)
+      for booking in bookings:
+        booking.studio_class.free_seat()
 
 admin.site.register(Studio, StudioAdmin)
 admin.site.register(StudioClass, StudioClassAdmin)
+admin.site.register(ClassSeries, ClassSeriesAdmin)
 admin.site.register(Point)
 admin.site.register(Image)
 admin.site.register(Amenity)
 admin.site.register(SubscriptionPlan)
 admin.site.register(Subscription)
 admin.site.register(Payment)
+admin.site.register(PaymentMonthlySummary)
 admin.site.register(Card)
-admin.site.register(ClassBooking)
+admin.site.register(ClassBooking, ClassBookingAdmin)
+admin.site.register(WaitlistEntry)
 
 
 
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class StudiosConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'studios'
+
+    def ready(self):
+        from studios import checks, signals  # noqa: F401
@@ -0,0 +1,45 @@
+from django.db import transaction
+from django.utils import timezone
+
+from studios.cache import response_cache
+from studios.models import StudioClass
+
+
+def get_scope(studio_id):
+  return f'availability:{studio_id}'
+
+
+def get_version(studio_id):
+  return response_cache.backend.get_version(get_scope(studio_id))
+
+
+def get_availability(studio_id):
+  """
+  Return (version, {class_id: seats_left}) for the upcoming classes of a studio, the map is
+  cached under the studio's availability version so repeated reads don't touch the database
+  """
+  version = get_version(studio_id)
+  key = f'{get_scope(studio_id)}:{version}'
+  seats = response_cache.get(key)
+  if seats is None:
+    classes = StudioClass.objects.filter(studio_id=studio_id, status='active', start_time__gte=timezone.now()) \
+      .values_list('pk', 'capacity', 'booked_count')
+    seats = {str(pk): max(capacity - booked_count, 0) for pk, capacity, booked_count in classes}
+    response_cache.set(key, seats)
+  return version, seats
+
+
+def publish(studio_id):
+  """
+  Announce that seats of a studio's classes changed once the current transaction commits
+  """
+  transaction.on_commit(lambda: response_cache.bump(get_scope(studio_id)))
+
+
+def publish_class(class_id):
+  """
+  Announce that seats of a class changed, for callers that don't have the class loaded
+  """
+  studio_id = StudioClass.objects.filter(pk=class_id).values_list('studio_id', flat=True).first()
+  if studio_id is not None:
+    publish(studio_id)
@@ -0,0 +1,204 @@
+import os
+import socket
+import uuid
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import timedelta
+
+import django
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import Count, DateField, F, Q, Sum
+from django.db.models.functions import Cast, Mod
+from django.utils import timezone
+
+from studios import entitlements, summaries
+from studios.models import BillingPartition, BillingRun, Payment, Subscription
+
+CHUNK_SIZE = 1000
+
+
+class LeaseLost(Exception):
+  pass
+
+
+def due_subscriptions(run_date):
+  """
+  Return active subscriptions to bill on run_date in (next_date, id) order, a period of zero days
+  would never stop being due and is skipped
+  """
+  return Subscription.objects.filter(status='active', next_date__lte=run_date, duration__gt=0) \
+    .order_by('next_date', 'id')
+
+
+def partition_subscriptions(partition):
+  """
+  Return the due subscriptions of a partition after its position
+  """
+  run = partition.run
+  subscriptions = due_subscriptions(run.run_date)
+  if run.partitions > 1:
+    subscriptions = subscriptions.alias(partition=Mod('user_id', run.partitions)).filter(partition=partition.number)
+  if partition.last_next_date is not None:
+    subscriptions = subscriptions.filter(
+      Q(next_date__gt=partition.last_next_date) | Q(next_date=partition.last_next_date, id__gt=partition.last_subscription_id)
+    )
+  return subscriptions
+
+
+def lease_expiry():
+  return timezone.now() + timedelta(seconds=settings.BILLING_LEASE_SECONDS)
+
+
+def acquire_lease(partition, owner):
+  """
+  Take the partition for owner unless another worker holds an unexpired lease on it
+  """
+  available = Q(lease_expires__isnull=True) | Q(lease_expires__lt=timezone.now()) | Q(leased_by=owner)
+  return BillingPartition.objects.filter(available, pk=partition.pk, finished_at__isnull=True) \
+    .update(leased_by=owner, lease_expires=lease_expiry()) == 1
+
+
+def bill_chunk(partition, owner, chunk_size=CHUNK_SIZE):
+  """
+  Bill the next chunk of the partition's due subscriptions, the payments, the subscription updates
+  and the new position commit together. Return the number of subscriptions processed
+  """
+  # the card is the only part of the user needed
+  subscriptions = partition_subscriptions(partition).annotate(card_id=F('user__card__id')) \
+    .only('id', 'user_id', 'next_date', 'price', 'duration')
+  now = timezone.now()
+  with transaction.atomic():
+    # renewing the lease first, a worker whose lease was taken over can't commit anything
+    if not BillingPartition.objects.filter(pk=partition.pk, leased_by=owner).update(lease_expires=lease_expiry()):
+      raise LeaseLost
+    chunk = list(subscriptions.select_for_update(of=('self',))[:chunk_size])
+    if not chunk:
+      return 0
+    payments = []
+    cancelled = []
+    # subscriptions moving forward by the same number of days share one UPDATE
+    renewals = defaultdict(list)
+    for subscription in chunk:
+      if subscription.card_id is None:
+        cancelled.append(subscription)
+        continue
+      # one period is charged per run, the one holding run_date. Periods missed while billing
+      # didn't run are skipped rather than charged all at once, next_date moves past run_date
+      skipped = (partition.run.run_date - subscription.next_date).days // subscription.duration
+      payments.append(Payment(
+        date=now, amount=subscription.price, card_id=subscription.card_id, user_id=subscription.user_id,
+        subscription=subscription, period_start=subscription.next_date + timedelta(days=subscription.duration * skipped),
+        billing_run=partition.run,
+      ))
+      renewals[(subscription.duration, skipped)].append(subscription.id)
+    # a payment already written for a period (by an earlier attempt) is not written again
+    Payment.objects.bulk_create(payments, batch_size=chunk_size, ignore_conflicts=True)
+    # bulk_create() skips the signals keeping the monthly summaries, the rows of this chunk
+    # are the ones dated now, without the payments that were already written
+    if payments:
+      month = summaries.month_of(now)
+      written = Payment.objects.filter(billing_run=partition.run, date=now, subscription_id__in=[subscription.id for subscription in chunk]) \
+        .values('user_id').annotate(count=Count('id'), total=Sum('amount')).order_by()
+      summaries.add({(row['user_id'], month): (row['count'], row['total']) for row in written})
+    for (duration, skipped), subscription_ids in renewals.items():
+      Subscription.objects.filter(pk__in=subscription_ids).update(
+        start_date=Cast(F('next_date') + timedelta(days=duration * skipped), DateField()),
+        next_date=Cast(F('next_date') + timedelta(days=duration * (skipped + 1)), DateField()),
+      )
+    Subscription.objects.filter(pk__in=[subscription.id for subscription in cancelled]).update(status='cancelled')
+    # update() skips the signals that drop cached entitlements, renewals don't change them
+    entitlements.invalidate([subscription.user_id for subscription in cancelled])
+    partition.billed += len(chunk) - len(cancelled)
+    partition.cancelled += len(cancelled)
+    partition.last_next_date = chunk[-1].next_date
+    partition.last_subscription_id = chunk[-1].id
+    partition.save(update_fields=['last_next_date', 'last_subscription_id', 'billed', 'cancelled'])
+  return len(chunk)
+
+
+def bill_partition(partition_id, chunk_size=CHUNK_SIZE):
+  """
+  Bill a partition to the end under a lease and return its id, a partition leased by
+  another worker is left alone
+  """
+  owner = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+  partition = BillingPartition.objects.select_related('run').get(pk=partition_id)
+  if not acquire_lease(partition, owner):
+    return partition_id
+  try:
+    while bill_chunk(partition, owner, chunk_size):
+      pass
+  except LeaseLost:
+    return partition_id
+  BillingPartition.objects.filter(pk=partition.pk, leased_by=owner) \
+    .update(finished_at=timezone.now(), leased_by='', lease_expires=None)
+  return partition_id
+
+
+def bill_partition_in_worker(partition_id, chunk_size):
+  try:
+    return bill_partition(partition_id, chunk_size)
+  finally:
+    connections.close_all()
+
+
+def setup_worker():
+  django.setup()
+
+
+def run_billing(run_date=None, chunk_size=CHUNK_SIZE, workers=1, partitions=None, stdout=None):
+  """
+  Bill every subscription due on run_date (today by default) with the given number of worker
+  processes and return the BillingRun. Running it again for the same day resumes the partitions
+  that did not finish, the run is only finished once all of them are
+  """
+  run_date = run_date or timezone.localdate()
+  run, created = BillingRun.objects.get_or_create(run_date=run_date, defaults={'partitions': partitions or workers})
+  if run.finished_at is not None:
+    return run
+  BillingPartition.objects.bulk_create([BillingPartition(run=run, number=number) for number in range(run.partitions)], ignore_conflicts=True)
+  pending = list(run.partition_set.filter(finished_at__isnull=True).order_by('number').values_list('pk', flat=True))
+  if workers > 1 and len(pending) > 1:
+    # worker processes open their own connections, forked ones must not reuse the parent's
+    connections.close_all()
+    with ProcessPoolExecutor(min(workers, len(pending)), initializer=setup_worker) as pool:
+      for future in as_completed([pool.submit(bill_partition_in_worker, pk, chunk_size) for pk in pending]):
+        report_partition(future.result(), stdout)
+  else:
+    for pk in pending:
+      report_partition(bill_partition(pk, chunk_size), stdout)
+  if run.partition_set.filter(finished_at__isnull=True).exists():
+    return run
+  totals = run.partition_set.aggregate(billed=Sum('billed'), cancelled=Sum('cancelled'))
+  run.billed = totals['billed']
+  run.cancelled = totals['cancelled']
+  run.finished_at = timezone.now()
+  run.save(update_fields=['billed', 'cancelled', 'finished_at'])
+  return run
+
+
+def report_partition(partition_id, stdout):
+  if stdout is None:
+    return
+  partition = BillingPartition.objects.select_related('run').get(pk=partition_id)
+  state = 'finished' if partition.finished_at is not None else f'unfinished, leased by {partition.leased_by or "nobody"}'
+  stdout.write(f'{partition}: {partition.billed} billed, {partition.cancelled} cancelled ({state})')
+
+
+def reconcile(run):
+  """
+  Check the payments of a finished run: no subscription is left due and every billed subscription
+  has exactly one payment of this run. Return the counts, see is_consistent()
+  """
+  payments = Payment.objects.filter(billing_run=run)
+  return {
+    'still_due': due_subscriptions(run.run_date).count(),
+    'billed': run.billed,
+    'paid': payments.values('subscription').distinct().count(),
+    'payments': payments.count(),
+  }
+
+
+def is_consistent(checks):
+  return checks['still_due'] == 0 and checks['billed'] == checks['paid'] == checks['payments']
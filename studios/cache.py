@@ -0,0 +1,136 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.utils.module_loading import import_string
+
+
+def is_shared(cache):
+  """
+  Return whether a Django cache is seen by every process, local memory and dummy caches aren't
+  """
+  return not isinstance(cache, (LocMemCache, DummyCache))
+
+
+class LocMemLRUBackend:
+  """
+  Process-local least recently used cache with a time to live on every entry,
+  versions are kept apart from the entries so they are never evicted
+  """
+  shared = False
+
+  def __init__(self, max_entries=1024, timeout=300):
+    self.max_entries = max_entries
+    self.timeout = timeout
+    self._lock = threading.Lock()
+    self._entries = OrderedDict()
+    self._versions = {}
+
+  def get(self, key):
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is None:
+        return None
+      expires, value = entry
+      if expires < time.monotonic():
+        del self._entries[key]
+        return None
+      self._entries.move_to_end(key)
+      return value
+
+  def set(self, key, value):
+    with self._lock:
+      self._entries[key] = (time.monotonic() + self.timeout, value)
+      self._entries.move_to_end(key)
+      while len(self._entries) > self.max_entries:
+        self._entries.popitem(last=False)
+
+  def get_version(self, scope):
+    return self._versions.get(scope, 0)
+
+  def bump_version(self, scope):
+    with self._lock:
+      self._versions[scope] = self._versions.get(scope, 0) + 1
+
+
+class DjangoCacheBackend:
+  """
+  Cache shared between processes through one of the CACHES aliases (e.g. redis or memcached),
+  an evicted version restarts from the current time so it never matches older entries
+  """
+  def __init__(self, alias='default', timeout=300):
+    self.cache = caches[alias]
+    self.timeout = timeout
+
+  @property
+  def shared(self):
+    return is_shared(self.cache)
+
+  def get(self, key):
+    return self.cache.get(key)
+
+  def set(self, key, value):
+    self.cache.set(key, value, self.timeout)
+
+  def get_version(self, scope):
+    key = f'version:{scope}'
+    version = self.cache.get(key)
+    if version is None:
+      self.cache.add(key, time.time_ns(), None)
+      version = self.cache.get(key)
+    return version
+
+  def bump_version(self, scope):
+    key = f'version:{scope}'
+    try:
+      self.cache.incr(key)
+    except ValueError:
+      self.cache.set(key, time.time_ns(), None)
+
+
+class ResponseCache:
+  """
+  Rendered responses keyed by endpoint, arguments and the version of the data they were built from
+  """
+  def __init__(self):
+    self._backend = None
+
+  @property
+  def backend(self):
+    if self._backend is None:
+      config = getattr(settings, 'STUDIOS_RESPONSE_CACHE', {})
+      backend_class = import_string(config.get('BACKEND', 'studios.cache.LocMemLRUBackend'))
+      self._backend = backend_class(**config.get('OPTIONS', {}))
+    return self._backend
+
+  @property
+  def shared(self):
+    return self.backend.shared
+
+  def key(self, scope, path, query_params, validator=None, media_type=None):
+    query = '&'.join(f'{name}={value}' for name, value in sorted(query_params.lists()))
+    raw = f'{scope}:{self.backend.get_version(scope)}:{validator}:{media_type}:{path}?{query}'
+    return 'response:' + hashlib.md5(raw.encode()).hexdigest()
+
+  def get(self, key):
+    return self.backend.get(key)
+
+  def set(self, key, value):
+    self.backend.set(key, value)
+
+  def bump(self, scope):
+    self.backend.bump_version(scope)
+
+  def clear(self):
+    """
+    Drop the backend, it is built again from the settings on next use
+    """
+    self._backend = None
+
+
+response_cache = ResponseCache()
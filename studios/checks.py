@@ -0,0 +1,21 @@
+from django.conf import settings
+from django.core.checks import Tags, Warning, register
+
+from studios.cache import response_cache
+
+
+@register(Tags.caches)
+def check_availability_stream_cache(app_configs, **kwargs):
+  """
+  The availability stream polls versions bumped by whichever process handled the enrolment,
+  a process-local response cache never sees the bumps of the other workers
+  """
+  if not getattr(settings, 'STUDIOS_AVAILABILITY_STREAM', False) or response_cache.shared:
+    return []
+  return [Warning(
+    'The availability stream is enabled with a process-local STUDIOS_RESPONSE_CACHE, streams '
+    'miss the seat changes made by other workers.',
+    hint="Use studios.cache.DjangoCacheBackend with a shared CACHES alias (e.g. redis or memcached), "
+         "or set STUDIOS_AVAILABILITY_STREAM = False.",
+    id='studios.W001',
+  )]
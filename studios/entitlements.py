@@ -0,0 +1,61 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import Count, Q
+
+from studios.cache import DjangoCacheBackend, is_shared
+from studios.models import Subscription
+
+ACTIVE = 'active'
+INACTIVE = 'inactive'
+NONE = 'none'
+
+
+def get_backend():
+  """
+  Return the cache entitlements are kept in, None when STUDIOS_ENTITLEMENT_CACHE is process-local:
+  a web worker would keep serving an entitlement changed by another worker or by billing
+  """
+  alias = getattr(settings, 'STUDIOS_ENTITLEMENT_CACHE', 'default')
+  if not is_shared(caches[alias]):
+    return None
+  return DjangoCacheBackend(alias, getattr(settings, 'STUDIOS_ENTITLEMENT_CACHE_TIMEOUT', 300))
+
+
+def get_scope(user_id):
+  return f'entitlement:{user_id}'
+
+
+def load_entitlement(user_id):
+  counts = Subscription.objects.filter(user_id=user_id).aggregate(active=Count('id', filter=Q(status='active')), total=Count('id'))
+  return ACTIVE if counts['active'] else INACTIVE if counts['total'] else NONE
+
+
+def get_entitlement(user_id):
+  """
+  Return ACTIVE when the user has an active subscription, INACTIVE when all of their subscriptions
+  are cancelled and NONE without any, cached in the shared entitlement cache until one of their
+  subscriptions changes
+  """
+  backend = get_backend()
+  if backend is None:
+    return load_entitlement(user_id)
+  # an entitlement read before a concurrent change commits is written under the old version,
+  # which nobody reads once the change has bumped it
+  key = f'{get_scope(user_id)}:{backend.get_version(get_scope(user_id))}'
+  entitlement = backend.get(key)
+  if entitlement is None:
+    entitlement = load_entitlement(user_id)
+    backend.set(key, entitlement)
+  return entitlement
+
+
+def invalidate(user_ids):
+  """
+  Drop the cached entitlements of the given users once the current transaction commits,
+  needed after writes that bypass the Subscription signals
+  """
+  backend = get_backend()
+  if backend is None:
+    return
+  transaction.on_commit(lambda: [backend.bump_version(get_scope(user_id)) for user_id in user_ids])
@@ -0,0 +1,79 @@
+from django.core.exceptions import FieldDoesNotExist, ImproperlyConfigured
+from rest_framework import serializers
+
+from studios.mixins import SerializeRowsMixin
+
+# fields whose to_representation leaves the database value as it is
+IDENTITY_FIELDS = (serializers.CharField, serializers.IntegerField, serializers.FloatField)
+
+
+class ValuesSerializer:
+  """
+  Read-only serializer that builds the output of a ModelSerializer straight from
+  .values() rows, each field's conversion is looked up once when it is compiled
+  """
+  def __init__(self, serializer):
+    self.lookups = []
+    self.mappers = self._compile(serializer, '')
+
+  def _compile(self, serializer, prefix):
+    model = serializer.Meta.model
+    mappers = []
+    for name, field in serializer.fields.items():
+      if field.write_only:
+        continue
+      source = field.source
+      try:
+        model_field = model._meta.get_field(source)
+      except FieldDoesNotExist:
+        raise ImproperlyConfigured(f"{serializer.__class__.__name__}.{name} is not a model field")
+      lookup = f'{prefix}{source}'
+      if isinstance(field, serializers.Serializer):
+        # a null foreign key serializes the whole nested object as None
+        self.lookups.append(lookup)
+        mappers.append((name, lookup, None, self._compile(field, f'{lookup}__')))
+        continue
+      if isinstance(field, serializers.ListSerializer) or model_field.many_to_many or model_field.one_to_many:
+        raise ImproperlyConfigured(f"{serializer.__class__.__name__}.{name} is a to-many relation")
+      if isinstance(field, serializers.RelatedField) or type(field) in IDENTITY_FIELDS:
+        # .values() already gives the related primary key
+        to_representation = None
+      else:
+        to_representation = field.to_representation
+      self.lookups.append(lookup)
+      mappers.append((name, lookup, to_representation, None))
+    return mappers
+
+  def values(self, queryset):
+    return queryset.values(*self.lookups)
+
+  def _represent(self, row, mappers):
+    data = {}
+    for name, lookup, to_representation, nested in mappers:
+      value = row[lookup]
+      if value is None:
+        data[name] = None
+      elif nested is not None:
+        data[name] = self._represent(row, nested)
+      elif to_representation is None:
+        data[name] = value
+      else:
+        data[name] = to_representation(value)
+    return data
+
+  def to_representation(self, rows):
+    mappers = self.mappers
+    return [self._represent(row, mappers) for row in rows]
+
+
+class ValuesListMixin(SerializeRowsMixin):
+  """
+  List view mixin serializing rows from .values() through a ValuesSerializer built
+  from the view's serializer, the output is the same as the model serializer's
+  """
+  def get_rows(self, queryset):
+    self.values_serializer = ValuesSerializer(self.get_serializer())
+    return self.values_serializer.values(queryset)
+
+  def serialize_rows(self, rows):
+    return self.values_serializer.to_representation(rows)
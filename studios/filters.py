@@ -0,0 +1,62 @@
+from django.conf import settings
+from django.utils import timezone
+from django_filters import rest_framework as filters
+from rest_framework.exceptions import ValidationError
+
+from studios import geo
+from studios.models import Point, StudioClass
+from studios.nearest import nearest_studios
+from studios.search import search_classes
+
+
+class StudioClassFilter(filters.FilterSet):
+  """
+  Typed filters for a studio's schedule, time bounds compare on the indexed start_time
+  instead of matching it as text
+  """
+  start_after = filters.IsoDateTimeFilter(field_name='start_time', lookup_expr='gte')
+  start_before = filters.IsoDateTimeFilter(field_name='start_time', lookup_expr='lte')
+
+  class Meta:
+    model = StudioClass
+    fields = ('name', 'coach', 'start_time', 'end_time', 'start_after', 'start_before')
+
+
+class ClassSearchFilter(StudioClassFilter):
+  """
+  Upcoming classes across all studios matching the words of q in their name, coach or keywords,
+  optionally less than radius_km away from latitude/longitude
+  """
+  # applied together in filter_queryset, they depend on each other and on the time window
+  q = filters.CharFilter(method='filter_in_queryset')
+  latitude = filters.NumberFilter(method='filter_in_queryset')
+  longitude = filters.NumberFilter(method='filter_in_queryset')
+  radius_km = filters.NumberFilter(method='filter_in_queryset')
+
+  class Meta(StudioClassFilter.Meta):
+    fields = StudioClassFilter.Meta.fields + ('q', 'latitude', 'longitude', 'radius_km')
+
+  def filter_in_queryset(self, queryset, name, value):
+    return queryset
+
+  def filter_queryset(self, queryset):
+    queryset = super().filter_queryset(queryset)
+    data = self.form.cleaned_data
+    if data.get('q'):
+      # only upcoming classes are searched, the window keeps each token's index scan short
+      now = timezone.now()
+      start_after = max(data['start_after'], now) if data.get('start_after') else now
+      queryset = search_classes(queryset, data['q'], start_after, data.get('start_before'))
+    if data.get('radius_km') is not None:
+      queryset = self.filter_distance(queryset, data.get('latitude'), data.get('longitude'), float(data['radius_km']))
+    return queryset
+
+  def filter_distance(self, queryset, latitude, longitude, radius_km):
+    if latitude is None or longitude is None:
+      raise ValidationError({'radius_km': ['latitude and longitude are required with radius_km.']})
+    latitude, longitude = float(latitude), float(longitude)
+    if settings.STUDIOS_NEAREST_INDEX:
+      return queryset.filter(studio_id__in=nearest_studios.nearest(latitude, longitude, radius_km=radius_km))
+    return queryset.filter(Point.in_bounding_box(latitude, longitude, radius_km, 'studio__point__')) \
+      .alias(proximity=Point.proximity_expression(latitude, longitude, 'studio__point__')) \
+      .filter(proximity__gt=geo.proximity(radius_km))
@@ -0,0 +1,136 @@
+import math
+
+# geohash helpers used to index Point rows by grid cell
+# reference: https://en.wikipedia.org/wiki/Geohash
+
+EARTH_RADIUS_KM = 6371
+GEOHASH_PRECISION = 12
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+
+def encode(latitude, longitude, precision=GEOHASH_PRECISION):
+  """
+  Return the geohash of the cell containing the given coordinates
+  """
+  lat_range = [-90.0, 90.0]
+  lon_range = [-180.0, 180.0]
+  geohash = []
+  bits = 0
+  bit_count = 0
+  even = True
+  while len(geohash) < precision:
+    value, bounds = (longitude, lon_range) if even else (latitude, lat_range)
+    mid = (bounds[0] + bounds[1]) / 2
+    bits <<= 1
+    if value >= mid:
+      bits |= 1
+      bounds[0] = mid
+    else:
+      bounds[1] = mid
+    even = not even
+    bit_count += 1
+    if bit_count == 5:
+      geohash.append(BASE32[bits])
+      bits = 0
+      bit_count = 0
+  return ''.join(geohash)
+
+
+def unit_vector(latitude, longitude):
+  """
+  Return the position of the coordinates on the unit sphere
+  """
+  lat = math.radians(latitude)
+  lon = math.radians(longitude)
+  return (math.cos(lat) * math.cos(lon), math.cos(lat) * math.sin(lon), math.sin(lat))
+
+
+def proximity(distance_km):
+  """
+  Return the dot product of two unit vectors distance_km apart, it shrinks as the distance grows
+  """
+  return math.cos(min(distance_km / EARTH_RADIUS_KM, math.pi))
+
+
+def bounding_box(latitude, longitude, distance_km):
+  """
+  Return ((min_lat, max_lat), [(min_lon, max_lon), ...]) enclosing every point less than
+  distance_km away from the coordinates, longitudes split in two ranges across the antimeridian
+  source: http://janmatuschek.de/LatitudeLongitudeBoundingCoordinates
+  """
+  angle = distance_km / EARTH_RADIUS_KM
+  d_lat = math.degrees(angle)
+  min_lat = latitude - d_lat
+  max_lat = latitude + d_lat
+  # a pole is inside the circle, every longitude can be reached
+  if min_lat <= -90 or max_lat >= 90:
+    return (max(min_lat, -90), min(max_lat, 90)), [(-180, 180)]
+  d_lon = math.degrees(math.asin(min(math.sin(angle) / math.cos(math.radians(latitude)), 1)))
+  min_lon = longitude - d_lon
+  max_lon = longitude + d_lon
+  if d_lon >= 180:
+    return (min_lat, max_lat), [(-180, 180)]
+  if min_lon < -180:
+    return (min_lat, max_lat), [(min_lon + 360, 180), (-180, max_lon)]
+  if max_lon > 180:
+    return (min_lat, max_lat), [(min_lon, 180), (-180, max_lon - 360)]
+  return (min_lat, max_lat), [(min_lon, max_lon)]
+
+
+def cell_size(precision):
+  """
+  Return the (latitude, longitude) size in degrees of a cell at the given precision
+  """
+  lon_bits = (5 * precision + 1) // 2
+  lat_bits = 5 * precision // 2
+  return 180.0 / 2 ** lat_bits, 360.0 / 2 ** lon_bits
+
+
+def neighbourhood(latitude, longitude, precision):
+  """
+  Return the geohashes of the 3x3 block of cells centred on the cell containing the coordinates
+  """
+  lat_size, lon_size = cell_size(precision)
+  # centre of the cell containing the coordinates
+  centre_lat = (math.floor((latitude + 90) / lat_size) + 0.5) * lat_size - 90
+  centre_lon = (math.floor((longitude + 180) / lon_size) + 0.5) * lon_size - 180
+  cells = set()
+  for d_lat in (-1, 0, 1):
+    lat = centre_lat + d_lat * lat_size
+    if lat <= -90 or lat >= 90:
+      continue
+    for d_lon in (-1, 0, 1):
+      lon = (centre_lon + d_lon * lon_size + 180) % 360 - 180
+      cells.add(encode(lat, lon, precision))
+  return cells
+
+
+def safe_radius(latitude, precision):
+  """
+  Return the distance in kilometers around the coordinates that is guaranteed to be
+  covered by their neighbourhood() at the given precision
+  """
+  lat_size, lon_size = cell_size(precision)
+  # the block reaches at least one full cell past the centre cell on every side,
+  # east/west cells are narrowest at the block's edge closest to a pole
+  edge_lat = abs(latitude) + 2 * lat_size
+  if edge_lat >= 90 or lon_size >= 90:
+    return 0
+  lat_km = math.radians(lat_size) * EARTH_RADIUS_KM
+  lon_km = math.asin(math.sin(math.radians(lon_size)) * math.cos(math.radians(edge_lat))) * EARTH_RADIUS_KM
+  return min(lat_km, lon_km)
+
+
+def prefix_range(prefix):
+  """
+  Return (lower, upper) bounds so that lower <= geohash < upper matches every geohash
+  starting with prefix, upper is None when there is no bound
+  """
+  chars = list(prefix)
+  while chars:
+    position = BASE32.index(chars[-1])
+    if position + 1 < len(BASE32):
+      chars[-1] = BASE32[position + 1]
+      return prefix, ''.join(chars)
+    chars.pop()
+  return prefix, None
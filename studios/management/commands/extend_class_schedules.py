@@ -0,0 +1,18 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from studios.schedules import extend_schedules, get_horizon
+
+
+class Command(BaseCommand):
+  help = 'Write upcoming occurrences of recurring classes up to the schedule horizon'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--days', type=int, help='horizon in days, defaults to STUDIOS_SCHEDULE_HORIZON_DAYS')
+
+  def handle(self, *args, **options):
+    until = timezone.now() + timedelta(days=options['days']) if options['days'] is not None else get_horizon()
+    created = extend_schedules(until)
+    self.stdout.write(self.style.SUCCESS(f'{created} classes written up to {until:%Y-%m-%d %H:%M}'))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from studios.search import rebuild_index
+
+
+class Command(BaseCommand):
+  help = 'Rebuild the search tokens of every class'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--chunk-size', type=int, default=1000, help='number of classes indexed per batch')
+
+  def handle(self, *args, **options):
+    created = rebuild_index(options['chunk_size'])
+    self.stdout.write(self.style.SUCCESS(f'{created} search tokens written'))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from studios.summaries import rebuild
+
+
+class Command(BaseCommand):
+  help = 'Recount the monthly payment summaries of every user from their payments'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--chunk-size', type=int, default=1000, help='number of summaries written per batch')
+
+  def handle(self, *args, **options):
+    created = rebuild(options['chunk_size'])
+    self.stdout.write(self.style.SUCCESS(f'{created} payment summaries written'))
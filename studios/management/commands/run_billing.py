@@ -0,0 +1,25 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+
+from studios.billing import CHUNK_SIZE, is_consistent, reconcile, run_billing
+
+
+class Command(BaseCommand):
+  help = 'Charge the subscriptions due today, safe to run again after a crash'
+
+  def add_arguments(self, parser):
+    parser.add_argument('--date', type=date.fromisoformat, help='day to bill (YYYY-MM-DD), defaults to today')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='number of subscriptions billed per transaction')
+    parser.add_argument('--workers', type=int, default=1, help='number of worker processes')
+    parser.add_argument('--partitions', type=int, help='partitions of a new run, defaults to the number of workers')
+
+  def handle(self, *args, **options):
+    run = run_billing(options['date'], options['chunk_size'], options['workers'], options['partitions'], self.stdout)
+    if run.finished_at is None:
+      raise CommandError(f'{run} has unfinished partitions, run it again once their leases expire')
+    self.stdout.write(self.style.SUCCESS(f'{run}: {run.billed} billed, {run.cancelled} cancelled'))
+    checks = reconcile(run)
+    self.stdout.write(', '.join(f'{name} {value}' for name, value in checks.items()))
+    if not is_consistent(checks):
+      raise CommandError(f'{run} does not reconcile')
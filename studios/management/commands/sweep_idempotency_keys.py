@@ -0,0 +1,16 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from studios.models import IdempotencyKey
+
+
+class Command(BaseCommand):
+  help = 'Delete idempotency keys older than IDEMPOTENCY_KEY_TTL_HOURS'
+
+  def handle(self, *args, **options):
+    expired = timezone.now() - timedelta(hours=settings.IDEMPOTENCY_KEY_TTL_HOURS)
+    deleted, _ = IdempotencyKey.objects.filter(created_at__lt=expired).delete()
+    self.stdout.write(self.style.SUCCESS(f'{deleted} idempotency keys deleted'))
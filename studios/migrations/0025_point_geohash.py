@@ -0,0 +1,55 @@
+# Generated by Django 4.1.3 on 2026-10-18 10:00
+
+from django.db import migrations, models
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+
+def encode(latitude, longitude, precision=12):
+    # copy of studios.geo.encode() as of this migration, later changes to it must not alter it
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    geohash = []
+    bits = 0
+    bit_count = 0
+    even = True
+    while len(geohash) < precision:
+        value, bounds = (longitude, lon_range) if even else (latitude, lat_range)
+        mid = (bounds[0] + bounds[1]) / 2
+        bits <<= 1
+        if value >= mid:
+            bits |= 1
+            bounds[0] = mid
+        else:
+            bounds[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            geohash.append(BASE32[bits])
+            bits = 0
+            bit_count = 0
+    return ''.join(geohash)
+
+
+def fill_geohash(apps, schema_editor):
+    Point = apps.get_model('studios', 'Point')
+    points = list(Point.objects.all())
+    for point in points:
+        point.geohash = encode(point.latitude, point.longitude)
+    Point.objects.bulk_update(points, ['geohash'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('studios', '0024_alter_subscription_user'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='point',
+            name='geohash',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=12),
+        ),
+        migrations.RunPython(fill_geohash, migrations.RunPython.noop),
+    ]
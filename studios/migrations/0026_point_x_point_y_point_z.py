@@ -0,0 +1,46 @@
+# Generated by Django 4.1.3 on 2026-10-18 11:00
+
+import math
+
+from django.db import migrations, models
+
+
+def unit_vector(latitude, longitude):
+    # copy of studios.geo.unit_vector() as of this migration, later changes to it must not alter it
+    lat = math.radians(latitude)
+    lon = math.radians(longitude)
+    return (math.cos(lat) * math.cos(lon), math.cos(lat) * math.sin(lon), math.sin(lat))
+
+
+def fill_unit_vectors(apps, schema_editor):
+    Point = apps.get_model('studios', 'Point')
+    points = list(Point.objects.all())
+    for point in points:
+        point.x, point.y, point.z = unit_vector(point.latitude, point.longitude)
+    Point.objects.bulk_update(points, ['x', 'y', 'z'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('studios', '0025_point_geohash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='point',
+            name='x',
+            field=models.FloatField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='point',
+            name='y',
+            field=models.FloatField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='point',
+            name='z',
+            field=models.FloatField(default=0, editable=False),
+        ),
+        migrations.RunPython(fill_unit_vectors, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.1.3 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('studios', '0026_point_x_point_y_point_z'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='point',
+            index=models.Index(fields=['latitude', 'longitude'], name='point_lat_long_idx'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.1.3 on 2026-10-18 13:00
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('studios', '0027_point_lat_long_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='classbooking',
+            name='last_modified',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name='studio',
+            name='last_modified',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name='studioclass',
+            name='last_modified',
+            field=models.DateTimeField(auto_now=True),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 4.1.3 on 2026-10-18 14:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('studios', '0028_studio_last_modified_studioclass_last_modified_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ClassSeries',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=200)),
+                ('description', models.CharField(max_length=200)),
+                ('coach', models.CharField(max_length=200)),
+                ('capacity', models.PositiveIntegerField()),
+                ('start_time', models.DateTimeField()),
+                ('end_time', models.DateTimeField()),
+                ('recurrence_end', models.DateTimeField()),
+                ('interval_days', models.PositiveIntegerField(default=7)),
+                ('status', models.CharField(choices=[('active', 'active'), ('cancelled', 'cancelled')], default='active', max_length=20)),
+                ('materialized_until', models.DateTimeField(blank=True, editable=False, null=True)),
+            ],
+            options={
+                'verbose_name_plural': 'class series',
+            },
+        ),
+        migrations.AddField(
+            model_name='classseries',
+            name='studio',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.DO_NOTHING, related_name='series', to='studios.studio'),
+        ),
+        migrations.AddField(
+            model_name='studioclass',
+            name='series',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='occurrences', to='studios.classseries'),
+        ),
+        migrations.AddConstraint(
+            model_name='studioclass',
+            constraint=models.UniqueConstraint(fields=('series', 'start_time'), name='unique_series_occurrence'),
+        ),
+    ]
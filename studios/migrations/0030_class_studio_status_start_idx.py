@@ -0,0 +1,17 @@
+# Generated by Django 4.1.3 on 2026-10-18 15:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('studios', '0029_classseries_studioclass_series'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='studioclass',
+            index=models.Index(fields=['studio', 'status', 'start_time'], name='class_studio_status_start_idx'),
+        ),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 4.1.3 on 2026-10-18 16:00
+
+import re
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+TOKEN_RE = re.compile(r'\w+')
+
+
+def tokenize(*texts):
+    # copy of studios.search.tokenize() as of this migration, later changes to it must not alter it
+    tokens = set()
+    for text in texts:
+        if text:
+            tokens.update(token[:50] for token in TOKEN_RE.findall(text.lower()))
+    return tokens
+
+
+def fill_search_tokens(apps, schema_editor):
+    StudioClass = apps.get_model('studios', 'StudioClass')
+    ClassSearchToken = apps.get_model('studios', 'ClassSearchToken')
+    tokens = []
+    for studio_class in StudioClass.objects.prefetch_related('keywords'):
+        keywords = [keyword.keyword for keyword in studio_class.keywords.all()]
+        for token in tokenize(studio_class.name, studio_class.coach, *keywords):
+            tokens.append(ClassSearchToken(token=token, studio_class=studio_class, start_time=studio_class.start_time))
+    ClassSearchToken.objects.bulk_create(tokens, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('studios', '0030_class_studio_status_start_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ClassSearchToken',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.CharField(max_length=50)),
+                ('start_time', models.DateTimeField()),
+                ('studio_class', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_tokens', to='studios.studioclass')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='classsearchtoken',
+            index=models.Index(fields=['token', 'start_time'], name='class_search_token_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='classsearchtoken',
+            constraint=models.UniqueConstraint(fields=('studio_class', 'token'), name='unique_class_search_token'),
+        ),
+        migrations.RunPython(fill_search_tokens, migrations.RunPython.noop),
+    ]
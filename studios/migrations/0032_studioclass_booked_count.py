@@ -0,0 +1,38 @@
+# Generated by Django 4.1.3 on 2026-10-18 17:00
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def remove_duplicate_bookings(apps, schema_editor):
+    ClassBooking = apps.get_model('studios', 'ClassBooking')
+    duplicates = ClassBooking.objects.values('studio_class', 'user') \
+        .annotate(first_id=Min('id'), bookings=Count('id')).filter(bookings__gt=1)
+    for duplicate in duplicates:
+        ClassBooking.objects.filter(studio_class=duplicate['studio_class'], user=duplicate['user']) \
+            .exclude(id=duplicate['first_id']).delete()
+
+
+def fill_booked_count(apps, schema_editor):
+    StudioClass = apps.get_model('studios', 'StudioClass')
+    studio_classes = list(StudioClass.objects.annotate(booking_total=Count('bookings')).filter(booking_total__gt=0))
+    for studio_class in studio_classes:
+        studio_class.booked_count = studio_class.booking_total
+    StudioClass.objects.bulk_update(studio_classes, ['booked_count'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('studios', '0031_classsearchtoken'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='studioclass',
+            name='booked_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(remove_duplicate_bookings, migrations.RunPython.noop),
+        migrations.RunPython(fill_booked_count, migrations.RunPython.noop),
+    ]
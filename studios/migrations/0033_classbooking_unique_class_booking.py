@@ -0,0 +1,17 @@
+# Generated by Django 4.1.3 on 2026-10-18 17:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('studios', '0032_studioclass_booked_count'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='classbooking',
+            constraint=models.UniqueConstraint(fields=('studio_class', 'user'), name='unique_class_booking'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.1.3 on 2026-10-18 20:00
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def fill_start_time(apps, schema_editor):
+    ClassBooking = apps.get_model('studios', 'ClassBooking')
+    StudioClass = apps.get_model('studios', 'StudioClass')
+    ClassBooking.objects.update(
+        start_time=Subquery(StudioClass.objects.filter(pk=OuterRef('studio_class_id')).values('start_time')[:1])
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('studios', '0035_idempotencykey'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='classbooking',
+            name='start_time',
+            field=models.DateTimeField(editable=False, null=True),
+        ),
+        migrations.RunPython(fill_start_time, migrations.RunPython.noop),
+    ]
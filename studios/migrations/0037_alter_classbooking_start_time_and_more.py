@@ -0,0 +1,22 @@
+# Generated by Django 4.1.3 on 2026-10-18 20:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('studios', '0036_classbooking_start_time'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='classbooking',
+            name='start_time',
+            field=models.DateTimeField(editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='classbooking',
+            index=models.Index(fields=['user', 'start_time', 'id'], name='booking_user_start_idx'),
+        ),
+    ]
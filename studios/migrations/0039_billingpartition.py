@@ -0,0 +1,51 @@
+# Generated by Django 4.1.3 on 2026-10-18 22:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('studios', '0038_billing'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='billingrun',
+            name='last_next_date',
+        ),
+        migrations.RemoveField(
+            model_name='billingrun',
+            name='last_subscription_id',
+        ),
+        migrations.AddField(
+            model_name='billingrun',
+            name='partitions',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='billing_run',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='payments', to='studios.billingrun'),
+        ),
+        migrations.CreateModel(
+            name='BillingPartition',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.PositiveIntegerField()),
+                ('last_next_date', models.DateField(blank=True, null=True)),
+                ('last_subscription_id', models.BigIntegerField(default=0)),
+                ('billed', models.PositiveIntegerField(default=0)),
+                ('cancelled', models.PositiveIntegerField(default=0)),
+                ('leased_by', models.CharField(blank=True, max_length=64)),
+                ('lease_expires', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('run', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='partition_set', to='studios.billingrun')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='billingpartition',
+            constraint=models.UniqueConstraint(fields=('run', 'number'), name='unique_billing_partition'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.1.3 on 2026-10-18 23:00
+
+from django.db import migrations
+from django.db.models import Count, Max
+
+
+def cancel_duplicate_active_subscriptions(apps, schema_editor):
+    Subscription = apps.get_model('studios', 'Subscription')
+    duplicates = Subscription.objects.filter(status='active').values('user') \
+        .annotate(latest_id=Max('id'), subscriptions=Count('id')).filter(subscriptions__gt=1)
+    for duplicate in duplicates:
+        # the views used to pick the last active subscription, it stays the current one
+        Subscription.objects.filter(user=duplicate['user'], status='active') \
+            .exclude(id=duplicate['latest_id']).update(status='cancelled')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('studios', '0039_billingpartition'),
+    ]
+
+    operations = [
+        migrations.RunPython(cancel_duplicate_active_subscriptions, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 4.1.3 on 2026-10-18 23:30
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, DateField, Sum
+from django.db.models.functions import TruncMonth
+import django.db.models.deletion
+
+
+def fill_payment_summaries(apps, schema_editor):
+    Payment = apps.get_model('studios', 'Payment')
+    PaymentMonthlySummary = apps.get_model('studios', 'PaymentMonthlySummary')
+    rows = Payment.objects.annotate(month=TruncMonth('date', output_field=DateField())) \
+        .values('user_id', 'month').annotate(count=Count('id'), total=Sum('amount')).order_by()
+    PaymentMonthlySummary.objects.bulk_create([PaymentMonthlySummary(**row) for row in rows], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('studios', '0041_unique_active_subscription'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PaymentMonthlySummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField()),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('total', models.FloatField(default=0)),
+            ],
+            options={
+                'verbose_name_plural': 'payment monthly summaries',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['user', 'date', 'id'], name='payment_user_date_idx'),
+        ),
+        migrations.AddField(
+            model_name='paymentmonthlysummary',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='payment_summaries', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddConstraint(
+            model_name='paymentmonthlysummary',
+            constraint=models.UniqueConstraint(fields=('user', 'month'), name='unique_payment_monthly_summary'),
+        ),
+        migrations.RunPython(fill_payment_summaries, migrations.RunPython.noop),
+    ]
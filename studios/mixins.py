@@ -0,0 +1,228 @@
+import hashlib
+import json
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models.query import QuerySet
+from django.http import HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.cache import patch_vary_headers
+from django.utils.http import parse_etags, quote_etag
+from rest_framework.response import Response
+
+from studios.cache import response_cache
+from studios.models import IdempotencyKey
+from studios.renderers import dumps
+
+
+class EagerLoadingMixin:
+  """
+  View mixin building querysets through the serializer's setup_eager_loading(),
+  only the relations of the fields being rendered are fetched
+  """
+  def setup_eager_loading(self, queryset):
+    serializer = self.get_serializer()
+    return serializer.setup_eager_loading(queryset, serializer.fields)
+
+
+class SerializeRowsMixin:
+  """
+  List view mixin splitting list() into get_rows() and serialize_rows() hooks
+  so other mixins can change how rows are fetched and serialized
+  """
+  def get_rows(self, queryset):
+    return queryset
+
+  def serialize_rows(self, rows):
+    return self.get_serializer(rows, many=True).data
+
+  def list(self, request, *args, **kwargs):
+    rows = self.get_rows(self.filter_queryset(self.get_queryset()))
+
+    page = self.paginate_queryset(rows)
+    if page is not None:
+      return self.get_paginated_response(self.serialize_rows(page))
+    return Response(self.serialize_rows(rows))
+
+
+class StreamingListMixin(SerializeRowsMixin):
+  """
+  List view mixin answering ?stream=true with the whole unpaginated list as a JSON array,
+  rows are fetched, serialized and flushed stream_chunk_size at a time so memory stays bounded
+  """
+  stream_chunk_size = 500
+
+  def list(self, request, *args, **kwargs):
+    if request.query_params.get('stream') not in ('true', '1'):
+      return super().list(request, *args, **kwargs)
+    rows = self.get_rows(self.filter_queryset(self.get_queryset()))
+    return StreamingHttpResponse(self.stream_rows(rows), content_type='application/json')
+
+  def chunk_rows(self, rows):
+    size = self.stream_chunk_size
+    if isinstance(rows, QuerySet):
+      # a server side cursor where the database supports it, prefetches run per chunk
+      chunk = []
+      for row in rows.iterator(chunk_size=size):
+        chunk.append(row)
+        if len(chunk) == size:
+          yield chunk
+          chunk = []
+      if chunk:
+        yield chunk
+      return
+    start = 0
+    while True:
+      chunk = list(rows[start:start + size])
+      if not chunk:
+        return
+      yield chunk
+      start += size
+
+  def stream_rows(self, rows):
+    yield b'['
+    separator = b''
+    for chunk in self.chunk_rows(rows):
+      yield separator + b','.join(dumps(item) for item in self.serialize_rows(chunk))
+      separator = b','
+    yield b']'
+
+
+class CachedResponseMixin:
+  """
+  View mixin caching rendered JSON GET responses under the endpoint, its arguments, the accepted
+  media type and the version of get_cache_scope(), signals bump the version when the data behind
+  it changes. Behind ConditionalGetMixin the ETag validator is part of the key too, so a body is
+  only ever sent with the ETag of the data it was built from
+  """
+  def get_cache_scope(self):
+    raise NotImplementedError
+
+  def get_cache_validator(self):
+    get_validator = getattr(self, 'get_validator', None)
+    return get_validator() if get_validator is not None else None
+
+  def get(self, request, *args, **kwargs):
+    if request.accepted_renderer.format != 'json':
+      return super().get(request, *args, **kwargs)
+    # media type params like indent=4 change the body
+    key = response_cache.key(
+      self.get_cache_scope(), request.path, request.query_params, self.get_cache_validator(), request.accepted_media_type
+    )
+    content = response_cache.get(key)
+    if content is None:
+      response = super().get(request, *args, **kwargs)
+      if response.status_code != 200:
+        return response
+      content = request.accepted_renderer.render(response.data, request.accepted_media_type, self.get_renderer_context())
+      response_cache.set(key, content)
+    response = HttpResponse(content, content_type='application/json')
+    patch_vary_headers(response, ['Accept'])
+    return response
+
+
+class ConditionalGetMixin:
+  """
+  View mixin answering If-None-Match with 304 Not Modified before anything is serialized,
+  the strong ETag is derived from get_etag_validator(), a cheap value that changes
+  whenever the response body would
+  """
+  def get_etag_validator(self):
+    raise NotImplementedError
+
+  def get_validator(self):
+    # computed once per request, CachedResponseMixin keys the body on it as well
+    if not hasattr(self, '_etag_validator'):
+      self._etag_validator = self.get_etag_validator()
+    return self._etag_validator
+
+  def get_etag(self, request):
+    raw = f'{request.user.pk}:{request.accepted_media_type}:{request.get_full_path()}:{self.get_validator()}'
+    return quote_etag(hashlib.md5(raw.encode()).hexdigest())
+
+  def get(self, request, *args, **kwargs):
+    etag = self.get_etag(request)
+    if_none_match = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+    if etag in if_none_match or '*' in if_none_match:
+      response = HttpResponseNotModified()
+    else:
+      response = super().get(request, *args, **kwargs)
+      if response.status_code != 200:
+        return response
+    response['ETag'] = etag
+    return response
+
+
+class IdempotentCreateMixin:
+  """
+  View mixin making create requests with an Idempotency-Key header safe to retry, the first
+  successful response is stored and returned again for the same key without running create().
+  A placeholder left by a request that never completed (a killed worker) is taken over by a
+  retry once it is older than IDEMPOTENCY_KEY_ABANDONED_SECONDS
+  """
+  def post(self, request, *args, **kwargs):
+    key = request.headers.get('Idempotency-Key')
+    if not key or not request.user.is_authenticated:
+      return super().post(request, *args, **kwargs)
+    if len(key) > 255:
+      return Response({'detail': 'Idempotency-Key is too long.'}, status=400)
+    fingerprint = self.get_fingerprint(request)
+    while True:
+      try:
+        with transaction.atomic():
+          record = IdempotencyKey.objects.create(user=request.user, key=key, fingerprint=fingerprint)
+        break
+      except IntegrityError:
+        record = IdempotencyKey.objects.filter(user=request.user, key=key).first()
+        if record is None:
+          # the request holding the key failed and released it in the meantime
+          continue
+        if self.take_over(record, fingerprint):
+          break
+        return self.replay(record, fingerprint)
+    try:
+      response = super().post(request, *args, **kwargs)
+    except Exception:
+      # failed requests are not stored, retrying them runs create() again
+      record.delete()
+      raise
+    record.status_code = response.status_code
+    record.response_body = response.data
+    record.save(update_fields=['status_code', 'response_body'])
+    return response
+
+  @staticmethod
+  def get_fingerprint(request):
+    """
+    Hash the method, path and parsed data of a request, the raw body can't be read anymore
+    once CSRF checks have parsed a multipart request
+    """
+    data = request.data
+    if hasattr(data, 'lists'):
+      # form data, uploaded files count by name
+      data = dict(data.lists())
+    body = json.dumps(data, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256('\n'.join((request.method, request.get_full_path(), body)).encode()).hexdigest()
+
+  def take_over(self, record, fingerprint):
+    """
+    Claim the placeholder of an abandoned request with the same fingerprint, return whether it was claimed
+    """
+    if record.status_code is not None or record.fingerprint != fingerprint:
+      return False
+    abandoned = timezone.now() - timedelta(seconds=settings.IDEMPOTENCY_KEY_ABANDONED_SECONDS)
+    if record.created_at >= abandoned:
+      return False
+    # restarting the clock lets only one of several concurrent retries claim it
+    return IdempotencyKey.objects.filter(pk=record.pk, status_code__isnull=True, created_at=record.created_at) \
+      .update(created_at=timezone.now()) == 1
+
+  def replay(self, record, fingerprint):
+    if record.fingerprint != fingerprint:
+      return Response({'detail': 'Idempotency-Key was already used for a different request.'}, status=422)
+    if record.status_code is None:
+      return Response({'detail': 'A request with this Idempotency-Key is still in progress.'}, status=409)
+    response = Response(record.response_body, status=record.status_code)
+    response['Idempotent-Replayed'] = 'true'
+    return response
@@ -1,26 +1,12 @@
-from django.db import models
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import IntegrityError, models, transaction
 from django.contrib.auth import get_user_model
 from django.db.models import CASCADE
 
-# code for distance calc, sqlite doesn't natively support math functions, so add them
-# source: https://stackoverflow.com/questions/19703975/django-sort-by-distance
-import math
-from django.db.backends.signals import connection_created
-from django.dispatch import receiver
-from django.db.models.expressions import RawSQL
+from django.db.models import ExpressionWrapper, F, Q
 
 from accounts.models import User
-
-@receiver(connection_created)
-def extend_sqlite(connection=None, **kwargs):
-    if connection.vendor == "sqlite":
-        cf = connection.connection.create_function
-        cf('acos', 1, math.acos)
-        cf('cos', 1, math.cos)
-        cf('radians', 1, math.radians)
-        cf('sin', 1, math.sin)
-        cf('least', 2, min)
-        cf('greatest', 2, max)
+from studios import geo
 
 # Create your models here.
 
@@ -36,38 +22,111 @@ class Image(models.Model):
     image_url = self.image.url[14:]
     return f"https://moonfitness-images.s3.us-east-2.amazonaws.com{image_url}"
 
+# finest geohash precision tried when narrowing a nearby search (cells of ~1.2km x 0.6km)
+NEARBY_SEARCH_PRECISION = 6
+
 class Point(models.Model):
   latitude = models.FloatField()
   longitude = models.FloatField()
   studio = models.OneToOneField('Studio', on_delete=models.CASCADE, related_name='point', unique=True)
+  # spatial index, nearby lookups only read the cells around the user
+  geohash = models.CharField(max_length=geo.GEOHASH_PRECISION, db_index=True, blank=True, editable=False)
+  # position on the unit sphere, distances reduce to a dot product the database evaluates natively
+  x = models.FloatField(default=0, editable=False)
+  y = models.FloatField(default=0, editable=False)
+  z = models.FloatField(default=0, editable=False)
   
   def __str__(self):
     return f"{self.latitude},{self.longitude}"
     # return self.studio.name
 
-  #method source: https://stackoverflow.com/questions/19703975/django-sort-by-distance
-  def get_points_nearby_coords(latitude, longitude, max_distance=None):
+  @property
+  def vector(self):
+    return (self.x, self.y, self.z)
+
+  def save(self, *args, **kwargs):
+    self.geohash = geo.encode(self.latitude, self.longitude)
+    self.x, self.y, self.z = geo.unit_vector(self.latitude, self.longitude)
+    update_fields = kwargs.get('update_fields')
+    if update_fields is not None and ('latitude' in update_fields or 'longitude' in update_fields):
+      kwargs['update_fields'] = {*update_fields, 'geohash', 'x', 'y', 'z'}
+    super().save(*args, **kwargs)
+
+  def in_cells(cells, field_prefix=''):
     """
-    Return objects sorted by distance to specified coordinates
-    which distance is less than max_distance given in kilometers
-    """
-    # Great circle distance formula
-    gcd_formula = "6371 * acos(least(greatest(\
-    cos(radians(%s)) * cos(radians(latitude)) \
-    * cos(radians(longitude) - radians(%s)) + \
-    sin(radians(%s)) * sin(radians(latitude)) \
-    , -1), 1))"
-    distance_raw_sql = RawSQL(
-        gcd_formula,
-        (latitude, longitude, latitude)
+    Return a filter matching points inside any of the given geohash cells
+    """
+    condition = Q()
+    for cell in cells:
+      lower, upper = geo.prefix_range(cell)
+      cell_condition = Q(**{f'{field_prefix}geohash__gte': lower})
+      if upper is not None:
+        cell_condition &= Q(**{f'{field_prefix}geohash__lt': upper})
+      condition |= cell_condition
+    return condition
+
+  def in_bounding_box(latitude, longitude, distance_km, field_prefix=''):
+    """
+    Return a filter on the indexed latitude/longitude columns matching a box that
+    holds every point less than distance_km away from the coordinates
+    """
+    (min_lat, max_lat), lon_ranges = geo.bounding_box(latitude, longitude, distance_km)
+    lon_condition = Q()
+    for min_lon, max_lon in lon_ranges:
+      lon_condition |= Q(**{f'{field_prefix}longitude__gte': min_lon, f'{field_prefix}longitude__lte': max_lon})
+    return Q(**{f'{field_prefix}latitude__gte': min_lat, f'{field_prefix}latitude__lte': max_lat}) & lon_condition
+
+  def narrow_to_nearest(queryset, latitude, longitude, limit, field_prefix=''):
+    """
+    Restrict a queryset annotated with proximity to the smallest block of geohash cells
+    around the coordinates that is guaranteed to hold the closest limit points
+    """
+    for precision in range(NEARBY_SEARCH_PRECISION, 0, -1):
+      radius = geo.safe_radius(latitude, precision)
+      if radius == 0:
+        break
+      cells = geo.neighbourhood(latitude, longitude, precision)
+      candidates = queryset.filter(Point.in_cells(cells, field_prefix))
+      # every point closer than radius is inside the block, so once the block holds
+      # limit of them its closest limit points are the overall closest
+      if candidates.filter(proximity__gte=geo.proximity(radius)).count() >= limit:
+        return candidates
+    return queryset
+
+  def proximity_expression(latitude, longitude, field_prefix=''):
+    """
+    Return the dot product between the unit vectors of the specified coordinates and
+    the point reached through field_prefix (e.g. 'point__' from a Studio),
+    it is the cosine of the angle between them so larger means closer
+    """
+    x, y, z = geo.unit_vector(latitude, longitude)
+    return ExpressionWrapper(
+      x * F(f'{field_prefix}x') + y * F(f'{field_prefix}y') + z * F(f'{field_prefix}z'),
+      output_field=models.FloatField()
     )
+
+  def get_points_nearby_coords(latitude, longitude, max_distance=None, limit=None):
+    """
+    Return objects sorted by distance to specified coordinates
+    which distance is less than max_distance given in kilometers, ties are broken by studio id,
+    when limit is given only the first limit objects are guaranteed to be in order
+    """
     qs = Point.objects.all() \
-    .annotate(distance=distance_raw_sql) \
-    .order_by('distance')
+    .annotate(proximity=Point.proximity_expression(latitude, longitude)) \
+    .order_by('-proximity', 'studio_id')
     if max_distance is not None:
-        qs = qs.filter(distance__lt=max_distance)
+        # cheap indexed box first, the exact distance only for the rows inside it
+        qs = qs.filter(Point.in_bounding_box(latitude, longitude, max_distance)) \
+        .filter(proximity__gt=geo.proximity(max_distance))
+    if limit is not None:
+        qs = Point.narrow_to_nearest(qs, latitude, longitude, limit)
     return qs
 
+  class Meta:
+    indexes = [
+      models.Index(fields=['latitude', 'longitude'], name='point_lat_long_idx'),
+    ]
+
 class Amenity(models.Model):
   type = models.CharField(max_length=200)
   quantity = models.IntegerField()
@@ -92,6 +151,27 @@ class Keyword(models.Model):
     return self.keyword
 
 STATUS_CHOICES = (('active', 'active'), ('cancelled', 'cancelled'))
+class ClassSeries(models.Model):
+  name = models.CharField(max_length=200)
+  description = models.CharField(max_length=200)
+  coach = models.CharField(max_length=200)
+  capacity = models.PositiveIntegerField()
+  # times of the first occurrence, later ones repeat every interval_days until recurrence_end
+  start_time = models.DateTimeField()
+  end_time = models.DateTimeField()
+  recurrence_end = models.DateTimeField()
+  interval_days = models.PositiveIntegerField(default=7)
+  studio = models.ForeignKey('Studio', on_delete=models.DO_NOTHING, related_name='series')
+  status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='active')
+  # start time of the last occurrence written, extending the schedule resumes after it
+  materialized_until = models.DateTimeField(null=True, blank=True, editable=False)
+
+  def __str__(self):
+    return f"{self.id} - {self.name} - every {self.interval_days} days"
+
+  class Meta:
+    verbose_name_plural = 'class series'
+
 class StudioClass(models.Model):
   name = models.CharField(max_length=200)
   description = models.CharField(max_length=200)
@@ -102,12 +182,83 @@ class StudioClass(models.Model):
   recurrence_end = models.DateTimeField()
   studio = models.ForeignKey('Studio', on_delete=models.DO_NOTHING, related_name='classes')
   status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='active')
+  last_modified = models.DateTimeField(auto_now=True)
+  # set on occurrences written from a recurring series
+  series = models.ForeignKey(ClassSeries, on_delete=models.DO_NOTHING, related_name='occurrences', null=True, blank=True)
+  # number of bookings, only changed through reserve_seat/release_seat
+  booked_count = models.PositiveIntegerField(default=0, editable=False)
 
   def __str__(self):
     return f"{self.id} - {self.name} - {self.start_time}"
 
+  def cancel(self):
+    self.status = 'cancelled'
+    self.save(update_fields=['status', 'last_modified'])
+
+  def reserve_seat(self):
+    """
+    Take a seat if the class is not full, return whether one was taken.
+    The check and the increment are a single conditional UPDATE, so concurrent bookings can't oversell
+    """
+    return StudioClass.objects.filter(pk=self.pk, booked_count__lt=F('capacity')) \
+      .update(booked_count=F('booked_count') + 1) == 1
+
+  def release_seat(self):
+    StudioClass.objects.filter(pk=self.pk, booked_count__gt=0).update(booked_count=F('booked_count') - 1)
+
+  def free_seat(self):
+    """
+    Hand the seat of a dropped booking to the first user on the waitlist who can still take it,
+    or give it back to the class when nobody can. Call inside the transaction deleting the booking
+    """
+    from studios import entitlements
+    while True:
+      # locking the head of the queue makes concurrent drops promote different users
+      entry = self.waitlist.select_for_update().order_by('id').first()
+      if entry is None:
+        self.release_seat()
+        return None
+      entry.delete()
+      # the check enrolments make, cached like theirs
+      if entitlements.get_entitlement(entry.user_id) != entitlements.ACTIVE:
+        continue
+      try:
+        with transaction.atomic():
+          return ClassBooking.objects.create(studio_class=self, user_id=entry.user_id)
+      except IntegrityError:
+        # booked the class in the meantime
+        continue
+
   class Meta:
     ordering = ['start_time']
+    indexes = [
+      # a studio's schedule filters on studio and status and scans start_time in order
+      models.Index(fields=['studio', 'status', 'start_time'], name='class_studio_status_start_idx'),
+    ]
+    constraints = [
+      models.UniqueConstraint(fields=['series', 'start_time'], name='unique_series_occurrence'),
+    ]
+
+
+class ClassSearchToken(models.Model):
+  """
+  Inverted index entry of studios.search, one row per distinct token of a class's name,
+  coach and keywords, start_time is copied so a token and a time window share one index
+  """
+  token = models.CharField(max_length=50)
+  studio_class = models.ForeignKey(StudioClass, on_delete=models.CASCADE, related_name='search_tokens')
+  start_time = models.DateTimeField()
+
+  def __str__(self):
+    return f"{self.token} - {self.studio_class_id}"
+
+  class Meta:
+    indexes = [
+      models.Index(fields=['token', 'start_time'], name='class_search_token_idx'),
+    ]
+    constraints = [
+      models.UniqueConstraint(fields=['studio_class', 'token'], name='unique_class_search_token'),
+    ]
 
 
 class Studio(models.Model):
@@ -116,12 +267,31 @@ class Studio(models.Model):
   # geolocation = models.OneToOneField(Point, on_delete=models.CASCADE, related_name='geolocation', default=None, null=True, blank=True)
   postal_code = models.CharField(max_length=200)
   phone_number = models.CharField(max_length=200)
+  # also touched when the studio's point, images, amenities or classes change
+  last_modified = models.DateTimeField(auto_now=True)
   # images = models.ManyToManyField(Image, related_name='images', blank=True)
   # amenities = models.ManyToManyField(Amenity, related_name='amenities', blank=True)
 
   def __str__(self):
     return self.name
 
+  def get_studios_nearby_coords(latitude, longitude, max_distance=None, limit=None):
+    """
+    Return studios sorted by the distance of their point to specified coordinates
+    in a single query, ties are broken by studio id and studios without a point are left out,
+    when limit is given only the first limit studios are guaranteed to be in order
+    """
+    qs = Studio.objects.filter(point__isnull=False) \
+    .annotate(proximity=Point.proximity_expression(latitude, longitude, 'point__')) \
+    .order_by('-proximity', 'id')
+    if max_distance is not None:
+        # cheap indexed box first, the exact distance only for the rows inside it
+        qs = qs.filter(Point.in_bounding_box(latitude, longitude, max_distance, 'point__')) \
+        .filter(proximity__gt=geo.proximity(max_distance))
+    if limit is not None:
+        qs = Point.narrow_to_nearest(qs, latitude, longitude, limit, 'point__')
+    return qs
+
 class SubscriptionPlan(models.Model):
   price = models.FloatField()
   duration = models.PositiveIntegerField()
@@ -129,6 +299,13 @@ class SubscriptionPlan(models.Model):
   def __str__(self):
     return f"{self.price}-{self.duration}days"
 
+class SubscriptionManager(models.Manager):
+  def current_for(self, user):
+    """
+    Return the user's active subscription or None, there is at most one
+    """
+    return self.filter(user=user, status='active').first()
+
 class Subscription(models.Model):
   start_date = models.DateField()
   next_date = models.DateField()
@@ -137,9 +314,21 @@ class Subscription(models.Model):
   duration = models.PositiveIntegerField()
   status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='active')
 
+  objects = SubscriptionManager()
+
   def __str__(self):
     return f"{self.user.username} - subscription - {self.id}"
 
+  class Meta:
+    indexes = [
+      # billing walks the due subscriptions in (next_date, id) order
+      models.Index(fields=['status', 'next_date', 'id'], name='subscription_due_idx'),
+    ]
+    constraints = [
+      # also the index behind current_for()
+      models.UniqueConstraint(fields=['user'], condition=Q(status='active'), name='unique_active_subscription'),
+    ]
+
 class Card(models.Model):
   user = models.OneToOneField(User, on_delete=models.DO_NOTHING, related_name='card')
   last_name = models.CharField(max_length=200)
@@ -158,13 +347,145 @@ class Payment(models.Model):
   amount = models.FloatField()
   card = models.ForeignKey(Card, on_delete=models.DO_NOTHING, related_name='payments')
   user = models.ForeignKey(User, on_delete=models.DO_NOTHING, related_name='payments')
+  # the subscription period paid for, a period is never charged twice
+  subscription = models.ForeignKey(Subscription, on_delete=models.DO_NOTHING, related_name='payments', null=True, blank=True)
+  period_start = models.DateField(null=True, blank=True)
+  billing_run = models.ForeignKey('BillingRun', on_delete=models.DO_NOTHING, related_name='payments', null=True, blank=True)
 
   def __str__(self):
     return f"{self.user.username} - payment ({self.date})"
 
+  class Meta:
+    # a user's history is read newest first from one index
+    indexes = [
+      models.Index(fields=['user', 'date', 'id'], name='payment_user_date_idx'),
+    ]
+    constraints = [
+      models.UniqueConstraint(fields=['subscription', 'period_start'], name='unique_subscription_period_payment'),
+    ]
+
+class PaymentMonthlySummary(models.Model):
+  """
+  Number and total amount of a user's payments in a month of the local time zone,
+  kept up to date as payments are written so the summary never scans the history
+  """
+  user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='payment_summaries')
+  # first day of the month
+  month = models.DateField()
+  count = models.PositiveIntegerField(default=0)
+  total = models.FloatField(default=0)
+
+  def __str__(self):
+    return f"{self.user_id} - {self.month:%Y-%m}"
+
+  class Meta:
+    verbose_name_plural = 'payment monthly summaries'
+    constraints = [
+      models.UniqueConstraint(fields=['user', 'month'], name='unique_payment_monthly_summary'),
+    ]
+
+class BillingRun(models.Model):
+  """
+  Billing of one day, split in partitions of subscriptions by user id that are billed in parallel
+  """
+  run_date = models.DateField(unique=True)
+  partitions = models.PositiveIntegerField(default=1)
+  # totals of the partitions, set when every partition has finished
+  billed = models.PositiveIntegerField(default=0)
+  cancelled = models.PositiveIntegerField(default=0)
+  started_at = models.DateTimeField(auto_now_add=True)
+  finished_at = models.DateTimeField(null=True, blank=True)
+
+  def __str__(self):
+    return f"billing run {self.run_date}"
+
+class BillingPartition(models.Model):
+  """
+  Subscriptions of a billing run whose user id modulo the run's partitions is number.
+  A worker owns the partition while its lease is valid, chunks commit their position
+  so a crashed worker's partition resumes after it
+  """
+  run = models.ForeignKey(BillingRun, on_delete=models.CASCADE, related_name='partition_set')
+  number = models.PositiveIntegerField()
+  # (next_date, id) of the last subscription billed
+  last_next_date = models.DateField(null=True, blank=True)
+  last_subscription_id = models.BigIntegerField(default=0)
+  billed = models.PositiveIntegerField(default=0)
+  cancelled = models.PositiveIntegerField(default=0)
+  leased_by = models.CharField(max_length=64, blank=True)
+  lease_expires = models.DateTimeField(null=True, blank=True)
+  finished_at = models.DateTimeField(null=True, blank=True)
+
+  def __str__(self):
+    return f"{self.run} - partition {self.number + 1}/{self.run.partitions}"
+
+  class Meta:
+    constraints = [
+      models.UniqueConstraint(fields=['run', 'number'], name='unique_billing_partition'),
+    ]
+
 class ClassBooking(models.Model):
   studio_class = models.ForeignKey(StudioClass, on_delete=models.DO_NOTHING, related_name='bookings')
   user = models.ForeignKey(User, on_delete=models.DO_NOTHING, related_name='bookings')
+  last_modified = models.DateTimeField(auto_now=True)
+  # copy of studio_class.start_time so a user's bookings are read in order from one index
+  start_time = models.DateTimeField(editable=False)
+
+  def __str__(self):
+    return f"{self.studio_class.name} - {self.user.username} ({self.id})"
+
+  def save(self, *args, **kwargs):
+    if self.start_time is None:
+      self.start_time = self.studio_class.start_time
+    super().save(*args, **kwargs)
+
+  class Meta:
+    indexes = [
+      models.Index(fields=['user', 'start_time', 'id'], name='booking_user_start_idx'),
+    ]
+    constraints = [
+      models.UniqueConstraint(fields=['studio_class', 'user'], name='unique_class_booking'),
+    ]
+
+class WaitlistEntry(models.Model):
+  studio_class = models.ForeignKey(StudioClass, on_delete=models.CASCADE, related_name='waitlist')
+  user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='waitlist')
+  created_at = models.DateTimeField(auto_now_add=True)
 
   def __str__(self):
-    return f"{self.studio_class.name} - {self.user.username} ({self.id})"
\ No newline at end of file
+    return f"{self.studio_class_id} - {self.user_id} ({self.id})"
+
+  @property
+  def position(self):
+    return WaitlistEntry.objects.filter(studio_class_id=self.studio_class_id, id__lte=self.id).count()
+
+  class Meta:
+    verbose_name_plural = 'waitlist entries'
+    # entries are served first come first served, in id order
+    indexes = [
+      models.Index(fields=['studio_class', 'id'], name='waitlist_class_id_idx'),
+    ]
+    constraints = [
+      models.UniqueConstraint(fields=['studio_class', 'user'], name='unique_waitlist_entry'),
+    ]
+
+class IdempotencyKey(models.Model):
+  """
+  Response of a create request sent with an Idempotency-Key header, replayed when the client retries.
+  The row is written before the request runs, status_code stays null until it has completed
+  """
+  user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='idempotency_keys')
+  key = models.CharField(max_length=255)
+  # digest of the method, path and body the key was first used with
+  fingerprint = models.CharField(max_length=64)
+  status_code = models.PositiveSmallIntegerField(null=True, blank=True)
+  response_body = models.JSONField(null=True, blank=True, encoder=DjangoJSONEncoder)
+  created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+  def __str__(self):
+    return f"{self.user_id} - {self.key}"
+
+  class Meta:
+    constraints = [
+      models.UniqueConstraint(fields=['user', 'key'], name='unique_idempotency_key'),
+    ]
@@ -0,0 +1,223 @@
+import heapq
+import math
+import threading
+import time
+
+from django.conf import settings
+
+from studios import geo
+
+# a leaf of the tree holds at most this many points
+LEAF_SIZE = 16
+
+
+def chord_squared(radius_km):
+  """
+  Return the squared straight line distance on the unit sphere matching a great circle distance
+  """
+  angle = min(radius_km / geo.EARTH_RADIUS_KM, math.pi)
+  return (2 * math.sin(angle / 2)) ** 2
+
+
+def _distance_squared(a, b):
+  return (a[0] - b[0]) ** 2 + (a[1] - b[1]) ** 2 + (a[2] - b[2]) ** 2
+
+
+def _build(items, depth=0):
+  # items are (vector, studio_id) pairs, inner nodes are (axis, split, left, right)
+  if len(items) <= LEAF_SIZE:
+    return items
+  axis = depth % 3
+  items.sort(key=lambda item: item[0][axis])
+  middle = len(items) // 2
+  split = items[middle][0][axis]
+  return (axis, split, _build(items[:middle], depth + 1), _build(items[middle:], depth + 1))
+
+
+class NearestStudioIndex:
+  """
+  Process-local KD-tree of studio locations on the unit sphere, straight line distance
+  between unit vectors grows with great circle distance so both give the same order.
+  Point changes are applied incrementally, the tree is rebuilt once enough of them pile up
+  and the whole index is reloaded from the database every max_age seconds
+  """
+  def __init__(self, max_age=None):
+    self.max_age = max_age
+    self._lock = threading.RLock()
+    self._loaded_at = None
+    self._vectors = {}
+    self._tree = None
+    # studio ids added or moved since the tree was built, and ids whose tree entry is stale
+    self._pending = {}
+    self._stale = set()
+
+  def __len__(self):
+    self._ensure_loaded()
+    return len(self._vectors)
+
+  @property
+  def loaded(self):
+    return self._loaded_at is not None
+
+  def load(self):
+    from studios.models import Point
+    vectors = {studio_id: (x, y, z) for studio_id, x, y, z in Point.objects.values_list('studio_id', 'x', 'y', 'z')}
+    with self._lock:
+      self._vectors = vectors
+      self._rebuild()
+      self._loaded_at = time.monotonic()
+
+  def clear(self):
+    with self._lock:
+      self._loaded_at = None
+      self._vectors = {}
+      self._tree = None
+      self._pending = {}
+      self._stale = set()
+
+  def update(self, studio_id, vector):
+    with self._lock:
+      if not self.loaded:
+        return
+      self._vectors[studio_id] = self._pending[studio_id] = vector
+      self._stale.add(studio_id)
+      self._maybe_rebuild()
+
+  def remove(self, studio_id):
+    with self._lock:
+      if not self.loaded:
+        return
+      self._vectors.pop(studio_id, None)
+      self._pending.pop(studio_id, None)
+      self._stale.add(studio_id)
+      self._maybe_rebuild()
+
+  def nearest(self, latitude, longitude, k=None, radius_km=None):
+    """
+    Return the ids of the k closest studios less than radius_km away from of the coordinates, closest first,
+    ties are broken by studio id
+    """
+    self._ensure_loaded()
+    if k is not None and k <= 0:
+      return []
+    target = geo.unit_vector(latitude, longitude)
+    bound = chord_squared(radius_km) if radius_km is not None else math.inf
+    with self._lock:
+      if k is None or k >= len(self._vectors):
+        found = self._within(target, bound)
+      else:
+        found = self._k_nearest(target, k, bound)
+    return [studio_id for _, studio_id in sorted(found)]
+
+  def count(self, latitude, longitude, radius_km=None):
+    """
+    Return the number of studios less than radius_km away from the coordinates
+    """
+    if radius_km is None:
+      return len(self)
+    return len(self.nearest(latitude, longitude, radius_km=radius_km))
+
+  def _ensure_loaded(self):
+    if not self.loaded or (self.max_age is not None and time.monotonic() - self._loaded_at > self.max_age):
+      self.load()
+
+  def _maybe_rebuild(self):
+    if len(self._pending) + len(self._stale) > max(LEAF_SIZE, math.isqrt(len(self._vectors))):
+      self._rebuild()
+
+  def _rebuild(self):
+    self._tree = _build(list((vector, studio_id) for studio_id, vector in self._vectors.items()))
+    self._pending = {}
+    self._stale = set()
+
+  def _candidates(self):
+    # pending entries are not in the tree yet and are scanned linearly
+    return ((vector, studio_id) for studio_id, vector in self._pending.items())
+
+  def _within(self, target, bound):
+    found = []
+    stack = [self._tree]
+    while stack:
+      node = stack.pop()
+      if isinstance(node, list):
+        for vector, studio_id in node:
+          if studio_id not in self._stale:
+            distance = _distance_squared(target, vector)
+            if distance < bound:
+              found.append((distance, studio_id))
+        continue
+      axis, split, left, right = node
+      offset = target[axis] - split
+      if offset < 0 or offset ** 2 <= bound:
+        stack.append(left)
+      if offset >= 0 or offset ** 2 <= bound:
+        stack.append(right)
+    for vector, studio_id in self._candidates():
+      distance = _distance_squared(target, vector)
+      if distance < bound:
+        found.append((distance, studio_id))
+    return found
+
+  def _k_nearest(self, target, k, bound):
+    # max-heap on (distance, studio_id) holding the best k seen so far
+    heap = []
+
+    def consider(vector, studio_id):
+      distance = _distance_squared(target, vector)
+      if distance >= bound:
+        return
+      if len(heap) < k:
+        heapq.heappush(heap, (-distance, -studio_id))
+      elif (distance, studio_id) < (-heap[0][0], -heap[0][1]):
+        heapq.heapreplace(heap, (-distance, -studio_id))
+
+    for vector, studio_id in self._candidates():
+      consider(vector, studio_id)
+
+    def search(node):
+      if isinstance(node, list):
+        for vector, studio_id in node:
+          if studio_id not in self._stale:
+            consider(vector, studio_id)
+        return
+      axis, split, left, right = node
+      offset = target[axis] - split
+      near, far = (left, right) if offset < 0 else (right, left)
+      search(near)
+      worst = -heap[0][0] if len(heap) == k else bound
+      if offset ** 2 <= worst:
+        search(far)
+
+    search(self._tree)
+    return [(-distance, -studio_id) for distance, studio_id in heap]
+
+
+class NearestStudios:
+  """
+  Sequence of studios sorted by distance from the index, studio rows are only
+  loaded for the slice being read
+  """
+  def __init__(self, index, queryset, latitude, longitude, k=None, radius_km=None):
+    self.index = index
+    self.queryset = queryset
+    self.latitude = latitude
+    self.longitude = longitude
+    self.k = k
+    self.radius_km = radius_km
+
+  def __len__(self):
+    total = self.index.count(self.latitude, self.longitude, self.radius_km)
+    return total if self.k is None else min(total, self.k)
+
+  def __getitem__(self, item):
+    if not isinstance(item, slice):
+      return self[item:item + 1][0]
+    stop = item.stop
+    if self.k is not None:
+      stop = self.k if stop is None else min(stop, self.k)
+    studio_ids = self.index.nearest(self.latitude, self.longitude, stop, self.radius_km)[item.start:stop]
+    studios = self.queryset.in_bulk(studio_ids)
+    return [studios[studio_id] for studio_id in studio_ids if studio_id in studios]
+
+
+nearest_studios = NearestStudioIndex(max_age=getattr(settings, 'STUDIOS_NEAREST_INDEX_MAX_AGE', None))
@@ -0,0 +1,37 @@
+from rest_framework.pagination import CursorPagination, LimitOffsetPagination
+
+
+class NearbyPagination(LimitOffsetPagination):
+  """
+  Limit/offset pagination for views whose queryset only holds the rows up to
+  the requested page, the total count comes from the view's get_count()
+  """
+  def paginate_queryset(self, queryset, request, view=None):
+    self.view = view
+    return super().paginate_queryset(queryset, request, view)
+
+  def get_count(self, queryset):
+    return self.view.get_count(queryset)
+
+
+class BookingCursorPagination(CursorPagination):
+  """
+  Keyset pagination over a user's bookings, each page continues from the position of the
+  previous one in the (user, start_time, id) index instead of skipping over an offset
+  """
+  ordering = ('start_time', 'id')
+  page_size_query_param = 'page_size'
+  max_page_size = 100
+
+
+class PastBookingCursorPagination(BookingCursorPagination):
+  ordering = ('-start_time', '-id')
+
+
+class PaymentCursorPagination(CursorPagination):
+  """
+  Keyset pagination over a user's payments newest first, read from the (user, date, id) index
+  """
+  ordering = ('-date', '-id')
+  page_size_query_param = 'page_size'
+  max_page_size = 100
@@ -0,0 +1,132 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q, Value
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from studios import availability
+from studios.models import ClassSeries, Keyword, StudioClass
+from studios.search import index_classes
+from studios.signals import touch_studios
+
+
+def get_horizon():
+  """
+  Return the time up to which occurrences of recurring classes are written ahead
+  """
+  return timezone.now() + timedelta(days=getattr(settings, 'STUDIOS_SCHEDULE_HORIZON_DAYS', 28))
+
+
+def occurrence_times(series, after, until):
+  """
+  Yield (start_time, end_time) of the occurrences of series starting after `after` and
+  no later than until, repeats keep the same local wall clock time across DST changes
+  """
+  tz = timezone.get_current_timezone()
+  first_start = timezone.localtime(series.start_time, tz).replace(tzinfo=None)
+  duration = series.end_time - series.start_time
+  interval = timedelta(days=series.interval_days)
+  until = min(until, series.recurrence_end)
+  n = 0
+  if after is not None:
+    # skip straight past the occurrences already written instead of walking through them
+    n = max((timezone.localtime(after, tz).replace(tzinfo=None) - first_start) // interval, 0)
+  while True:
+    start = timezone.make_aware(first_start + n * interval, tz)
+    if start > until:
+      return
+    if after is None or start > after:
+      yield start, start + duration
+    n += 1
+
+
+def materialize(series_list, until=None):
+  """
+  Write the missing occurrences of the given series up to until with one bulk insert,
+  each series resumes after its materialized_until so history is never rescanned
+  """
+  until = until or get_horizon()
+  occurrences = []
+  extended = []
+  for series in series_list:
+    last = series.materialized_until
+    for start, end in occurrence_times(series, series.materialized_until, until):
+      occurrences.append(StudioClass(
+        name=series.name, description=series.description, coach=series.coach, capacity=series.capacity,
+        start_time=start, end_time=end, recurrence_end=series.recurrence_end,
+        studio_id=series.studio_id, series=series,
+      ))
+      last = start
+    if last != series.materialized_until:
+      series.materialized_until = last
+      extended.append(series)
+  with transaction.atomic():
+    # the (series, start_time) constraint makes a concurrent or repeated run harmless
+    StudioClass.objects.bulk_create(occurrences, batch_size=1000, ignore_conflicts=True)
+    ClassSeries.objects.bulk_update(extended, ['materialized_until'], batch_size=1000)
+    if extended:
+      # bulk_create skips post_save, index the new occurrences for search here
+      index_classes(StudioClass.objects.filter(series__in=extended, search_tokens__isnull=True).prefetch_related('keywords'))
+      touch_studios({series.studio_id for series in extended})
+  return len(occurrences)
+
+
+def extend_schedules(until=None):
+  """
+  Write occurrences up to until for every active series that is not written that far yet
+  """
+  until = until or get_horizon()
+  pending = ClassSeries.objects.filter(status='active', start_time__lte=until) \
+    .filter(Q(materialized_until__isnull=True) | Q(materialized_until__lt=until) & Q(materialized_until__lt=F('recurrence_end')))
+  return materialize(pending.iterator(chunk_size=1000), until)
+
+
+def update_series(series):
+  """
+  Apply an edited series to its occurrences that have not started yet. Occurrences still on
+  the new schedule take its details, unbooked ones that fell off it are deleted and booked ones
+  keep their time, then missing occurrences are written. Capacities never drop below bookings
+  """
+  if series.status != 'active':
+    cancel_occurrences(series)
+    return
+  now = timezone.now()
+  until = max(series.materialized_until or now, get_horizon())
+  scheduled = [start for start, end in occurrence_times(series, now, until)]
+  upcoming = StudioClass.objects.filter(series=series, start_time__gte=now)
+  with transaction.atomic():
+    dropped = upcoming.exclude(start_time__in=scheduled).filter(booked_count=0)
+    Keyword.objects.filter(studio_class__in=dropped).delete()
+    dropped.delete()
+    upcoming.update(
+      name=series.name, description=series.description, coach=series.coach, recurrence_end=series.recurrence_end,
+      capacity=Greatest(F('booked_count'), Value(series.capacity)), last_modified=now,
+    )
+    upcoming.filter(start_time__in=scheduled).update(end_time=F('start_time') + (series.end_time - series.start_time))
+    # the kept occurrences are indexed under their new name and coach, materialize() indexes the new ones
+    index_classes(upcoming.prefetch_related('keywords'))
+    # written again from now on, occurrences that already exist are skipped
+    series.materialized_until = now
+    ClassSeries.objects.filter(pk=series.pk).update(materialized_until=now)
+    materialize([series], until)
+    touch_studios([series.studio_id])
+    availability.publish(series.studio_id)
+
+
+def cancel_occurrences(series):
+  with transaction.atomic():
+    StudioClass.objects.filter(series=series, start_time__gte=timezone.now()) \
+      .update(status='cancelled', last_modified=timezone.now())
+    touch_studios([series.studio_id])
+
+
+def cancel_series(series):
+  """
+  Cancel a series and all of its occurrences that have not started yet with one update
+  """
+  with transaction.atomic():
+    series.status = 'cancelled'
+    series.save(update_fields=['status'])
+    cancel_occurrences(series)
@@ -0,0 +1,67 @@
+import re
+
+from django.db import transaction
+
+from studios.models import ClassSearchToken, StudioClass
+
+TOKEN_RE = re.compile(r'\w+')
+TOKEN_MAX_LENGTH = 50
+
+
+def tokenize(*texts):
+  """
+  Return the set of lowercase word tokens found in the given texts
+  """
+  tokens = set()
+  for text in texts:
+    if text:
+      tokens.update(token[:TOKEN_MAX_LENGTH] for token in TOKEN_RE.findall(text.lower()))
+  return tokens
+
+
+def index_classes(classes):
+  """
+  Replace the search tokens of the given classes with tokens of their name, coach and keywords,
+  prefetch keywords on a queryset to avoid a query per class
+  """
+  classes = list(classes)
+  if not classes:
+    return 0
+  rows = []
+  for studio_class in classes:
+    keywords = [keyword.keyword for keyword in studio_class.keywords.all()]
+    for token in tokenize(studio_class.name, studio_class.coach, *keywords):
+      rows.append(ClassSearchToken(token=token, studio_class=studio_class, start_time=studio_class.start_time))
+  with transaction.atomic():
+    ClassSearchToken.objects.filter(studio_class__in=[studio_class.pk for studio_class in classes]).delete()
+    ClassSearchToken.objects.bulk_create(rows, batch_size=1000)
+  return len(rows)
+
+
+def rebuild_index(chunk_size=1000):
+  """
+  Rebuild the tokens of every class in chunks of chunk_size classes
+  """
+  total = 0
+  last_pk = 0
+  while True:
+    chunk = list(StudioClass.objects.filter(pk__gt=last_pk).order_by('pk').prefetch_related('keywords')[:chunk_size])
+    if not chunk:
+      return total
+    total += index_classes(chunk)
+    last_pk = chunk[-1].pk
+
+
+def search_classes(queryset, text, start_after=None, start_before=None):
+  """
+  Narrow queryset to classes matching every token of text through the token index,
+  each token is a range scan of the (token, start_time) index over the time window
+  """
+  for token in tokenize(text):
+    matches = ClassSearchToken.objects.filter(token=token)
+    if start_after is not None:
+      matches = matches.filter(start_time__gte=start_after)
+    if start_before is not None:
+      matches = matches.filter(start_time__lte=start_before)
+    queryset = queryset.filter(pk__in=matches.values('studio_class'))
+  return queryset
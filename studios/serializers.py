@@ -3,9 +3,13 @@ from rest_framework.fields import CurrentUserDefault
 from django.utils import timezone
 from rest_framework import status
 from rest_framework.response import Response
-from rest_framework.exceptions import PermissionDenied
-import datetime
-from .models import Studio, Image, Point, StudioClass, Amenity, SubscriptionPlan, Subscription, Payment, Card, ClassBooking
+from rest_framework.exceptions import NotFound, PermissionDenied
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, OuterRef, Prefetch, Subquery
+from django.db.models.functions import Coalesce
+import math
+from . import availability, entitlements
+from .models import Studio, Image, Point, StudioClass, Amenity, SubscriptionPlan, Subscription, Payment, PaymentMonthlySummary, Card, ClassBooking, WaitlistEntry
 
 class ImageSerializer(serializers.ModelSerializer):
   image = serializers.CharField(source='absolute_url', read_only=True)
@@ -23,34 +27,144 @@ class AmenitiesSerializer(serializers.ModelSerializer):
     model = Amenity
     fields = ['type', 'quantity']
 
-class StudiosSerializer(serializers.ModelSerializer):
-  images = ImageSerializer(many=True)
-  classes = ClassesSerializer(many=True)
-  amenities = AmenitiesSerializer(many=True)
-  class Meta:
-    model = Studio
-    fields = ['id', 'name', 'images', 'postal_code', 'phone_number', 'address', 'amenities', 'classes']
-
 class PointSerializer(serializers.ModelSerializer):
   # latitude = serializers.CharField(source='__str__', read_only=True)
   class Meta:
     model = Point
     fields = ['latitude', 'longitude']
 
-class StudioSerializer(serializers.ModelSerializer):
+class NearbySearchSerializer(serializers.Serializer):
+  """
+  Query params of the nearby studios search, k studios at most and radius_km kilometers away at most
+  """
+  latitude = serializers.FloatField(min_value=-90, max_value=90)
+  longitude = serializers.FloatField(min_value=-180, max_value=180)
+  k = serializers.IntegerField(min_value=1, required=False)
+  radius_km = serializers.FloatField(required=False)
+
+  def validate(self, attrs):
+    # the range validators let nan through
+    for name in ('latitude', 'longitude', 'radius_km'):
+      if name in attrs and not math.isfinite(attrs[name]):
+        raise serializers.ValidationError({name: ['A finite number is required.']})
+    if attrs.get('radius_km', 1) <= 0:
+      raise serializers.ValidationError({'radius_km': ['Ensure this value is greater than 0.']})
+    return attrs
+
+def requested_fields(request, name):
+  """
+  Return the set of names in a comma separated query param, None when it is not given
+  """
+  value = request.query_params.get(name) if request is not None else None
+  if not value:
+    return None
+  return {field.strip() for field in value.split(',') if field.strip()}
+
+class DynamicFieldsMixin:
+  """
+  Serializer mixin for sparse fieldsets and opt-in expansion:
+  ?fields= keeps only the listed fields, ?expand= renders the relations listed in
+  Meta.expandable_fields as nested objects, dotted names expand relations of nested serializers
+  """
+  def __init__(self, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    request = self.context.get('request')
+    self.apply_requested(requested_fields(request, 'fields'), requested_fields(request, 'expand') or set())
+
+  def apply_requested(self, fields, expand):
+    expandable = getattr(self.Meta, 'expandable_fields', {})
+    nested_expand = {}
+    for name in expand:
+      name, _, rest = name.partition('.')
+      if rest:
+        nested_expand.setdefault(name, set()).add(rest)
+      elif name in expandable:
+        serializer_class, kwargs = expandable[name]
+        self.fields[name] = serializer_class(**kwargs)
+    if fields is not None:
+      for name in list(self.fields):
+        if name not in fields and name not in expand:
+          self.fields.pop(name)
+    for name, rest in nested_expand.items():
+      field = self.fields.get(name)
+      field = getattr(field, 'child', field)
+      if isinstance(field, DynamicFieldsMixin):
+        field.apply_requested(None, rest)
+
+# number of upcoming classes listed with each studio
+UPCOMING_CLASSES_LIMIT = 5
+
+def upcoming_classes():
+  return StudioClass.objects.filter(status='active', start_time__gte=timezone.now())
+
+class StudiosSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
   images = ImageSerializer(many=True)
-  classes = ClassesSerializer(many=True)
+  classes = ClassesSerializer(source='upcoming_classes', many=True)
+  upcoming_count = serializers.IntegerField(read_only=True)
+  next_start_time = serializers.DateTimeField(read_only=True)
   amenities = AmenitiesSerializer(many=True)
+  class Meta:
+    model = Studio
+    fields = ['id', 'name', 'images', 'postal_code', 'phone_number', 'address', 'amenities', 'classes', 'upcoming_count', 'next_start_time']
+    expandable_fields = {'point': (PointSerializer, {})}
+
+  @staticmethod
+  def setup_eager_loading(queryset, fields):
+    # one query per requested nested relation for the whole page instead of one per studio,
+    # classes are limited to the next few upcoming ones and summarized by annotations
+    studio_upcoming = upcoming_classes().filter(studio=OuterRef('pk')).order_by()
+    if 'upcoming_count' in fields:
+      queryset = queryset.annotate(
+        upcoming_count=Coalesce(Subquery(studio_upcoming.values('studio').annotate(count=Count('pk')).values('count')), 0)
+      )
+    if 'next_start_time' in fields:
+      queryset = queryset.annotate(next_start_time=Subquery(studio_upcoming.order_by('start_time').values('start_time')[:1]))
+    if 'point' in fields:
+      queryset = queryset.select_related('point')
+    if 'images' in fields:
+      queryset = queryset.prefetch_related(Prefetch('images', queryset=Image.objects.all()))
+    if 'amenities' in fields:
+      queryset = queryset.prefetch_related(Prefetch('amenities', queryset=Amenity.objects.all()))
+    if 'classes' in fields:
+      next_classes = upcoming_classes().filter(
+        pk__in=Subquery(upcoming_classes().filter(studio=OuterRef('studio')).order_by('start_time', 'pk').values('pk')[:UPCOMING_CLASSES_LIMIT])
+      ).order_by('start_time', 'pk')
+      queryset = queryset.prefetch_related(Prefetch('classes', queryset=next_classes, to_attr='upcoming_classes'))
+    return queryset
+
+class StudioSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
+  images = ImageSerializer(many=True)
+  classes = ClassesSerializer(source='upcoming_classes', many=True)
+  upcoming_count = serializers.IntegerField(read_only=True)
+  next_start_time = serializers.DateTimeField(read_only=True)
+  amenities = AmenitiesSerializer(many=True)
+  point = PointSerializer()
+  class Meta:
+    model = Studio
+    fields = ['id', 'name', 'images', 'amenities', 'classes', 'upcoming_count', 'next_start_time', 'address', 'point', 'postal_code', 'phone_number']
+
+  @staticmethod
+  def setup_eager_loading(queryset, fields):
+    return StudiosSerializer.setup_eager_loading(queryset, fields)
+
+class StudioSummarySerializer(serializers.ModelSerializer):
   point = PointSerializer()
   class Meta:
     model = Studio
-    fields = ['id', 'name', 'images', 'amenities', 'classes', 'address', 'point', 'postal_code', 'phone_number']
+    fields = ['id', 'name', 'address', 'point']
 
-class StudioClassesSerializer(serializers.ModelSerializer):
+class StudioClassesSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
   #studio = StudioSerializer()
   class Meta:
     model = StudioClass
     fields = ['id', 'name', 'description', 'coach', 'capacity', 'start_time', 'end_time', 'studio']
+    expandable_fields = {'studio': (StudioSummarySerializer, {})}
+
+  @staticmethod
+  def setup_eager_loading(queryset, fields):
+    if isinstance(fields.get('studio'), serializers.Serializer):
+      queryset = queryset.select_related('studio__point')
+    return queryset
 
 class CardSerializer(serializers.ModelSerializer):
   class Meta:
@@ -63,6 +177,15 @@ class PaymentsSerializer(serializers.ModelSerializer):
     model = Payment
     fields = ['date', 'amount', 'card', 'user']
 
+  @staticmethod
+  def setup_eager_loading(queryset, fields):
+    return queryset.select_related('card')
+
+class PaymentMonthlySummarySerializer(serializers.ModelSerializer):
+  class Meta:
+    model = PaymentMonthlySummary
+    fields = ['month', 'count', 'total']
+
 class SubscriptionPlansSerializer(serializers.ModelSerializer):
 
   class Meta:
@@ -79,34 +202,42 @@ class SubscriptionSubscribeSerializer(serializers.ModelSerializer):
     fields = ['start_date', 'next_date', 'user', 'price', 'duration', 'status']
 
   def create(self, validated_data):
-    
     current_user = validated_data['user']
-    has_subscription = Subscription.objects.filter(user=current_user)
-    time_left = False
-    status = False
-    time_now = timezone.now().date()
-    datetimetest = datetime.datetime.now()
-    print(datetimetest)
-    if has_subscription:
-      for subscription in has_subscription:
-        if subscription.next_date > time_now:
-          time_left = True
-        if subscription.status == 'active':
-          status = True
-    if status == True:
+    if Subscription.objects.current_for(current_user) is not None:
       raise PermissionDenied(detail='Already have a subscription', code=405)
+    # a cancelled subscription that is still paid for doesn't charge again
+    time_left = Subscription.objects.filter(user=current_user, next_date__gt=timezone.now().date()).exists()
     if hasattr(current_user, 'card'):
-      if time_left == False:
-        payment = Payment(date=timezone.now(), amount=float(validated_data['price']), card=current_user.card, user=current_user)
-        payment.save()
-      return Subscription.objects.create(**validated_data)
+      try:
+        with transaction.atomic():
+          subscription = Subscription.objects.create(**validated_data)
+          if time_left == False:
+            payment = Payment(date=timezone.now(), amount=float(validated_data['price']), card=current_user.card, user=current_user,
+                              subscription=subscription, period_start=subscription.start_date)
+            payment.save()
+      except IntegrityError:
+        # a concurrent request subscribed first
+        raise PermissionDenied(detail='Already have a subscription', code=405)
+      return subscription
     else:
       raise PermissionDenied(detail='Please add a card to your account', code=402)
 
-class ClassSerializer(serializers.ModelSerializer):
+class ClassSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
   class Meta:
     model = StudioClass
     fields = ['id', 'name', 'description', 'coach', 'capacity', 'start_time', 'end_time', 'studio']
+    expandable_fields = {'studio': (StudioSummarySerializer, {})}
+
+def check_booking_entitlement(user):
+  """
+  Raise PermissionDenied unless the user has an active subscription to book classes with,
+  no query once the user's entitlement is cached
+  """
+  entitlement = entitlements.get_entitlement(user.pk)
+  if entitlement == entitlements.NONE:
+    raise PermissionDenied(detail='Need to purchase a subscription first', code=405)
+  if entitlement != entitlements.ACTIVE:
+    raise PermissionDenied(detail='Need an active subscription', code=405)
 
 class ClassBookingSerializer(serializers.ModelSerializer):
   user = serializers.HiddenField(
@@ -121,19 +252,117 @@ class ClassBookingSerializer(serializers.ModelSerializer):
     current_user = validated_data['user']
     class_id = self.context['request'].data['class_id']
     studio_class = StudioClass.objects.filter(id=class_id)[0]
-    booking_exist = ClassBooking.objects.filter(studio_class=studio_class, user=current_user)
-    if booking_exist:
+    if ClassBooking.objects.filter(studio_class=studio_class, user=current_user).exists():
+      raise PermissionDenied(detail='Already booked', code=405)
+    check_booking_entitlement(current_user)
+    with transaction.atomic():
+      # the seat is given back by the rollback if the booking can't be written
+      if not studio_class.reserve_seat():
+        raise PermissionDenied(detail='Class is full.', code=405)
+      try:
+        with transaction.atomic():
+          return ClassBooking.objects.create(studio_class=studio_class, user=current_user)
+      except IntegrityError:
+        # a concurrent request booked the same class for this user
+        raise PermissionDenied(detail='Already booked', code=405)
+
+class WaitlistEntrySerializer(serializers.ModelSerializer):
+  user = serializers.HiddenField(
+    default=serializers.CurrentUserDefault()
+  )
+
+  class Meta:
+    model = WaitlistEntry
+    fields = ['id', 'user', 'studio_class', 'position', 'created_at']
+    read_only_fields = ['studio_class', 'position']
+
+  def create(self, validated_data):
+    current_user = validated_data['user']
+    kwargs = self.context['view'].kwargs
+    studio_class = StudioClass.objects.filter(id=kwargs['class_id'], studio_id=kwargs['studio_id'], status='active').first()
+    if studio_class is None:
+      raise NotFound(detail='Class not found')
+    if ClassBooking.objects.filter(studio_class=studio_class, user=current_user).exists():
       raise PermissionDenied(detail='Already booked', code=405)
-    if len(ClassBooking.objects.filter(studio_class=studio_class)) >= studio_class.capacity:
-      raise PermissionDenied(detail='Class is full.', code=405)
-    if not hasattr(current_user, 'subscription'):
-      raise PermissionDenied(detail='Need to purchase a subscription first', code=405)
-    if current_user.subscription:
-      subscription = current_user.subscription.filter(status='active')[0]
-      if subscription:
-        return ClassBooking.objects.create(studio_class=studio_class, user=current_user)
+    check_booking_entitlement(current_user)
+    if studio_class.booked_count < studio_class.capacity:
+      raise PermissionDenied(detail='Class has free seats, enrol instead', code=405)
+    try:
+      with transaction.atomic():
+        return WaitlistEntry.objects.create(studio_class=studio_class, user=current_user)
+    except IntegrityError:
+      raise PermissionDenied(detail='Already on the waitlist', code=405)
+
+class SeatCountChanged(Exception):
+  pass
+
+class BulkClassBookingSerializer(serializers.Serializer):
+  """
+  Books several classes at once, either the given class_ids or every upcoming occurrence of a series.
+  Classes that can't be booked are reported with the reason instead of failing the whole request
+  """
+  user = serializers.HiddenField(
+    default=serializers.CurrentUserDefault()
+  )
+  class_ids = serializers.ListField(child=serializers.IntegerField(), required=False, max_length=500)
+  series_id = serializers.IntegerField(required=False)
+
+  def validate(self, attrs):
+    if ('class_ids' in attrs) == ('series_id' in attrs):
+      raise serializers.ValidationError('Provide either class_ids or series_id.')
+    return attrs
+
+  def create(self, validated_data):
+    current_user = validated_data['user']
+    check_booking_entitlement(current_user)
+    if 'series_id' in validated_data:
+      class_ids = list(StudioClass.objects.filter(series_id=validated_data['series_id'], status='active', start_time__gte=timezone.now())
+        .order_by('start_time').values_list('pk', flat=True))
     else:
-      raise PermissionDenied(detail='Need an active subscription', code=405)
+      class_ids = list(dict.fromkeys(validated_data['class_ids']))
+    results = dict.fromkeys(class_ids, 'unavailable')
+    with transaction.atomic():
+      booked = set(ClassBooking.objects.filter(user=current_user, studio_class__in=class_ids).values_list('studio_class_id', flat=True))
+      bookable = StudioClass.objects.filter(pk__in=class_ids, status='active', start_time__gte=timezone.now()).exclude(pk__in=booked)
+      bookable_ids = set(bookable.values_list('pk', flat=True))
+      reserved = self.reserve_seats(bookable)
+      reserved_classes = StudioClass.objects.filter(pk__in=reserved).values_list('pk', 'start_time', 'studio_id')
+      try:
+        with transaction.atomic():
+          ClassBooking.objects.bulk_create([
+            ClassBooking(studio_class_id=class_id, user=current_user, start_time=start_time)
+            for class_id, start_time, studio_id in reserved_classes
+          ])
+      except IntegrityError:
+        # a concurrent request booked one of the classes for this user
+        raise PermissionDenied(detail='Already booked', code=405)
+      # bulk_create skips the booking signals
+      for studio_id in {studio_id for class_id, start_time, studio_id in reserved_classes}:
+        availability.publish(studio_id)
+    for class_id in booked:
+      results[class_id] = 'already booked'
+    for class_id in bookable_ids:
+      results[class_id] = 'booked' if class_id in reserved else 'full'
+    return [{'class_id': class_id, 'status': result} for class_id, result in results.items()]
+
+  @staticmethod
+  def reserve_seats(bookable):
+    """
+    Take a seat in every class of bookable that is not full and return their ids,
+    the rows are locked in id order so concurrent bulk bookings can't deadlock
+    """
+    try:
+      with transaction.atomic():
+        open_ids = list(bookable.select_for_update().filter(booked_count__lt=F('capacity'))
+          .order_by('pk').values_list('pk', flat=True))
+        updated = StudioClass.objects.filter(pk__in=open_ids, booked_count__lt=F('capacity')) \
+          .update(booked_count=F('booked_count') + 1)
+        if updated != len(open_ids):
+          raise SeatCountChanged
+        return set(open_ids)
+    except SeatCountChanged:
+      # without row locks a class filled up in between, take the seats one by one
+      return {studio_class.pk for studio_class in bookable.order_by('pk') if studio_class.reserve_seat()}
 
 class ClassDroppingSerializer(serializers.ModelSerializer):
   user = serializers.HiddenField(
@@ -144,11 +373,20 @@ class ClassDroppingSerializer(serializers.ModelSerializer):
     model = ClassBooking
     fields = ['user']
 
-class ClassBookingUserSerializer(serializers.ModelSerializer):
+class ClassBookingUserSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
   studio_class = ClassSerializer()
   class Meta:
     model = ClassBooking
     fields = ['id', 'studio_class', 'user']
 
+  @staticmethod
+  def setup_eager_loading(queryset, fields):
+    studio_class = fields.get('studio_class')
+    if studio_class is not None:
+      queryset = queryset.select_related('studio_class')
+      if isinstance(studio_class.fields.get('studio'), serializers.Serializer):
+        queryset = queryset.select_related('studio_class__studio__point')
+    return queryset
+
 
 
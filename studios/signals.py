@@ -0,0 +1,135 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from studios import availability, entitlements, summaries
+from studios.cache import response_cache
+from studios.models import Amenity, ClassBooking, ClassSeries, Image, Keyword, Payment, Point, Studio, StudioClass, Subscription, SubscriptionPlan
+from studios.nearest import nearest_studios
+from studios.search import index_classes
+
+
+def touch_studios(studio_ids):
+  """
+  Mark studios as changed for ETags and cached responses, for writes that bypass model signals
+  """
+  # keeps Studio.last_modified usable as the validator of the studio's whole payload
+  Studio.objects.filter(pk__in=studio_ids).update(last_modified=timezone.now())
+  transaction.on_commit(lambda: [response_cache.bump(f'studio:{studio_id}') for studio_id in studio_ids])
+  # classes may have been added, moved or cancelled
+  for studio_id in studio_ids:
+    availability.publish(studio_id)
+
+
+@receiver(post_save, sender=Point)
+def point_saved(sender, instance, raw=False, **kwargs):
+  if raw:
+    return
+  transaction.on_commit(lambda: nearest_studios.update(instance.studio_id, instance.vector))
+
+
+@receiver(post_delete, sender=Point)
+def point_deleted(sender, instance, **kwargs):
+  transaction.on_commit(lambda: nearest_studios.remove(instance.studio_id))
+
+
+@receiver([post_save, post_delete], sender=Studio)
+def studio_changed(sender, instance, raw=False, **kwargs):
+  if raw:
+    return
+  transaction.on_commit(lambda: response_cache.bump(f'studio:{instance.pk}'))
+
+
+@receiver([post_save, post_delete], sender=Point)
+@receiver([post_save, post_delete], sender=Image)
+@receiver([post_save, post_delete], sender=Amenity)
+@receiver([post_save, post_delete], sender=StudioClass)
+def studio_data_changed(sender, instance, raw=False, **kwargs):
+  if raw:
+    return
+  touch_studios([instance.studio_id])
+
+
+@receiver(post_save, sender=StudioClass)
+def studio_class_saved(sender, instance, raw=False, **kwargs):
+  if raw:
+    return
+  index_classes([instance])
+  # bookings keep a copy of the start time for ordering
+  ClassBooking.objects.filter(studio_class=instance).exclude(start_time=instance.start_time) \
+    .update(start_time=instance.start_time)
+
+
+@receiver([post_save, post_delete], sender=ClassBooking)
+def class_booking_changed(sender, instance, raw=False, **kwargs):
+  if raw:
+    return
+  # bookings made or dropped through the class have it loaded already, others look up its
+  # studio id alone instead of loading the class
+  if ClassBooking.studio_class.is_cached(instance):
+    availability.publish(instance.studio_class.studio_id)
+  else:
+    availability.publish_class(instance.studio_class_id)
+
+
+@receiver([post_save, post_delete], sender=Keyword)
+def keyword_changed(sender, instance, raw=False, **kwargs):
+  if raw:
+    return
+  index_classes(StudioClass.objects.filter(pk=instance.studio_class_id).prefetch_related('keywords'))
+
+
+@receiver(post_save, sender=ClassSeries)
+def class_series_saved(sender, instance, created=False, raw=False, update_fields=None, **kwargs):
+  if raw:
+    return
+  from studios.schedules import materialize, update_series
+  if created:
+    # write the first occurrences right away, extend_class_schedules keeps the horizon moving
+    materialize([instance])
+  elif update_fields is None:
+    # an edit, saves of single fields come from cancel_series() which handles the occurrences itself
+    update_series(instance)
+
+
+@receiver([post_save, post_delete], sender=SubscriptionPlan)
+def subscription_plan_changed(sender, instance, raw=False, **kwargs):
+  if raw:
+    return
+  transaction.on_commit(lambda: response_cache.bump('plans'))
+
+
+@receiver([post_save, post_delete], sender=Subscription)
+def subscription_changed(sender, instance, raw=False, **kwargs):
+  if raw:
+    return
+  entitlements.invalidate([instance.user_id])
+
+
+@receiver(pre_save, sender=Payment)
+def payment_saving(sender, instance, raw=False, **kwargs):
+  if raw or instance.pk is None:
+    return
+  # the month the payment is counted in before the edit
+  instance._summary_key = Payment.objects.filter(pk=instance.pk).values_list('user_id', 'date').first()
+
+
+@receiver(post_save, sender=Payment)
+def payment_saved(sender, instance, created=False, raw=False, **kwargs):
+  if raw:
+    return
+  key = (instance.user_id, summaries.month_of(instance.date))
+  if created:
+    summaries.add({key: (1, instance.amount)})
+    return
+  keys = {key}
+  previous = getattr(instance, '_summary_key', None)
+  if previous is not None:
+    keys.add((previous[0], summaries.month_of(previous[1])))
+  summaries.refresh(keys)
+
+
+@receiver(post_delete, sender=Payment)
+def payment_deleted(sender, instance, **kwargs):
+  summaries.refresh([(instance.user_id, summaries.month_of(instance.date))])
@@ -0,0 +1,159 @@
+import asyncio
+import io
+import json
+import logging
+import re
+
+from asgiref.sync import sync_to_async
+from corsheaders.middleware import CorsMiddleware
+from django.conf import settings
+from django.core.exceptions import DisallowedHost
+from django.core.handlers.asgi import ASGIRequest
+from django.db import close_old_connections
+from django.http import HttpResponse
+
+from studios import availability
+
+logger = logging.getLogger(__name__)
+
+AVAILABILITY_STREAM_PATH = re.compile(r'^/studios/(?P<studio_id>\d+)/classes/availability/stream/$')
+
+
+def load_availability(studio_id):
+  try:
+    return availability.get_availability(studio_id)
+  finally:
+    # streams live outside Django's request cycle, which would otherwise close the connection
+    close_old_connections()
+
+
+class AvailabilityWatch:
+  """
+  Seats of one studio shared by the streams a process has open on it: a single poller reads
+  the version every interval, reloads the map when it moved and wakes every stream
+  """
+  def __init__(self, studio_id):
+    self.studio_id = studio_id
+    self.streams = 0
+    self.version = None
+    self.seats = None
+    # replaced each time the seats change, streams wait on the one current when they last read
+    self.changed = asyncio.Event()
+    self.task = None
+
+  async def poll(self, interval):
+    # the shared thread serves the whole process's sync code, polls don't need to queue behind it
+    get_version = sync_to_async(availability.get_version, thread_sensitive=False)
+    load = sync_to_async(load_availability, thread_sensitive=False)
+    while True:
+      try:
+        if await get_version(self.studio_id) != self.version:
+          self.version, self.seats = await load(self.studio_id)
+          changed, self.changed = self.changed, asyncio.Event()
+          changed.set()
+      except Exception:
+        # a cache or database outage must not end the streams, the next poll retries
+        logger.exception('Polling the availability of studio %s failed', self.studio_id)
+      await asyncio.sleep(interval)
+
+
+# studio id -> AvailabilityWatch of the streams open in this process
+watches = {}
+
+
+def join(studio_id):
+  watch = watches.get(studio_id)
+  if watch is None:
+    watch = watches[studio_id] = AvailabilityWatch(studio_id)
+  watch.streams += 1
+  if watch.task is None:
+    watch.task = asyncio.ensure_future(watch.poll(getattr(settings, 'STUDIOS_AVAILABILITY_POLL_INTERVAL', 1)))
+  return watch
+
+
+def leave(watch):
+  watch.streams -= 1
+  if not watch.streams:
+    watch.task.cancel()
+    del watches[watch.studio_id]
+
+
+def check_request(scope):
+  """
+  Run the checks the middleware applies to Django's own responses: return the CORS headers
+  CorsMiddleware gives the response, None when the host is not in ALLOWED_HOSTS
+  """
+  request = ASGIRequest(scope, io.BytesIO())
+  try:
+    request.get_host()
+  except DisallowedHost:
+    return None
+  response = CorsMiddleware(lambda request: HttpResponse()).process_response(request, HttpResponse())
+  return [
+    (name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in response.items()
+    if name.lower().startswith('access-control-') or name.lower() == 'vary'
+  ]
+
+
+async def availability_stream(scope, receive, send):
+  """
+  Raw ASGI app streaming server-sent events with the seats left in a studio's classes.
+  The first event is the whole map, later ones only the classes whose count changed, null
+  for classes that left the schedule. Streams on the same studio share one poller and
+  no thread is held while waiting, so a worker can keep many idle streams open
+  """
+  cors_headers = check_request(scope)
+  if cors_headers is None:
+    await send({'type': 'http.response.start', 'status': 400, 'headers': [(b'content-type', b'text/plain')]})
+    await send({'type': 'http.response.body', 'body': b'Bad Request'})
+    return
+  studio_id = int(AVAILABILITY_STREAM_PATH.match(scope['path'])['studio_id'])
+  heartbeat = getattr(settings, 'STUDIOS_AVAILABILITY_HEARTBEAT', 15)
+  disconnected = asyncio.Event()
+
+  async def watch_disconnect():
+    while (await receive())['type'] != 'http.disconnect':
+      pass
+    disconnected.set()
+
+  watcher = asyncio.ensure_future(watch_disconnect())
+  await send({
+    'type': 'http.response.start',
+    'status': 200,
+    'headers': [
+      (b'content-type', b'text/event-stream'),
+      (b'cache-control', b'no-cache'),
+      (b'x-accel-buffering', b'no'),
+      *cors_headers,
+    ],
+  })
+  watch = join(studio_id)
+  try:
+    seats = None
+    while not disconnected.is_set():
+      changed = watch.changed
+      if watch.seats is not None and watch.seats is not seats:
+        if seats is None:
+          await send_event(send, watch.seats)
+        else:
+          latest = watch.seats
+          changes = {class_id: latest.get(class_id) for class_id in seats.keys() | latest.keys() if seats.get(class_id) != latest.get(class_id)}
+          if changes:
+            await send_event(send, changes)
+        seats = watch.seats
+      waiting = asyncio.ensure_future(changed.wait())
+      done, _ = await asyncio.wait({waiting, watcher}, timeout=heartbeat, return_when=asyncio.FIRST_COMPLETED)
+      waiting.cancel()
+      if not done:
+        # keeps proxies from closing an idle connection
+        await send({'type': 'http.response.body', 'body': b': keep-alive\n\n', 'more_body': True})
+  finally:
+    leave(watch)
+    watcher.cancel()
+  if not disconnected.is_set():
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+async def send_event(send, data):
+  body = f'data: {json.dumps(data, separators=(",", ":"))}\n\n'.encode()
+  await send({'type': 'http.response.body', 'body': body, 'more_body': True})
@@ -0,0 +1,71 @@
+from collections import defaultdict
+from datetime import datetime, time
+
+from django.db import transaction
+from django.db.models import Count, DateField, F, Sum
+from django.db.models.functions import TruncMonth
+from django.utils import timezone
+
+from studios.models import Payment, PaymentMonthlySummary
+
+
+def month_of(value):
+  """
+  Return the first day of the local month of a payment date
+  """
+  return timezone.localtime(value).date().replace(day=1)
+
+
+def month_range(month):
+  """
+  Return the aware (start, end) datetimes of a local month, end excluded
+  """
+  next_month = month.replace(year=month.year + 1, month=1) if month.month == 12 else month.replace(month=month.month + 1)
+  return (timezone.make_aware(datetime.combine(month, time.min)), timezone.make_aware(datetime.combine(next_month, time.min)))
+
+
+def add(totals):
+  """
+  Add {(user_id, month): (count, total)} to the summaries, missing rows are created
+  """
+  if not totals:
+    return
+  PaymentMonthlySummary.objects.bulk_create(
+    [PaymentMonthlySummary(user_id=user_id, month=month) for user_id, month in totals], ignore_conflicts=True
+  )
+  # users adding the same amounts to the same month share one UPDATE
+  groups = defaultdict(list)
+  for (user_id, month), (count, total) in totals.items():
+    groups[(month, count, total)].append(user_id)
+  for (month, count, total), user_ids in groups.items():
+    PaymentMonthlySummary.objects.filter(month=month, user_id__in=user_ids) \
+      .update(count=F('count') + count, total=F('total') + total)
+
+
+def refresh(keys):
+  """
+  Recount the summaries of the given (user_id, month) pairs from their payments,
+  for changes that can't be applied as an increment like edits and deletes
+  """
+  for user_id, month in keys:
+    start, end = month_range(month)
+    totals = Payment.objects.filter(user_id=user_id, date__gte=start, date__lt=end) \
+      .aggregate(count=Count('id'), total=Sum('amount'))
+    if totals['count']:
+      PaymentMonthlySummary.objects.update_or_create(user_id=user_id, month=month, defaults=totals)
+    else:
+      PaymentMonthlySummary.objects.filter(user_id=user_id, month=month).delete()
+
+
+def rebuild(chunk_size=1000):
+  """
+  Recount every summary from the payments and return the number of rows written
+  """
+  rows = Payment.objects.annotate(month=TruncMonth('date', output_field=DateField())) \
+    .values('user_id', 'month').annotate(count=Count('id'), total=Sum('amount')).order_by()
+  with transaction.atomic():
+    PaymentMonthlySummary.objects.all().delete()
+    created = PaymentMonthlySummary.objects.bulk_create(
+      (PaymentMonthlySummary(**row) for row in rows.iterator(chunk_size=chunk_size)), batch_size=chunk_size
+    )
+  return len(created)
@@ -1,3 +1,1544 @@
-from django.test import TestCase
+import json
+import math
+import multiprocessing
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from datetime import timezone as dt_timezone
+from decimal import Decimal
+from importlib import import_module
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from asgiref.testing import ApplicationCommunicator
+from django.apps import apps
+from django.conf import settings
+from django.db import IntegrityError, connection
+from django.db.models import Count, DateField, Sum
+from django.db.models.functions import TruncMonth
+from django.middleware.csrf import CSRF_SECRET_LENGTH
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+
+from accounts.models import User
+from studios import availability, entitlements, geo, summaries
+from studios.billing import LeaseLost, bill_chunk, bill_partition, is_consistent, lease_expiry, reconcile, run_billing
+from studios.cache import response_cache
+from studios.checks import check_availability_stream_cache
+from studios.fast_serializers import ValuesSerializer
+from studios.filters import StudioClassFilter
+from studios.models import NEARBY_SEARCH_PRECISION, Amenity, BillingPartition, BillingRun, Card, ClassBooking, ClassSearchToken, ClassSeries, IdempotencyKey, Image, Keyword, Payment, PaymentMonthlySummary, Point, Studio, StudioClass, Subscription, SubscriptionPlan, WaitlistEntry
+from studios.nearest import nearest_studios
+from studios.renderers import FastJSONRenderer, dumps, orjson
+from studios.schedules import extend_schedules, get_horizon, materialize
+from studios.serializers import ClassBookingSerializer, PaymentsSerializer, StudioClassesSerializer, SubscriptionPlansSerializer
+from studios.streams import availability_stream, watches
+
+# benchmarks build large tables so they only run with STUDIOS_BENCHMARKS=1,
+# STUDIOS_BENCHMARK_SCALE shrinks or grows the number of rows they build
+BENCHMARKS = os.environ.get('STUDIOS_BENCHMARKS') == '1'
+BENCHMARK_SCALE = float(os.environ.get('STUDIOS_BENCHMARK_SCALE', 1))
+benchmark = skipUnless(BENCHMARKS, 'set STUDIOS_BENCHMARKS=1 to run benchmarks')
+
+
+def benchmark_size(size):
+  return max(int(size * BENCHMARK_SCALE), 100)
+
+
+def best_time(function, repeat=5):
+  """
+  Return the fastest of repeat calls of function in seconds
+  """
+  timings = []
+  for _ in range(repeat):
+    start = time.perf_counter()
+    function()
+    timings.append(time.perf_counter() - start)
+  return min(timings)
+
+
+def destination(latitude, longitude, bearing, distance_km):
+  """
+  Return the coordinates reached going distance_km from the coordinates along bearing degrees
+  """
+  lat, lon, angle, bearing = math.radians(latitude), math.radians(longitude), distance_km / geo.EARTH_RADIUS_KM, math.radians(bearing)
+  end_lat = math.asin(math.sin(lat) * math.cos(angle) + math.cos(lat) * math.sin(angle) * math.cos(bearing))
+  end_lon = lon + math.atan2(math.sin(bearing) * math.sin(angle) * math.cos(lat), math.cos(angle) - math.sin(lat) * math.sin(end_lat))
+  return math.degrees(end_lat), (math.degrees(end_lon) + 180) % 360 - 180
+
+
+class GeohashTests(TestCase):
+  def test_encode(self):
+    # the example of https://en.wikipedia.org/wiki/Geohash
+    self.assertEqual(geo.encode(57.64911, 10.40744, 11), 'u4pruydqqvj')
+    self.assertEqual(geo.encode(-90, -180, 4), '0000')
+    self.assertEqual(geo.encode(90, 180, 4), 'zzzz')
+
+  def test_prefix_range(self):
+    self.assertEqual(geo.prefix_range('u4'), ('u4', 'u5'))
+    self.assertEqual(geo.prefix_range('bz'), ('bz', 'c'))
+    self.assertEqual(geo.prefix_range('zz'), ('zz', None))
+
+  def test_neighbourhood_covers_safe_radius(self):
+    for latitude, longitude in ((43.66, -79.39), (-33.87, 151.21), (0.01, 179.99), (70.5, -0.01)):
+      for precision in range(2, 7):
+        cells = geo.neighbourhood(latitude, longitude, precision)
+        radius = geo.safe_radius(latitude, precision)
+        for bearing in range(0, 360, 15):
+          with self.subTest(latitude=latitude, longitude=longitude, precision=precision, bearing=bearing):
+            self.assertIn(geo.encode(*destination(latitude, longitude, bearing, radius * 0.999), precision), cells)
+
+  def test_saved_and_backfilled(self):
+    studio = Studio.objects.create(name='studio', address='address', postal_code='M5S', phone_number='1')
+    point = Point.objects.create(studio=studio, latitude=43.66, longitude=-79.39)
+    self.assertEqual(point.geohash, geo.encode(43.66, -79.39))
+    point.latitude = 45.5
+    point.save(update_fields=['latitude'])
+    point.refresh_from_db()
+    self.assertEqual(point.geohash, geo.encode(45.5, -79.39))
+    Point.objects.update(geohash='')
+    import_module('studios.migrations.0025_point_geohash').fill_geohash(apps, None)
+    point.refresh_from_db()
+    self.assertEqual(point.geohash, geo.encode(45.5, -79.39))
+
+
+def create_studios(count):
+  """
+  Create count studios spread over the globe with their points, without going through save()
+  """
+  first = Studio.objects.count()
+  studios = Studio.objects.bulk_create(
+    [Studio(name=f'studio {first + i}', address='address', postal_code='M5S', phone_number='1') for i in range(count)],
+    batch_size=1000,
+  )
+  points = []
+  for i, studio in enumerate(studios):
+    # a deterministic spread, the golden angle keeps neighbours apart
+    latitude = ((first + i) * 0.618034 % 1) * 170 - 85
+    longitude = ((first + i) * 0.754878 % 1) * 360 - 180
+    x, y, z = geo.unit_vector(latitude, longitude)
+    points.append(Point(studio=studio, latitude=latitude, longitude=longitude, geohash=geo.encode(latitude, longitude), x=x, y=y, z=z))
+  Point.objects.bulk_create(points, batch_size=1000)
+  return studios
+
+
+@benchmark
+class StudiosNearbyBenchmark(TestCase):
+  """
+  A page of nearby studios costs about the same at 50k studios as at 5k, it must not grow
+  faster than the table does
+  """
+  size = benchmark_size(50000)
+  url = '/studios/all/?latitude=43.66&longitude=-79.39&limit=20'
+
+  def measure(self):
+    client = APIClient()
+    return best_time(lambda: self.assertEqual(client.get(self.url).status_code, 200))
+
+  def measure_sizes(self):
+    timings = []
+    for size in (self.size // 10, self.size):
+      create_studios(size - Studio.objects.count())
+      nearest_studios.clear()
+      timings.append(self.measure())
+    nearest_studios.clear()
+    return timings
+
+  def check_scaling(self, name, timings):
+    small, large = timings
+    print(f'\n{name}: {self.size // 10} studios {small * 1000:.1f}ms, {self.size} studios {large * 1000:.1f}ms')
+    # ten times the studios, linear or better with room for timing noise
+    self.assertLess(large, small * 10 * 1.5)
+
+  @override_settings(STUDIOS_NEAREST_INDEX=False)
+  def test_database_ordering(self):
+    self.check_scaling('database ordering', self.measure_sizes())
+
+  @override_settings(STUDIOS_NEAREST_INDEX=True)
+  def test_nearest_index(self):
+    self.check_scaling('nearest index', self.measure_sizes())
+
+
+def great_circle_km(latitude, longitude, point):
+  """
+  Return the haversine distance between the coordinates and a point
+  """
+  lat1, lat2 = math.radians(latitude), math.radians(point.latitude)
+  d_lat, d_lon = lat2 - lat1, math.radians(point.longitude - longitude)
+  a = math.sin(d_lat / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin(d_lon / 2) ** 2
+  return 2 * geo.EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+@override_settings(STUDIOS_NEAREST_INDEX=False)
+class NearbyOrderingTests(TestCase):
+  """
+  A page of nearby studios lists the same studios in the same order as sorting all of them
+  by their distance
+  """
+  origins = [(43.66, -79.39), (-33.87, 151.21), (0.1, 179.9), (88, 0)]
+
+  def setUp(self):
+    self.client = APIClient()
+    self.points = [studio.point for studio in create_studios(300)]
+
+  def closest(self, latitude, longitude):
+    return [point.studio_id for point in sorted(self.points, key=lambda point: (great_circle_km(latitude, longitude, point), point.studio_id))]
+
+  def test_pages(self):
+    for latitude, longitude in self.origins:
+      expected = self.closest(latitude, longitude)
+      for offset in (0, 7):
+        with self.subTest(latitude=latitude, longitude=longitude, offset=offset):
+          response = self.client.get('/studios/all/', {'latitude': latitude, 'longitude': longitude, 'limit': 10, 'offset': offset})
+          self.assertEqual(response.json()['count'], len(expected))
+          self.assertEqual([studio['id'] for studio in response.json()['results']], expected[offset:offset + 10])
+
+  def test_limited_query(self):
+    for latitude, longitude in self.origins:
+      with self.subTest(latitude=latitude, longitude=longitude):
+        studios = Studio.get_studios_nearby_coords(latitude, longitude, limit=5)
+        self.assertEqual([studio.pk for studio in studios[:5]], self.closest(latitude, longitude)[:5])
+
+
+class NearestIndexTests(TestCase):
+  """
+  The in-memory index and the database ordering list the same studios in the same order
+  """
+  def setUp(self):
+    nearest_studios.clear()
+    self.client = APIClient()
+    self.studios = create_studios(60)
+    self.origin = self.studios[0].point
+    # a tie broken by studio id and a studio that can't be located
+    self.twin = Studio.objects.create(name='twin', address='address', postal_code='M5S', phone_number='1')
+    Point.objects.create(studio=self.twin, latitude=self.origin.latitude, longitude=self.origin.longitude)
+    self.unlocated = Studio.objects.create(name='unlocated', address='address', postal_code='M5S', phone_number='1')
+
+  def tearDown(self):
+    nearest_studios.clear()
+
+  def search(self, **params):
+    response = self.client.get('/studios/all/', {'latitude': self.origin.latitude, 'longitude': self.origin.longitude, **params})
+    self.assertEqual(response.status_code, 200, params)
+    return response.json()['count'], [studio['id'] for studio in response.json()['results']]
+
+  def test_matches_database(self):
+    searches = [{'limit': 100}, {'k': 5}, {'radius_km': 3000}, {'k': 3, 'radius_km': 3000}, {'limit': 4, 'offset': 2}]
+    for params in searches:
+      with self.subTest(**params):
+        with override_settings(STUDIOS_NEAREST_INDEX=True):
+          indexed = self.search(**params)
+        with override_settings(STUDIOS_NEAREST_INDEX=False):
+          ordered = self.search(**params)
+        self.assertEqual(indexed, ordered)
+        points = Point.get_points_nearby_coords(self.origin.latitude, self.origin.longitude, params.get('radius_km'))
+        expected = list(points.values_list('studio_id', flat=True))[:params.get('k')]
+        self.assertEqual(indexed[0], len(expected))
+        offset = params.get('offset', 0)
+        self.assertEqual(indexed[1], expected[offset:offset + params.get('limit', len(expected))])
+    count, studio_ids = self.search(limit=100)
+    self.assertEqual(studio_ids[:2], [self.studios[0].pk, self.twin.pk])
+    self.assertNotIn(self.unlocated.pk, studio_ids)
+
+  def test_invalid_search(self):
+    searches = [
+      {'k': -1}, {'k': 0}, {'k': 'two'}, {'radius_km': 0}, {'radius_km': -5}, {'radius_km': 'nan'},
+      {'latitude': 91}, {'longitude': 'east'},
+    ]
+    for nearest_index in (True, False):
+      for params in searches:
+        with self.subTest(nearest_index=nearest_index, **params), override_settings(STUDIOS_NEAREST_INDEX=nearest_index):
+          response = self.client.get('/studios/all/', {'latitude': 43.66, 'longitude': -79.39, **params})
+          self.assertEqual(response.status_code, 400)
+          self.assertIn(next(iter(params)), response.json())
+      with override_settings(STUDIOS_NEAREST_INDEX=nearest_index):
+        self.assertEqual(self.client.get('/studios/all/', {'longitude': -79.39}).status_code, 400)
+
+
+class UnitVectorTests(TestCase):
+  def setUp(self):
+    self.studio = Studio.objects.create(name='studio', address='address', postal_code='M5S', phone_number='1')
+
+  def assertUnitVector(self, point, latitude, longitude):
+    for value, expected in zip((point.x, point.y, point.z), geo.unit_vector(latitude, longitude)):
+      self.assertAlmostEqual(value, expected)
+
+  def test_saved_and_backfilled(self):
+    point = Point.objects.create(studio=self.studio, latitude=43.66, longitude=-79.39)
+    self.assertUnitVector(point, 43.66, -79.39)
+    point.longitude = 100
+    point.save(update_fields=['longitude'])
+    point.refresh_from_db()
+    self.assertUnitVector(point, 43.66, 100)
+    Point.objects.update(x=0, y=0, z=0)
+    import_module('studios.migrations.0026_point_x_point_y_point_z').fill_unit_vectors(apps, None)
+    point.refresh_from_db()
+    self.assertUnitVector(point, 43.66, 100)
+
+  def test_proximity_follows_distance(self):
+    points = [studio.point for studio in create_studios(200)]
+    for latitude, longitude in ((43.66, -79.39), (0, 180), (-89, 45)):
+      with self.subTest(latitude=latitude, longitude=longitude):
+        expected = sorted(points, key=lambda point: (great_circle_km(latitude, longitude, point), point.studio_id))
+        self.assertEqual(list(Point.get_points_nearby_coords(latitude, longitude)), expected)
+
+
+class BoundingBoxTests(TestCase):
+  """
+  The bounding box prefilter never drops a point that is inside the radius, also where the
+  box wraps the antimeridian or reaches a pole
+  """
+  centres = [(43.66, -79.39), (0, 179.5), (89.5, 20), (-60, -179.9)]
+
+  def setUp(self):
+    self.points = [studio.point for studio in create_studios(500)]
+    # neighbours across the antimeridian and over the pole
+    for latitude, longitude in ((0.2, -179.8), (-60.1, 179.95), (89.7, -160), (89.2, 100)):
+      studio = Studio.objects.create(name='neighbour', address='address', postal_code='M5S', phone_number='1')
+      self.points.append(Point.objects.create(studio=studio, latitude=latitude, longitude=longitude))
+
+  def test_matches_distance(self):
+    for latitude, longitude in self.centres:
+      for radius in (100, 1000, 5000):
+        with self.subTest(latitude=latitude, longitude=longitude, radius=radius):
+          distances = {point.studio_id: great_circle_km(latitude, longitude, point) for point in self.points}
+          found = set(Point.get_points_nearby_coords(latitude, longitude, radius).values_list('studio_id', flat=True))
+          # points right on the circle may fall either way with rounding
+          self.assertEqual(
+            {studio_id for studio_id in found if abs(distances[studio_id] - radius) > 0.01},
+            {studio_id for studio_id, distance in distances.items() if distance < radius - 0.01},
+          )
+
+
+def create_classes(studio, count, **fields):
+  """
+  Create count upcoming classes of the studio a day apart
+  """
+  now = timezone.now()
+  classes = []
+  for i in range(count):
+    start_time = now + timedelta(days=i + 1)
+    classes.append(StudioClass.objects.create(
+      name=fields.get('name', 'yoga'), description='description', coach=fields.get('coach', 'coach'),
+      capacity=fields.get('capacity', 20), start_time=start_time, end_time=start_time + timedelta(hours=1),
+      recurrence_end=start_time + timedelta(hours=1), studio=studio,
+    ))
+  return classes
+
+
+def create_studio_details(studio, classes=3):
+  """
+  Give a studio images, amenities and upcoming classes with keywords
+  """
+  Image.objects.create(image='studios/front.jpg', studio=studio)
+  Image.objects.create(image='studios/room.jpg', studio=studio)
+  Amenity.objects.create(type='showers', quantity=2, studio=studio)
+  for studio_class in create_classes(studio, classes):
+    Keyword.objects.create(keyword='stretching', studio_class=studio_class)
+
+
+class QueryBudgetTestCase(TestCase):
+  """
+  Endpoints declare the number of queries they may run, it must not grow with the data
+  """
+  def setUp(self):
+    response_cache.clear()
+    nearest_studios.clear()
+    self.client = APIClient()
+
+  def tearDown(self):
+    response_cache.clear()
+    nearest_studios.clear()
+
+  def count_queries(self, url):
+    # cached responses are built again, the budget covers the cold path
+    response_cache.clear()
+    with CaptureQueriesContext(connection) as queries:
+      response = self.client.get(url)
+    self.assertEqual(response.status_code, 200, url)
+    return len(queries)
+
+  def assertQueryBudget(self, budgets, grow):
+    """
+    Check every url of {url: budget} before and after grow() adds data
+    """
+    counts = {url: self.count_queries(url) for url in budgets}
+    grow()
+    for url, budget in budgets.items():
+      with self.subTest(url=url):
+        grown = self.count_queries(url)
+        self.assertLessEqual(counts[url], budget)
+        self.assertLessEqual(grown, budget)
+        self.assertEqual(counts[url], grown, f'{url} runs more queries as the data grows')
+
+
+class StudioQueryBudgetTests(QueryBudgetTestCase):
+  def setUp(self):
+    super().setUp()
+    self.studio = create_studios(1)[0]
+    create_studio_details(self.studio)
+    self.plan = SubscriptionPlan.objects.create(price=10, duration=30)
+
+  def grow(self):
+    for studio in create_studios(20):
+      create_studio_details(studio, classes=5)
+    create_studio_details(self.studio, classes=10)
+    SubscriptionPlan.objects.bulk_create([SubscriptionPlan(price=i, duration=30) for i in range(20)])
+
+  def budgets(self, nearby_budget):
+    nearby = '/studios/all/?latitude=43.66&longitude=-79.39'
+    return {
+      nearby: nearby_budget,
+      f'{nearby}&limit=5&radius_km=20000&expand=point': nearby_budget,
+      '/studios/all/filter/?search=studio': 5,
+      # ETag validator, studio, images, amenities, classes
+      f'/studios/{self.studio.pk}/': 5,
+      # ETag validator, count, classes
+      f'/studios/{self.studio.pk}/classes/': 3,
+      f'/studios/{self.studio.pk}/classes/?expand=studio': 3,
+      '/studios/classes/search/?q=yoga': 2,
+      f'/studios/{self.studio.pk}/classes/availability/': 1,
+      '/studios/plans/': 2,
+      f'/studios/plans/{self.plan.pk}/': 1,
+    }
+
+  @override_settings(STUDIOS_NEAREST_INDEX=False)
+  def test_database_ordering(self):
+    # count, studios, images, amenities, classes and a count for each geohash precision
+    # tried when narrowing the search
+    self.assertQueryBudget(self.budgets(5 + NEARBY_SEARCH_PRECISION), self.grow)
+
+  @override_settings(STUDIOS_NEAREST_INDEX=True)
+  def test_nearest_index(self):
+    # the index is loaded once per process and not counted, bulk_create() skips the
+    # signals keeping it up to date so it is loaded again once the data has grown
+    nearest_studios.load()
+
+    def grow():
+      self.grow()
+      nearest_studios.load()
+
+    # studios, images, amenities, classes, the count comes from the index
+    self.assertQueryBudget(self.budgets(4), grow)
+
+
+class UpcomingClassesTests(TestCase):
+  """
+  Studios list their next few active upcoming classes and summarize the rest
+  """
+  def setUp(self):
+    response_cache.clear()
+    nearest_studios.clear()
+    self.client = APIClient()
+    self.studios = create_studios(2)
+    self.names = {}
+    self.next_start_times = {}
+    for studio in self.studios:
+      classes = create_classes(studio, 8)
+      for i, studio_class in enumerate(classes):
+        StudioClass.objects.filter(pk=studio_class.pk).update(name=f'{studio.name} class {i}')
+      # the first one is cancelled
+      self.names[studio.pk] = [f'{studio.name} class {i}' for i in range(1, 6)]
+      self.next_start_times[studio.pk] = classes[1].start_time
+      StudioClass.objects.filter(pk=classes[0].pk).update(status='cancelled')
+      past = create_classes(studio, 1, name='past')[0]
+      StudioClass.objects.filter(pk=past.pk).update(start_time=past.start_time - timedelta(days=30))
+
+  def tearDown(self):
+    response_cache.clear()
+    nearest_studios.clear()
+
+  def assertUpcoming(self, studio):
+    self.assertEqual([studio_class['name'] for studio_class in studio['classes']], self.names[studio['id']])
+    self.assertEqual(studio['upcoming_count'], 7)
+    self.assertEqual(datetime.fromisoformat(studio['next_start_time']), self.next_start_times[studio['id']])
+
+  def test_list(self):
+    response = self.client.get('/studios/all/', {'latitude': 43.66, 'longitude': -79.39})
+    self.assertEqual(len(response.json()['results']), 2)
+    for studio in response.json()['results']:
+      self.assertUpcoming(studio)
+
+  def test_detail(self):
+    for studio in self.studios:
+      self.assertUpcoming(self.client.get(f'/studios/{studio.pk}/').json())
+
+
+class SparseFieldsTests(TestCase):
+  """
+  ?fields= keeps only the listed fields and ?expand= nests the listed relations
+  """
+  def setUp(self):
+    response_cache.clear()
+    nearest_studios.clear()
+    self.client = APIClient()
+    self.studio = create_studios(1)[0]
+    self.studio_class = create_classes(self.studio, 1)[0]
+    self.summary = {
+      'id': self.studio.pk, 'name': self.studio.name, 'address': self.studio.address,
+      'point': {'latitude': self.studio.point.latitude, 'longitude': self.studio.point.longitude},
+    }
+
+  def tearDown(self):
+    response_cache.clear()
+    nearest_studios.clear()
+
+  def get(self, url, **params):
+    response = self.client.get(url, params)
+    self.assertEqual(response.status_code, 200)
+    return response.json()['results']
+
+  def test_studios(self):
+    nearby = {'latitude': 43.66, 'longitude': -79.39}
+    self.assertEqual(self.get('/studios/all/', fields='id,name', **nearby), [{'id': self.studio.pk, 'name': self.studio.name}])
+    self.assertNotIn('point', self.get('/studios/all/', **nearby)[0])
+    self.assertEqual(self.get('/studios/all/', fields='id', expand='point', **nearby), [{'id': self.studio.pk, 'point': self.summary['point']}])
+
+  def test_classes(self):
+    url = f'/studios/{self.studio.pk}/classes/'
+    self.assertEqual(self.get(url)[0]['studio'], self.studio.pk)
+    self.assertEqual(self.get(url, expand='studio')[0]['studio'], self.summary)
+    self.assertEqual(self.get(url, fields='id,studio', expand='studio'), [{'id': self.studio_class.pk, 'studio': self.summary}])
+
+  def test_bookings(self):
+    user = User.objects.create(username='member')
+    booking = ClassBooking.objects.create(studio_class=self.studio_class, user=user)
+    self.client.force_authenticate(user)
+    url = '/accounts/class-bookings-list/'
+    self.assertEqual(self.get(url)[0]['studio_class']['studio'], self.studio.pk)
+    self.assertEqual(self.get(url, expand='studio_class.studio')[0]['studio_class']['studio'], self.summary)
+    self.assertEqual(self.get(url, fields='id'), [{'id': booking.pk}])
+
+
+def create_payments(count):
+  """
+  Create count payments of a new user an hour apart
+  """
+  user = User.objects.create(username=f'payer {User.objects.count()}')
+  card = Card.objects.create(
+    user=user, last_name='last', first_name='first', address='address', phone_number='1',
+    card_number=4111111111111111, card_expiry=date(2030, 1, 1), card_cvv=123,
+  )
+  now = timezone.now()
+  Payment.objects.bulk_create(
+    [Payment(user=user, card=card, amount=10.5, date=now - timedelta(hours=i)) for i in range(count)], batch_size=1000
+  )
+
+
+class ValuesSerializerTests(TestCase):
+  """
+  The values() path renders the same bytes as the model serializers it is compiled from
+  """
+  def setUp(self):
+    studio = create_studios(1)[0]
+    create_studio_details(studio)
+    SubscriptionPlan.objects.create(price=9.99, duration=30)
+    create_payments(3)
+
+  def assertSameOutput(self, serializer, queryset):
+    queryset = queryset.order_by('id')
+    values_serializer = ValuesSerializer(serializer)
+    rows = values_serializer.to_representation(values_serializer.values(queryset))
+    self.assertEqual(dumps(rows), dumps(serializer.__class__(queryset, many=True).data))
+
+  def test_classes(self):
+    self.assertSameOutput(StudioClassesSerializer(), StudioClass.objects.all())
+
+  def test_expanded_classes(self):
+    serializer = StudioClassesSerializer()
+    serializer.apply_requested(None, {'studio'})
+    queryset = StudioClass.objects.all()
+    values_serializer = ValuesSerializer(serializer)
+    rows = values_serializer.to_representation(values_serializer.values(queryset.order_by('id')))
+    expected = []
+    for studio_class in queryset.order_by('id'):
+      data = StudioClassesSerializer(studio_class).data
+      data['studio'] = serializer.fields['studio'].to_representation(studio_class.studio)
+      expected.append(data)
+    self.assertEqual(dumps(rows), dumps(expected))
+
+  def test_plans(self):
+    self.assertSameOutput(SubscriptionPlansSerializer(), SubscriptionPlan.objects.all())
+
+  def test_payments(self):
+    self.assertSameOutput(PaymentsSerializer(), Payment.objects.all())
+
+
+@benchmark
+class ValuesSerializerBenchmark(TestCase):
+  """
+  Rows per second of the model serializers and of the values() path on the same rows
+  """
+  size = benchmark_size(20000)
+
+  def compare(self, name, serializer, queryset):
+    values_serializer = ValuesSerializer(serializer)
+    model = best_time(lambda: dumps(serializer.__class__(queryset.all(), many=True).data), repeat=3)
+    values = best_time(lambda: dumps(values_serializer.to_representation(values_serializer.values(queryset.all()))), repeat=3)
+    count = queryset.count()
+    print(f'\n{name}: {count / model:,.0f} rows/s model serializer, {count / values:,.0f} rows/s values, {model / values:.1f}x')
+    self.assertLess(values, model)
+
+  def test_classes(self):
+    studio = create_studios(1)[0]
+    start_time = timezone.now() + timedelta(days=1)
+    StudioClass.objects.bulk_create([
+      StudioClass(
+        name='yoga', description='description', coach='coach', capacity=20, start_time=start_time + timedelta(hours=i),
+        end_time=start_time + timedelta(hours=i + 1), recurrence_end=start_time, studio=studio,
+      ) for i in range(self.size)
+    ], batch_size=1000)
+    self.compare('classes', StudioClassesSerializer(), StudioClass.objects.all())
+
+  def test_plans(self):
+    SubscriptionPlan.objects.bulk_create([SubscriptionPlan(price=i, duration=30) for i in range(self.size)], batch_size=1000)
+    self.compare('plans', SubscriptionPlansSerializer(), SubscriptionPlan.objects.all())
+
+  def test_payments(self):
+    create_payments(self.size)
+    self.compare('payments', PaymentsSerializer(), Payment.objects.select_related('card'))
+
+
+class FastJSONRendererTests(TestCase):
+  def test_matches_json_renderer(self):
+    data = {
+      'name': 'caf\u00e9 \u2028 line \u2029 paragraph', 'when': timezone.now(), 'price': Decimal('10.50'),
+      'ids': [1, 2 ** 40], 'ratio': 0.1, 'empty': None, 'active': True, 'nested': [{'a': []}],
+    }
+    rendered = FastJSONRenderer().render(data)
+    self.assertEqual(rendered, JSONRenderer().render(data))
+    self.assertIn(b'\\u2028', rendered)
+
+  @skipUnless(orjson, 'orjson is not installed')
+  def test_float_differences(self):
+    # documented on FastJSONRenderer, the values are the same, only their spelling differs
+    for value in (1e16, 1e-5):
+      with self.subTest(value=value):
+        rendered = FastJSONRenderer().render([value])
+        self.assertNotEqual(rendered, JSONRenderer().render([value]))
+        self.assertEqual(json.loads(rendered), [value])
+    self.assertEqual(FastJSONRenderer().render([math.nan]), b'[null]')
+    with self.assertRaises(ValueError):
+      JSONRenderer().render([math.nan])
+
+  @mock.patch('studios.views.StudiosView.stream_chunk_size', 3)
+  def test_streamed_list(self):
+    create_studios(10)
+    client = APIClient()
+    url = '/studios/all/?latitude=43.66&longitude=-79.39'
+    response = client.get(f'{url}&stream=true')
+    self.assertTrue(response.streaming)
+    self.assertEqual(json.loads(b''.join(response.streaming_content)), client.get(f'{url}&limit=100').json()['results'])
+
+
+class ResponseCacheTests(TestCase):
+  def setUp(self):
+    response_cache.clear()
+    self.client = APIClient()
+    SubscriptionPlan.objects.create(price=10, duration=30)
+
+  def tearDown(self):
+    response_cache.clear()
+
+  def test_served_until_changed(self):
+    self.assertEqual(len(self.client.get('/studios/plans/').json()['results']), 1)
+    with self.assertNumQueries(0):
+      self.client.get('/studios/plans/')
+    with self.captureOnCommitCallbacks(execute=True):
+      SubscriptionPlan.objects.create(price=20, duration=30)
+    self.assertEqual(len(self.client.get('/studios/plans/').json()['results']), 2)
+
+  def test_media_type(self):
+    compact = self.client.get('/studios/plans/', HTTP_ACCEPT='application/json')
+    indented = self.client.get('/studios/plans/', HTTP_ACCEPT='application/json; indent=4')
+    self.assertNotIn(b'\n', compact.content)
+    self.assertIn(b'\n    "count"', indented.content)
+    self.assertEqual(json.loads(indented.content), compact.json())
+    self.assertEqual(self.client.get('/studios/plans/', HTTP_ACCEPT='application/json').content, compact.content)
+
+
+class StudioConditionalGetTests(TestCase):
+  def setUp(self):
+    response_cache.clear()
+    self.studio = create_studios(1)[0]
+    create_studio_details(self.studio, classes=2)
+    self.url = f'/studios/{self.studio.pk}/'
+    self.client = APIClient()
+
+  def tearDown(self):
+    response_cache.clear()
+
+  def test_not_modified(self):
+    etag = self.client.get(self.url)['ETag']
+    response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+    self.assertEqual(response.status_code, 304)
+
+  def test_started_class_changes_etag_and_body(self):
+    response = self.client.get(self.url)
+    self.assertEqual(response.json()['upcoming_count'], 2)
+    # time passing changes nothing in the database that would bump the cached version
+    StudioClass.objects.filter(pk=self.studio.classes.order_by('start_time')[0].pk).update(start_time=timezone.now() - timedelta(minutes=1))
+    started = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+    self.assertEqual(started.status_code, 200)
+    self.assertNotEqual(started['ETag'], response['ETag'])
+    self.assertEqual(started.json()['upcoming_count'], 1)
+    self.assertEqual(len(started.json()['classes']), 1)
+    self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=started['ETag']).status_code, 304)
+
+
+class ScheduleTests(TestCase):
+  """
+  Occurrences of a series are written up to the horizon once, and follow edits of the series
+  """
+  def setUp(self):
+    response_cache.clear()
+    self.studio = create_studios(1)[0]
+
+  def tearDown(self):
+    response_cache.clear()
+
+  def create_series(self, start_time, **fields):
+    return ClassSeries.objects.create(
+      name='yoga', description='description', coach='coach', capacity=10, start_time=start_time,
+      end_time=start_time + timedelta(hours=1), recurrence_end=start_time + timedelta(days=365), studio=self.studio, **fields
+    )
+
+  def upcoming(self, series):
+    return list(series.occurrences.filter(start_time__gte=timezone.now()).order_by('start_time'))
+
+  def test_written_up_to_the_horizon(self):
+    start = timezone.now() + timedelta(days=1)
+    series = self.create_series(start)
+    starts = [occurrence.start_time for occurrence in series.occurrences.order_by('start_time')]
+    # weekly up to STUDIOS_SCHEDULE_HORIZON_DAYS ahead
+    self.assertEqual(starts, [start + timedelta(days=7 * week) for week in range(4)])
+    series.refresh_from_db()
+    self.assertEqual(series.materialized_until, starts[-1])
+
+  def test_runs_are_idempotent(self):
+    series = self.create_series(timezone.now() + timedelta(days=1))
+    count = series.occurrences.count()
+    self.assertEqual(materialize([series]), 0)
+    self.assertEqual(extend_schedules(), 0)
+    # a stale copy of the series writes its occurrences again, the constraint skips them
+    series.materialized_until = None
+    materialize([series])
+    self.assertEqual(series.occurrences.count(), count)
+    extend_schedules(get_horizon() + timedelta(days=14))
+    self.assertEqual(series.occurrences.count(), count + 2)
+
+  @override_settings(TIME_ZONE='America/Toronto')
+  def test_wall_clock_time_kept_across_dst(self):
+    # daylight saving time ends on 2030-11-03 in Toronto
+    series = self.create_series(timezone.make_aware(datetime(2030, 10, 20, 9)))
+    materialize([series], timezone.make_aware(datetime(2030, 11, 20)))
+    occurrences = list(series.occurrences.order_by('start_time'))
+    self.assertEqual(len(occurrences), 5)
+    self.assertEqual({timezone.localtime(occurrence.start_time).hour for occurrence in occurrences}, {9})
+    self.assertEqual({timezone.localtime(occurrence.end_time).hour for occurrence in occurrences}, {10})
+    self.assertEqual([occurrence.start_time.astimezone(dt_timezone.utc).hour for occurrence in occurrences], [13, 13, 14, 14, 14])
+
+  def test_edit_reaches_upcoming_occurrences(self):
+    start = timezone.now() + timedelta(days=1)
+    series = self.create_series(start)
+    booked = self.upcoming(series)[1]
+    for user in create_members(2):
+      self.assertTrue(booked.reserve_seat())
+      ClassBooking.objects.create(studio_class=booked, user=user)
+    series.name = 'pilates'
+    series.capacity = 1
+    series.start_time += timedelta(hours=1)
+    series.end_time += timedelta(hours=1)
+    series.save()
+    occurrences = self.upcoming(series)
+    # the booked occurrence keeps its time next to its replacement, its capacity covers its bookings
+    self.assertEqual([occurrence.start_time for occurrence in occurrences], sorted([booked.start_time] + [
+      start + timedelta(days=7 * week, hours=1) for week in range(4)
+    ]))
+    self.assertEqual({occurrence.name for occurrence in occurrences}, {'pilates'})
+    self.assertEqual([occurrence.capacity for occurrence in occurrences], [1, 2, 1, 1, 1])
+    self.assertEqual(ClassSearchToken.objects.filter(token='pilates').count(), 5)
+    self.assertFalse(ClassSearchToken.objects.filter(token='yoga').exists())
+
+  def test_cancelled_by_edit(self):
+    series = self.create_series(timezone.now() + timedelta(days=1))
+    series.status = 'cancelled'
+    series.save()
+    self.assertEqual({occurrence.status for occurrence in self.upcoming(series)}, {'cancelled'})
+
+
+class ScheduleIndexTests(TestCase):
+  """
+  A studio's filtered schedule is read through the (studio, status, start_time) index
+  """
+  def setUp(self):
+    studios = create_studios(20)
+    for studio in studios:
+      create_classes(studio, 30)
+    self.studio = studios[0]
+
+  def test_filtered_schedule_uses_index(self):
+    now = timezone.now()
+    classes = StudioClass.objects.filter(studio__pk=self.studio.pk, status='active', start_time__gte=now)
+    data = {'start_after': (now + timedelta(days=2)).isoformat(), 'start_before': (now + timedelta(days=9)).isoformat()}
+    queryset = StudioClassFilter(data, queryset=classes).qs
+    self.assertEqual(queryset.count(), 7)
+    with connection.cursor() as cursor:
+      if connection.vendor == 'postgresql':
+        # the planner prefers a sequential scan of tables this small
+        cursor.execute('SET LOCAL enable_seqscan = off')
+      plan = queryset.explain()
+    self.assertIn('class_studio_status_start_idx', plan)
+
+
+class SearchTests(TestCase):
+  """
+  Classes match when every word of q is in their name, coach or keywords
+  """
+  def setUp(self):
+    self.client = APIClient()
+    studios = create_studios(2)
+    self.morning = create_classes(studios[0], 1, name='Morning Yoga', coach='Ada Lovelace')[0]
+    self.evening = create_classes(studios[1], 1, name='Evening yoga', coach='Grace Hopper')[0]
+    self.spin = create_classes(studios[1], 1, name='Spin', coach='Ada Lovelace')[0]
+    Keyword.objects.create(keyword='cardio', studio_class=self.spin)
+    cancelled = create_classes(studios[0], 1, name='Morning Yoga')[0]
+    StudioClass.objects.filter(pk=cancelled.pk).update(status='cancelled')
+
+  def search(self, q):
+    response = self.client.get('/studios/classes/search/', {'q': q})
+    self.assertEqual(response.status_code, 200)
+    return {studio_class['id'] for studio_class in response.json()['results']}
+
+  def test_every_word_matches(self):
+    self.assertEqual(self.search('yoga'), {self.morning.pk, self.evening.pk})
+    self.assertEqual(self.search('morning yoga'), {self.morning.pk})
+    self.assertEqual(self.search('morning spin'), set())
+
+  def test_coach_and_keywords(self):
+    self.assertEqual(self.search('lovelace'), {self.morning.pk, self.spin.pk})
+    self.assertEqual(self.search('ada cardio'), {self.spin.pk})
+
+  def test_case_insensitive(self):
+    self.assertEqual(self.search('YOGA hopper'), {self.evening.pk})
+
+  def test_backfilled(self):
+    ClassSearchToken.objects.all().delete()
+    import_module('studios.migrations.0031_classsearchtoken').fill_search_tokens(apps, None)
+    self.assertEqual(self.search('ada cardio'), {self.spin.pk})
+    self.assertEqual(self.search('morning yoga'), {self.morning.pk})
+
+
+def create_members(count):
+  """
+  Create count users with an active subscription
+  """
+  first = User.objects.count()
+  users = User.objects.bulk_create([User(username=f'member {first + i}') for i in range(count)])
+  today = timezone.now().date()
+  Subscription.objects.bulk_create([
+    Subscription(user=user, start_date=today, next_date=today + timedelta(days=30), price=10, duration=30) for user in users
+  ])
+  return users
+
+
+class ConcurrentEnrolmentTests(TransactionTestCase):
+  """
+  Parallel enrolments from many threads, each on its own database connection, never oversell a class
+  """
+  capacity = 25
+  workers = 20
+
+  def setUp(self):
+    if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+      self.skipTest('threads need a test database they can all connect to, set TEST NAME to a file')
+    response_cache.clear()
+    studio = create_studios(1)[0]
+    self.studio_class = create_classes(studio, 1, capacity=self.capacity)[0]
+    self.url = f'/studios/{studio.pk}/classes/{self.studio_class.pk}/enrol/'
+
+  def tearDown(self):
+    response_cache.clear()
+
+  def enrol(self, user):
+    try:
+      client = APIClient()
+      client.force_authenticate(user)
+      return client.post(self.url, {'class_id': self.studio_class.pk}).status_code
+    finally:
+      connection.close()
+
+  def enrol_all(self, users):
+    with ThreadPoolExecutor(max_workers=self.workers) as executor:
+      return list(executor.map(self.enrol, users))
+
+  def test_no_overselling(self):
+    statuses = self.enrol_all(create_members(200))
+    self.assertEqual(statuses.count(201), self.capacity)
+    self.assertEqual(statuses.count(403), 200 - self.capacity)
+    self.studio_class.refresh_from_db()
+    self.assertEqual(self.studio_class.booked_count, self.capacity)
+    self.assertEqual(ClassBooking.objects.filter(studio_class=self.studio_class).count(), self.capacity)
+
+  def test_one_booking_per_user(self):
+    user = create_members(1)[0]
+    statuses = self.enrol_all([user] * 50)
+    self.assertEqual(statuses.count(201), 1)
+    self.studio_class.refresh_from_db()
+    self.assertEqual(self.studio_class.booked_count, 1)
+    self.assertEqual(ClassBooking.objects.filter(studio_class=self.studio_class).count(), 1)
+
+
+class BookingAvailabilityTests(TestCase):
+  """
+  Bookings made or dropped bump the availability version of their class's studio
+  """
+  def setUp(self):
+    response_cache.clear()
+    self.studio = create_studios(1)[0]
+    self.studio_class = create_classes(self.studio, 1)[0]
+    self.user = create_members(1)[0]
+
+  def tearDown(self):
+    response_cache.clear()
+
+  def assertPublished(self, change):
+    version = availability.get_version(self.studio.pk)
+    with self.captureOnCommitCallbacks(execute=True), CaptureQueriesContext(connection) as queries:
+      change()
+    self.assertNotEqual(availability.get_version(self.studio.pk), version)
+    return [query['sql'] for query in queries if 'studios_studioclass' in query['sql']]
+
+  def test_loaded_class(self):
+    self.assertEqual(self.assertPublished(lambda: ClassBooking.objects.create(studio_class=self.studio_class, user=self.user)), [])
+
+  def test_class_not_loaded(self):
+    booking = ClassBooking.objects.create(studio_class=self.studio_class, user=self.user)
+    booking = ClassBooking.objects.get(pk=booking.pk)
+    # the studio id alone, not the whole class
+    class_queries = self.assertPublished(booking.delete)
+    self.assertEqual(len(class_queries), 1)
+    self.assertNotIn('"description"', class_queries[0])
+
+
+class BulkEnrolmentTests(TestCase):
+  def setUp(self):
+    response_cache.clear()
+    self.studio = create_studios(1)[0]
+    self.classes = create_classes(self.studio, 4, capacity=1)
+    self.user = create_members(1)[0]
+    self.client = APIClient()
+    self.client.force_authenticate(self.user)
+
+  def tearDown(self):
+    response_cache.clear()
+
+  def enrol(self, **data):
+    return self.client.post('/studios/classes/enrol/', data, format='json')
+
+  def booked_counts(self):
+    return [studio_class.booked_count for studio_class in StudioClass.objects.filter(pk__in=[studio_class.pk for studio_class in self.classes]).order_by('start_time')]
+
+  def test_unavailable_classes_are_reported(self):
+    full, booked = self.classes[:2]
+    self.assertTrue(full.reserve_seat())
+    self.assertTrue(booked.reserve_seat())
+    ClassBooking.objects.create(studio_class=booked, user=self.user)
+    response = self.enrol(class_ids=[studio_class.pk for studio_class in self.classes] + [0])
+    self.assertEqual(response.status_code, 201)
+    self.assertEqual(response.json()['results'], [
+      {'class_id': full.pk, 'status': 'full'},
+      {'class_id': booked.pk, 'status': 'already booked'},
+      {'class_id': self.classes[2].pk, 'status': 'booked'},
+      {'class_id': self.classes[3].pk, 'status': 'booked'},
+      {'class_id': 0, 'status': 'unavailable'},
+    ])
+    self.assertEqual(self.booked_counts(), [1, 1, 1, 1])
+
+  def test_bookings_copy_start_time(self):
+    self.enrol(class_ids=[studio_class.pk for studio_class in self.classes])
+    bookings = ClassBooking.objects.filter(user=self.user).select_related('studio_class')
+    self.assertEqual(len(bookings), 4)
+    # bulk_create() skips save(), the start_time is copied from the class
+    for booking in bookings:
+      self.assertEqual(booking.start_time, booking.studio_class.start_time)
+
+  def test_concurrent_booking_rolls_back_everything(self):
+    bulk_create = ClassBooking.objects.bulk_create
+
+    def booked_meanwhile(bookings, **kwargs):
+      # another request of the same user books one of the classes first
+      ClassBooking.objects.create(studio_class_id=bookings[-1].studio_class_id, user=self.user)
+      return bulk_create(bookings, **kwargs)
+
+    with mock.patch.object(ClassBooking.objects, 'bulk_create', side_effect=booked_meanwhile):
+      response = self.enrol(class_ids=[studio_class.pk for studio_class in self.classes])
+    self.assertEqual(response.status_code, 403)
+    # the seats taken before the insert failed are given back
+    self.assertEqual(self.booked_counts(), [0, 0, 0, 0])
+    self.assertFalse(ClassBooking.objects.exists())
+
+  def test_series(self):
+    start = timezone.now() + timedelta(days=1)
+    series = ClassSeries.objects.create(
+      name='yoga', description='description', coach='coach', capacity=5, start_time=start,
+      end_time=start + timedelta(hours=1), recurrence_end=start + timedelta(days=365), studio=self.studio,
+    )
+    response = self.enrol(series_id=series.pk)
+    self.assertEqual(response.status_code, 201)
+    occurrences = set(series.occurrences.values_list('pk', flat=True))
+    self.assertEqual({result['class_id'] for result in response.json()['results'] if result['status'] == 'booked'}, occurrences)
+    self.assertEqual(set(ClassBooking.objects.filter(user=self.user).values_list('studio_class', flat=True)), occurrences)
+
+
+class WaitlistTests(TestCase):
+  """
+  A dropped booking's seat goes to the first user on the waitlist who can still take it
+  """
+  def setUp(self):
+    response_cache.clear()
+    self.client = APIClient()
+    self.studio = create_studios(1)[0]
+    self.studio_class = create_classes(self.studio, 1, capacity=1)[0]
+    self.members = create_members(4)
+    self.booking = self.book(self.members[0])
+
+  def tearDown(self):
+    response_cache.clear()
+
+  def book(self, user):
+    self.assertTrue(self.studio_class.reserve_seat())
+    return ClassBooking.objects.create(studio_class=self.studio_class, user=user)
+
+  def join_waitlist(self, users):
+    for user in users:
+      WaitlistEntry.objects.create(studio_class=self.studio_class, user=user)
+
+  def drop(self, user, booking):
+    self.client.force_authenticate(user)
+    return self.client.delete(f'/studios/{self.studio.pk}/classes/{self.studio_class.pk}/drop/{booking.pk}/')
+
+  def booked_users(self):
+    self.studio_class.refresh_from_db()
+    users = set(ClassBooking.objects.filter(studio_class=self.studio_class).values_list('user_id', flat=True))
+    self.assertEqual(self.studio_class.booked_count, len(users))
+    return users
+
+  def waiting_users(self):
+    return list(self.studio_class.waitlist.order_by('id').values_list('user_id', flat=True))
+
+  def test_first_come_first_served(self):
+    self.join_waitlist(self.members[2:0:-1])
+    self.assertEqual(self.drop(self.members[0], self.booking).status_code, 204)
+    self.assertEqual(self.booked_users(), {self.members[2].pk})
+    self.assertEqual(self.waiting_users(), [self.members[1].pk])
+
+  def test_skips_users_without_an_active_subscription(self):
+    self.join_waitlist(self.members[1:3])
+    subscription = Subscription.objects.get(user=self.members[1])
+    subscription.status = 'cancelled'
+    subscription.save()
+    self.drop(self.members[0], self.booking)
+    self.assertEqual(self.booked_users(), {self.members[2].pk})
+    self.assertEqual(self.waiting_users(), [])
+
+  def test_skips_users_already_booked(self):
+    StudioClass.objects.filter(pk=self.studio_class.pk).update(capacity=2)
+    self.book(self.members[1])
+    self.join_waitlist(self.members[1:3])
+    self.drop(self.members[0], self.booking)
+    self.assertEqual(self.booked_users(), {self.members[1].pk, self.members[2].pk})
+    self.assertEqual(self.waiting_users(), [])
+
+  def test_seat_released_without_waitlist(self):
+    self.drop(self.members[0], self.booking)
+    self.assertEqual(self.booked_users(), set())
+
+  def test_only_own_bookings_can_be_dropped(self):
+    self.join_waitlist(self.members[1:2])
+    self.assertEqual(self.drop(self.members[1], self.booking).status_code, 404)
+    self.assertEqual(self.booked_users(), {self.members[0].pk})
+    self.assertEqual(self.waiting_users(), [self.members[1].pk])
+
+
+class IdempotentEnrolmentTests(TestCase):
+  def setUp(self):
+    response_cache.clear()
+    studio = create_studios(1)[0]
+    self.studio_class = create_classes(studio, 1)[0]
+    self.url = f'/studios/{studio.pk}/classes/{self.studio_class.pk}/enrol/'
+    self.user = create_members(1)[0]
+    self.client = APIClient()
+    self.client.force_authenticate(self.user)
+
+  def tearDown(self):
+    response_cache.clear()
+
+  def enrol(self):
+    return self.client.post(self.url, {'class_id': self.studio_class.pk}, HTTP_IDEMPOTENCY_KEY='enrol-1')
+
+  def test_replay(self):
+    first = self.enrol()
+    self.assertEqual(first.status_code, 201)
+    replayed = self.enrol()
+    self.assertEqual(replayed.status_code, 201)
+    self.assertEqual(replayed['Idempotent-Replayed'], 'true')
+    self.assertEqual(ClassBooking.objects.filter(user=self.user).count(), 1)
+
+  def test_killed_request_is_taken_over(self):
+    # a worker killed mid-request leaves its placeholder behind, nothing catches SystemExit
+    with mock.patch.object(ClassBookingSerializer, 'create', side_effect=SystemExit):
+      with self.assertRaises(SystemExit):
+        self.enrol()
+    self.assertIsNone(IdempotencyKey.objects.get(user=self.user).status_code)
+    self.assertEqual(self.enrol().status_code, 409)
+    IdempotencyKey.objects.update(created_at=timezone.now() - timedelta(seconds=settings.IDEMPOTENCY_KEY_ABANDONED_SECONDS + 1))
+    retried = self.enrol()
+    self.assertEqual(retried.status_code, 201)
+    self.assertEqual(IdempotencyKey.objects.get(user=self.user).status_code, 201)
+    self.assertEqual(self.enrol()['Idempotent-Replayed'], 'true')
+    self.assertEqual(ClassBooking.objects.filter(user=self.user).count(), 1)
+
+  def test_abandoned_request_with_other_body(self):
+    self.enrol()
+    IdempotencyKey.objects.update(status_code=None, created_at=timezone.now() - timedelta(days=1))
+    response = self.client.post(self.url, {'class_id': self.studio_class.pk + 1}, HTTP_IDEMPOTENCY_KEY='enrol-1')
+    self.assertEqual(response.status_code, 422)
+
+  def test_session_authenticated_form(self):
+    # the CSRF check of session authentication parses the form before the view reads it
+    client = APIClient(enforce_csrf_checks=True)
+    client.force_login(self.user)
+    client.cookies['csrftoken'] = 'a' * CSRF_SECRET_LENGTH
+    for _ in range(2):
+      response = client.post(self.url, {'class_id': self.studio_class.pk}, HTTP_IDEMPOTENCY_KEY='enrol-1', HTTP_X_CSRFTOKEN='a' * CSRF_SECRET_LENGTH)
+      self.assertEqual(response.status_code, 201)
+    self.assertEqual(response['Idempotent-Replayed'], 'true')
+    self.assertEqual(ClassBooking.objects.filter(user=self.user).count(), 1)
+
+  def test_key_released_while_claiming(self):
+    create = IdempotencyKey.objects.create
+    calls = []
+
+    def lose_race(**kwargs):
+      calls.append(kwargs)
+      if len(calls) == 1:
+        # the request holding the key fails and deletes its placeholder before this one reads it
+        raise IntegrityError('duplicate key')
+      return create(**kwargs)
+
+    with mock.patch.object(IdempotencyKey.objects, 'create', side_effect=lose_race):
+      self.assertEqual(self.enrol().status_code, 201)
+    self.assertEqual(len(calls), 2)
+    self.assertEqual(IdempotencyKey.objects.get(user=self.user).status_code, 201)
+
+
+class AvailabilityStreamCheckTests(TestCase):
+  def tearDown(self):
+    response_cache.clear()
+
+  def check(self):
+    response_cache.clear()
+    return [message.id for message in check_availability_stream_cache(None)]
+
+  @override_settings(STUDIOS_AVAILABILITY_STREAM=True, STUDIOS_RESPONSE_CACHE={'BACKEND': 'studios.cache.LocMemLRUBackend'})
+  def test_process_local_cache(self):
+    self.assertEqual(self.check(), ['studios.W001'])
+
+  @override_settings(STUDIOS_AVAILABILITY_STREAM=True, STUDIOS_RESPONSE_CACHE={'BACKEND': 'studios.cache.DjangoCacheBackend'})
+  def test_process_local_django_cache(self):
+    with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+      self.assertEqual(self.check(), ['studios.W001'])
+
+  @override_settings(STUDIOS_AVAILABILITY_STREAM=True, STUDIOS_RESPONSE_CACHE={'BACKEND': 'studios.cache.DjangoCacheBackend'})
+  def test_shared_cache(self):
+    with tempfile.TemporaryDirectory() as location:
+      with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': location}}):
+        self.assertEqual(self.check(), [])
+
+  @override_settings(STUDIOS_AVAILABILITY_STREAM=False)
+  def test_stream_disabled(self):
+    self.assertEqual(self.check(), [])
+
+
+@override_settings(STUDIOS_AVAILABILITY_POLL_INTERVAL=0.05)
+class AvailabilityStreamTests(TransactionTestCase):
+  """
+  The stream applies the host and CORS checks of the middleware it bypasses and streams
+  of the same studio share one poller
+  """
+  def setUp(self):
+    if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+      self.skipTest('polls read from other threads, set TEST NAME to a file')
+    response_cache.clear()
+    self.studio = create_studios(1)[0]
+    self.studio_class = create_classes(self.studio, 1, capacity=5)[0]
+
+  def tearDown(self):
+    response_cache.clear()
+
+  def open(self, host='testserver', origin=None):
+    headers = [(b'host', host.encode())]
+    if origin is not None:
+      headers.append((b'origin', origin.encode()))
+    path = f'/studios/{self.studio.pk}/classes/availability/stream/'
+    stream = ApplicationCommunicator(availability_stream, {
+      'type': 'http', 'method': 'GET', 'path': path, 'query_string': b'', 'headers': headers,
+    })
+    return stream
+
+  async def read_event(self, stream):
+    message = await stream.receive_output(timeout=5)
+    return json.loads(message['body'].decode().removeprefix('data: '))
+
+  def take_seat(self):
+    self.studio_class.reserve_seat()
+    availability.publish(self.studio.pk)
+
+  @override_settings(ALLOWED_HOSTS=['testserver'])
+  async def test_disallowed_host(self):
+    stream = self.open(host='attacker.example')
+    await stream.send_input({'type': 'http.request'})
+    self.assertEqual((await stream.receive_output(timeout=5))['status'], 400)
+    await stream.wait(timeout=5)
+
+  async def test_cors_headers(self):
+    for origin, allowed in (('https://moonfitness.vercel.app', True), ('https://attacker.example', False)):
+      with self.subTest(origin=origin):
+        stream = self.open(origin=origin)
+        await stream.send_input({'type': 'http.request'})
+        start = await stream.receive_output(timeout=5)
+        self.assertEqual(start['status'], 200)
+        headers = dict(start['headers'])
+        self.assertEqual(headers.get(b'access-control-allow-origin'), origin.encode() if allowed else None)
+        self.assertEqual(headers[b'vary'], b'Origin')
+        await stream.send_input({'type': 'http.disconnect'})
+        await stream.wait(timeout=5)
+
+  async def test_shared_poller(self):
+    streams = [self.open(), self.open()]
+    for stream in streams:
+      await stream.send_input({'type': 'http.request'})
+      await stream.receive_output(timeout=5)
+      self.assertEqual(await self.read_event(stream), {str(self.studio_class.pk): 5})
+    self.assertEqual(list(watches), [self.studio.pk])
+    self.assertEqual(watches[self.studio.pk].streams, 2)
+    await sync_to_async(self.take_seat)()
+    for stream in streams:
+      self.assertEqual(await self.read_event(stream), {str(self.studio_class.pk): 4})
+    for stream in streams:
+      await stream.send_input({'type': 'http.disconnect'})
+      await stream.wait(timeout=5)
+    self.assertEqual(watches, {})
+
+
+def create_subscribers(count, next_date, duration=30, cards=True):
+  """
+  Create count users with an active subscription due on next_date, paying with a card unless cards is False
+  """
+  first = User.objects.count()
+  users = User.objects.bulk_create([User(username=f'subscriber {first + i}') for i in range(count)], batch_size=1000)
+  if cards:
+    Card.objects.bulk_create([
+      Card(user=user, last_name='last', first_name='first', address='address', phone_number='1',
+           card_number=4111111111111111, card_expiry=date(2030, 1, 1), card_cvv=123) for user in users
+    ], batch_size=1000)
+  return Subscription.objects.bulk_create([
+    Subscription(user=user, start_date=next_date - timedelta(days=duration), next_date=next_date, price=10, duration=duration)
+    for user in users
+  ], batch_size=1000)
+
+
+class BillingTests(TestCase):
+  run_date = date(2026, 10, 18)
+
+  def bill(self, **kwargs):
+    run = run_billing(self.run_date, **kwargs)
+    self.assertIsNotNone(run.finished_at)
+    self.assertTrue(is_consistent(reconcile(run)), reconcile(run))
+    return run
+
+  def test_due_subscription(self):
+    subscription = create_subscribers(1, self.run_date)[0]
+    self.bill()
+    payment = Payment.objects.get(subscription=subscription)
+    self.assertEqual(payment.period_start, self.run_date)
+    subscription.refresh_from_db()
+    self.assertEqual(subscription.start_date, self.run_date)
+    self.assertEqual(subscription.next_date, self.run_date + timedelta(days=30))
+
+  def test_overdue_subscription_is_charged_once(self):
+    # three years of missed periods
+    subscription = create_subscribers(1, date(2023, 1, 8))[0]
+    self.bill()
+    payment = Payment.objects.get(subscription=subscription)
+    subscription.refresh_from_db()
+    # the period holding run_date is charged and the next one starts after run_date
+    self.assertLessEqual(payment.period_start, self.run_date)
+    self.assertEqual(subscription.start_date, payment.period_start)
+    self.assertEqual(subscription.next_date, payment.period_start + timedelta(days=30))
+    self.assertGreater(subscription.next_date, self.run_date)
+    self.assertEqual((payment.period_start - date(2023, 1, 8)).days % 30, 0)
+
+  def test_missed_periods_are_skipped(self):
+    # two and a half periods behind, and one period behind in the same run
+    behind, late = create_subscribers(1, self.run_date - timedelta(days=75)) + create_subscribers(1, self.run_date - timedelta(days=30))
+    run = self.bill()
+    self.assertEqual(run.billed, 2)
+    # only the period holding run_date is charged, the two missed ones are not
+    self.assertEqual(Payment.objects.get(subscription=behind).period_start, self.run_date - timedelta(days=15))
+    self.assertEqual(Payment.objects.get(subscription=late).period_start, self.run_date)
+    behind.refresh_from_db()
+    self.assertEqual(behind.next_date, self.run_date + timedelta(days=15))
+    # caught up, the next day's run has nothing to charge
+    self.assertEqual(run_billing(self.run_date + timedelta(days=1)).billed, 0)
+
+  def test_without_card_is_cancelled(self):
+    subscription = create_subscribers(1, self.run_date, cards=False)[0]
+    run = self.bill()
+    self.assertEqual(run.cancelled, 1)
+    subscription.refresh_from_db()
+    self.assertEqual(subscription.status, 'cancelled')
+    self.assertFalse(Payment.objects.exists())
+
+  def test_not_due(self):
+    create_subscribers(1, self.run_date + timedelta(days=1))
+    run = self.bill()
+    self.assertEqual(run.billed, 0)
+    self.assertFalse(Payment.objects.exists())
+
+  def test_crashed_run_resumes_without_double_charging(self):
+    create_subscribers(10, self.run_date)
+    create_subscribers(5, self.run_date - timedelta(days=100))
+    chunks = []
+
+    def crash_after_two_chunks(partition, owner, chunk_size):
+      if len(chunks) == 2:
+        raise RuntimeError('worker crashed')
+      chunks.append(partition.pk)
+      return bill_chunk(partition, owner, chunk_size)
+
+    with mock.patch('studios.billing.bill_chunk', side_effect=crash_after_two_chunks):
+      with self.assertRaises(RuntimeError):
+        run_billing(self.run_date, chunk_size=4)
+    self.assertEqual(Payment.objects.count(), 8)
+    # the crashed worker's lease runs out
+    BillingPartition.objects.update(lease_expires=timezone.now() - timedelta(seconds=1))
+    run = self.bill(chunk_size=4)
+    self.assertEqual(run.billed, 15)
+    self.assertEqual(Payment.objects.count(), 15)
+    self.assertEqual(Payment.objects.values('subscription').distinct().count(), 15)
+    # a second run of the same day charges nothing
+    self.bill(chunk_size=4)
+    self.assertEqual(Payment.objects.count(), 15)
+
+
+@benchmark
+class BillingBenchmark(TestCase):
+  """
+  Subscriptions billed per second on a table of 1M due subscriptions
+  """
+  size = benchmark_size(1000000)
+
+  def test_run_billing(self):
+    run_date = date(2026, 10, 18)
+    for start in range(0, self.size, 100000):
+      create_subscribers(min(100000, self.size - start), run_date)
+    started = time.perf_counter()
+    run = run_billing(run_date)
+    elapsed = time.perf_counter() - started
+    print(f'\nbilling: {self.size} subscriptions in {elapsed:.1f}s, {self.size / elapsed:,.0f} subscriptions/s')
+    self.assertEqual(run.billed, self.size)
+    self.assertTrue(is_consistent(reconcile(run)))
+
+
+class BillingPartitionTests(TestCase):
+  run_date = date(2026, 10, 18)
+
+  def setUp(self):
+    self.subscriptions = create_subscribers(12, self.run_date)
+
+  def start_run(self, partitions):
+    run = BillingRun.objects.create(run_date=self.run_date, partitions=partitions)
+    BillingPartition.objects.bulk_create([BillingPartition(run=run, number=number) for number in range(partitions)])
+    return run
+
+  def assertBilled(self, run):
+    self.assertIsNotNone(run.finished_at)
+    self.assertEqual(run.billed, len(self.subscriptions))
+    self.assertTrue(is_consistent(reconcile(run)))
+    self.assertFalse(run.partition_set.filter(finished_at__isnull=True).exists())
+
+  def test_partitions(self):
+    run = run_billing(self.run_date, chunk_size=2, partitions=3)
+    self.assertBilled(run)
+    self.assertEqual(sorted(run.partition_set.values_list('number', flat=True)), [0, 1, 2])
+    # every user's subscriptions fall in exactly one partition
+    self.assertEqual(sum(run.partition_set.values_list('billed', flat=True)), len(self.subscriptions))
+
+  def test_leased_partition_is_taken_over_once_expired(self):
+    run = self.start_run(2)
+    BillingPartition.objects.filter(run=run, number=1).update(leased_by='dead worker', lease_expires=lease_expiry())
+    run = run_billing(self.run_date, chunk_size=2)
+    self.assertIsNone(run.finished_at)
+    self.assertEqual(run.partition_set.get(number=1).leased_by, 'dead worker')
+    # BILLING_LEASE_SECONDS later the lease has run out
+    later = timezone.now() + timedelta(seconds=settings.BILLING_LEASE_SECONDS + 1)
+    with mock.patch('django.utils.timezone.now', return_value=later):
+      run = run_billing(self.run_date, chunk_size=2)
+    self.assertBilled(run)
+
+  def test_lease_lost_between_chunks(self):
+    run = self.start_run(1)
+    partition = run.partition_set.get()
+    chunks = []
+
+    def taken_over_after_first_chunk(partition, owner, chunk_size):
+      if chunks:
+        # another worker took the partition over after this one's lease expired
+        BillingPartition.objects.filter(pk=partition.pk).update(leased_by='other worker', lease_expires=lease_expiry())
+      chunks.append(owner)
+      return bill_chunk(partition, owner, chunk_size)
+
+    with mock.patch('studios.billing.bill_chunk', side_effect=taken_over_after_first_chunk):
+      bill_partition(partition.pk, chunk_size=2)
+    partition.refresh_from_db()
+    # the second chunk raised LeaseLost before writing anything, the partition is left to its new owner
+    self.assertIsNone(partition.finished_at)
+    self.assertEqual(partition.leased_by, 'other worker')
+    self.assertEqual(partition.billed, 2)
+    self.assertEqual(Payment.objects.count(), 2)
+    with self.assertRaises(LeaseLost):
+      bill_chunk(partition, chunks[0], 2)
+
+
+class BillingWorkerTests(TransactionTestCase):
+  """
+  Partitions billed by a pool of worker processes
+  """
+  def setUp(self):
+    if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+      self.skipTest('workers need a test database they can connect to, set TEST NAME to a file')
+    if multiprocessing.get_start_method() != 'fork':
+      # spawned workers would load the settings again and connect to the real database
+      self.skipTest('workers only share the test database settings when forked')
+
+  def test_worker_processes(self):
+    run_date = date(2026, 10, 18)
+    subscriptions = create_subscribers(40, run_date)
+    run = run_billing(run_date, chunk_size=5, workers=2, partitions=4)
+    self.assertIsNotNone(run.finished_at)
+    self.assertEqual(run.billed, len(subscriptions))
+    self.assertTrue(is_consistent(reconcile(run)))
+    self.assertEqual(run.partition_set.filter(finished_at__isnull=False).count(), 4)
+
+
+class EntitlementTests(TestCase):
+  def setUp(self):
+    self.location = tempfile.TemporaryDirectory()
+    self.user = User.objects.create(username='member')
+
+  def tearDown(self):
+    self.location.cleanup()
+
+  def shared_cache(self):
+    return override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': self.location.name}})
+
+  def subscribe(self, **fields):
+    with self.captureOnCommitCallbacks(execute=True):
+      return Subscription.objects.create(
+        user=self.user, start_date=date(2026, 10, 18), next_date=date(2026, 10, 18), price=10, duration=30, **fields
+      )
+
+  def test_shared_cache(self):
+    with self.shared_cache():
+      self.assertEqual(entitlements.get_entitlement(self.user.pk), entitlements.NONE)
+      subscription = self.subscribe()
+      self.assertEqual(entitlements.get_entitlement(self.user.pk), entitlements.ACTIVE)
+      with self.assertNumQueries(0):
+        self.assertEqual(entitlements.get_entitlement(self.user.pk), entitlements.ACTIVE)
+      # billing cancels with update() and invalidates explicitly
+      with self.captureOnCommitCallbacks(execute=True):
+        run_billing(date(2026, 10, 18))
+      subscription.refresh_from_db()
+      self.assertEqual(subscription.status, 'cancelled')
+      self.assertEqual(entitlements.get_entitlement(self.user.pk), entitlements.INACTIVE)
+
+  def test_stale_read_is_not_served(self):
+    with self.shared_cache():
+      backend = entitlements.get_backend()
+      scope = entitlements.get_scope(self.user.pk)
+      # a read that started before the subscription committed writes what it saw afterwards
+      stale_key = f'{scope}:{backend.get_version(scope)}'
+      self.subscribe()
+      backend.set(stale_key, entitlements.NONE)
+      self.assertEqual(entitlements.get_entitlement(self.user.pk), entitlements.ACTIVE)
+
+  @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+  def test_process_local_cache_is_not_used(self):
+    self.assertIsNone(entitlements.get_backend())
+    self.assertEqual(entitlements.get_entitlement(self.user.pk), entitlements.NONE)
+    # another process subscribing is seen right away
+    Subscription.objects.create(user=self.user, start_date=date(2026, 10, 18), next_date=date(2026, 11, 18), price=10, duration=30)
+    with self.assertNumQueries(1):
+      self.assertEqual(entitlements.get_entitlement(self.user.pk), entitlements.ACTIVE)
+
+
+class PaymentSummaryTests(TestCase):
+  """
+  Monthly summaries always equal the sums over the payments they summarize
+  """
+  def setUp(self):
+    self.subscriptions = create_subscribers(3, date(2026, 10, 18))
+    self.user = self.subscriptions[0].user
+    self.card = Card.objects.get(user=self.user)
+
+  def assertSummariesMatch(self):
+    expected = Payment.objects.annotate(month=TruncMonth('date', output_field=DateField())) \
+      .values('user_id', 'month').annotate(count=Count('id'), total=Sum('amount')).order_by()
+    self.assertEqual(
+      {(row['user_id'], row['month']): (row['count'], row['total']) for row in expected},
+      {(row.user_id, row.month): (row.count, row.total) for row in PaymentMonthlySummary.objects.all()},
+    )
+
+  def pay(self, amount, day):
+    return Payment.objects.create(user=self.user, card=self.card, amount=amount, date=timezone.make_aware(datetime(2026, 10, day)))
+
+  def test_payment_signals(self):
+    payment = self.pay(10, 3)
+    self.pay(5, 20)
+    self.assertSummariesMatch()
+    payment.amount = 12
+    payment.save()
+    self.assertSummariesMatch()
+    # moved to another month, both months are counted again
+    payment.date = timezone.make_aware(datetime(2026, 9, 30))
+    payment.save()
+    self.assertSummariesMatch()
+    self.assertEqual(PaymentMonthlySummary.objects.filter(user=self.user).count(), 2)
+    payment.delete()
+    self.assertSummariesMatch()
+    self.assertEqual(PaymentMonthlySummary.objects.filter(user=self.user).count(), 1)
+
+  def test_billing(self):
+    # billing writes with bulk_create() next to payments already counted this month
+    Payment.objects.create(user=self.user, card=self.card, amount=7, date=timezone.now())
+    run = run_billing(date(2026, 10, 18))
+    self.assertEqual(run.billed, 3)
+    self.assertSummariesMatch()
+    self.assertEqual(PaymentMonthlySummary.objects.get(user=self.user).count, 2)
+
+  def test_backfill(self):
+    for day in (1, 2, 28):
+      self.pay(day, day)
+    run_billing(date(2026, 10, 18))
+    PaymentMonthlySummary.objects.all().delete()
+    import_module('studios.migrations.0042_payment_monthly_summary').fill_payment_summaries(apps, None)
+    self.assertSummariesMatch()
+    self.assertEqual(summaries.rebuild(), PaymentMonthlySummary.objects.count())
+    self.assertSummariesMatch()
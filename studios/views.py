@@ -4,81 +4,183 @@ from rest_framework.permissions import AllowAny
 from django.shortcuts import get_object_or_404
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
+from rest_framework.views import APIView
 from rest_framework_simplejwt.exceptions import InvalidToken
 from datetime import datetime
 from django.utils import timezone
 from django_filters import rest_framework as filters
 from rest_framework import filters as rest_filters
-
-from .models import Studio, Point, StudioClass, SubscriptionPlan, ClassBooking
-from .serializers import ClassBookingSerializer, ClassDroppingSerializer, StudiosSerializer, StudioSerializer, StudioClassesSerializer, SubscriptionPlansSerializer, SubscriptionSubscribeSerializer
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Max, Q
+
+from .models import Studio, StudioClass, SubscriptionPlan, ClassBooking
+from . import availability
+from .fast_serializers import ValuesListMixin
+from .filters import ClassSearchFilter, StudioClassFilter
+from .mixins import CachedResponseMixin, ConditionalGetMixin, EagerLoadingMixin, IdempotentCreateMixin, StreamingListMixin
+from .nearest import NearestStudios, nearest_studios
+from .pagination import NearbyPagination
+from .serializers import BulkClassBookingSerializer, ClassBookingSerializer, ClassDroppingSerializer, NearbySearchSerializer, StudiosSerializer, StudioSerializer, StudioClassesSerializer, SubscriptionPlansSerializer, SubscriptionSubscribeSerializer, WaitlistEntrySerializer
 
 # Create your views here.
 
-class StudiosView(ListAPIView):
+class StudiosView(StreamingListMixin, EagerLoadingMixin, ListAPIView):
   serializer_class = StudiosSerializer
+  pagination_class = NearbyPagination
+
+  def get_search(self):
+    # get user location from request, with optional number of studios and radius in kilometers,
+    # empty params count as missing
+    if not hasattr(self, '_search'):
+      search = NearbySearchSerializer(data={name: value for name, value in self.request.query_params.items() if value})
+      search.is_valid(raise_exception=True)
+      data = search.validated_data
+      self._search = data['latitude'], data['longitude'], data.get('k'), data.get('radius_km')
+    return self._search
 
   def get_queryset(self):
-    # get user location from request
-    user_lat = float(self.request.query_params.get('latitude'))
-    user_long = float(self.request.query_params.get('longitude'))
-    # get points sorted by closest to given user point
-    points_in_order = Point.get_points_nearby_coords(user_lat, user_long)
-    # get list of studio ids translated from points
-    studio_ids = [i['studio_id'] for i in list(points_in_order.values())]
-    # sort studios based on previous list
-    studios_in_order = sorted(Studio.objects.all(), key=lambda x: studio_ids.index(x.id))
-    return studios_in_order
-
-class StudiosFilterView(ListAPIView):
+    user_lat, user_long, k, radius_km = self.get_search()
+    if settings.STUDIOS_NEAREST_INDEX:
+      # closest studios come from the in-memory index, only the page's studios are queried
+      studios = self.setup_eager_loading(Studio.objects.all())
+      return NearestStudios(nearest_studios, studios, user_lat, user_long, k, radius_km)
+    # only the studios up to the end of the requested page are needed
+    limit = self.paginator.get_limit(self.request)
+    if limit is not None:
+      limit += self.paginator.get_offset(self.request)
+    if k is not None:
+      limit = k if limit is None else min(limit, k)
+    # studios joined to their point and sorted by closest to given user point,
+    # the paginator slices this in the database so only the page is loaded
+    studios = Studio.get_studios_nearby_coords(user_lat, user_long, max_distance=radius_km, limit=limit)
+    studios = self.setup_eager_loading(studios)
+    return studios if k is None else studios[:k]
+
+  def get_count(self, queryset):
+    if isinstance(queryset, NearestStudios):
+      return len(queryset)
+    user_lat, user_long, k, radius_km = self.get_search()
+    if radius_km is None:
+      count = Studio.objects.filter(point__isnull=False).count()
+    else:
+      count = Studio.get_studios_nearby_coords(user_lat, user_long, max_distance=radius_km).count()
+    return count if k is None else min(count, k)
+
+class StudiosFilterView(EagerLoadingMixin, ListAPIView):
   serializer_class = StudiosSerializer
   filter_backends = [rest_filters.SearchFilter]
   filterset_fields = ('name', 'address', 'postal_code', 'phone_number',)
   search_fields = ['name', 'address', 'postal_code', 'phone_number',]
 
   def get_queryset(self):
-    return Studio.objects.all()
+    return self.setup_eager_loading(Studio.objects.all())
 
-class StudioView(RetrieveAPIView):
+class StudioView(ConditionalGetMixin, CachedResponseMixin, EagerLoadingMixin, RetrieveAPIView):
   serializer_class = StudioSerializer
 
+  def get_cache_scope(self):
+    return f"studio:{self.kwargs['studio_id']}"
+
+  def get_etag_validator(self):
+    # the studio is touched whenever its related rows change, upcoming classes also move with time
+    return Studio.objects.filter(id=self.kwargs['studio_id']).annotate(
+      upcoming=Count('classes', filter=Q(classes__status='active', classes__start_time__gte=timezone.now()))
+    ).values_list('last_modified', 'upcoming').first()
+
   def get_object(self):
-    return get_object_or_404(Studio, id=self.kwargs['studio_id'])
+    studios = self.setup_eager_loading(Studio.objects.all())
+    return get_object_or_404(studios, id=self.kwargs['studio_id'])
 
-class StudioClassesView(ListAPIView):
+class StudioClassesView(ConditionalGetMixin, StreamingListMixin, ValuesListMixin, EagerLoadingMixin, ListAPIView):
   serializer_class = StudioClassesSerializer
   filter_backends = [rest_filters.SearchFilter, filters.DjangoFilterBackend]
-  filterset_fields = ('name', 'coach', 'start_time', 'end_time')
-  search_fields = ['name', 'coach', 'start_time', 'end_time']
+  filterset_class = StudioClassFilter
+  # times are filtered with start_after/start_before, searching them as text can't use an index
+  search_fields = ['name', 'coach']
 
   def get_queryset(self):
-    classes = StudioClass.objects.filter(studio__pk=self.kwargs['studio_id'])
+    # matches the (studio, status, start_time) index
+    classes = StudioClass.objects.filter(studio__pk=self.kwargs['studio_id'], status='active')
     future_classes = classes.filter(start_time__gte=timezone.now())
-    return future_classes
+    return self.setup_eager_loading(future_classes)
+
+  def get_etag_validator(self):
+    # the count changes as classes start, the studio covers ?expand=studio
+    return self.filter_queryset(self.get_queryset()).aggregate(
+      Max('last_modified'), Max('studio__last_modified'), Count('pk')
+    )
+
+class ClassSearchView(StreamingListMixin, ValuesListMixin, EagerLoadingMixin, ListAPIView):
+  serializer_class = StudioClassesSerializer
+  filter_backends = [filters.DjangoFilterBackend]
+  filterset_class = ClassSearchFilter
+
+  def get_queryset(self):
+    classes = StudioClass.objects.filter(status='active', start_time__gte=timezone.now()).order_by('start_time', 'id')
+    return self.setup_eager_loading(classes)
 
-class SubscriptionPlansView(ListAPIView):
+class SubscriptionPlansView(CachedResponseMixin, ValuesListMixin, ListAPIView):
   serializer_class = SubscriptionPlansSerializer
 
+  def get_cache_scope(self):
+    return 'plans'
+
   def get_queryset(self):
     return SubscriptionPlan.objects.all()
 
-class SubscriptionPlanView(RetrieveAPIView):
+class SubscriptionPlanView(CachedResponseMixin, RetrieveAPIView):
   serializer_class = SubscriptionPlansSerializer
 
+  def get_cache_scope(self):
+    return 'plans'
+
   def get_object(self):
     return get_object_or_404(SubscriptionPlan, id=self.kwargs['subscription_plan_id'])
 
-class SubscriptionPlanSubscribeView(CreateAPIView):
+class SubscriptionPlanSubscribeView(IdempotentCreateMixin, CreateAPIView):
   permission_classes = [IsAuthenticated]
   serializer_class = SubscriptionSubscribeSerializer
 
-class StudioClassEnrolView(CreateAPIView):
+class StudioClassAvailabilityView(APIView):
+  """
+  Seats left in each upcoming class of the studio, served from the cached availability map,
+  /stream/ pushes the changes as server-sent events when running under ASGI
+  """
+  def get(self, request, studio_id):
+    version, seats = availability.get_availability(studio_id)
+    return Response(seats)
+
+class StudioClassEnrolView(IdempotentCreateMixin, CreateAPIView):
   permission_classes = [IsAuthenticated]
   serializer_class = ClassBookingSerializer
 
+class StudioClassBulkEnrolView(IdempotentCreateMixin, CreateAPIView):
+  permission_classes = [IsAuthenticated]
+  serializer_class = BulkClassBookingSerializer
+
+  def create(self, request, *args, **kwargs):
+    serializer = self.get_serializer(data=request.data)
+    serializer.is_valid(raise_exception=True)
+    return Response({'results': serializer.save()}, status=201)
+
+class StudioClassWaitlistView(CreateAPIView):
+  permission_classes = [IsAuthenticated]
+  serializer_class = WaitlistEntrySerializer
+
 class StudioClassDropView(DestroyAPIView):
   permission_classes = [IsAuthenticated]
   serializer_class = ClassDroppingSerializer
 
   def get_queryset(self):
-    return ClassBooking.objects.all()
\ No newline at end of file
+    # users can only drop their own bookings of the class in the url
+    return ClassBooking.objects.filter(
+      user=self.request.user, studio_class_id=self.kwargs['class_id'], studio_class__studio_id=self.kwargs['studio_id']
+    ).select_related('studio_class')
+
+  def perform_destroy(self, instance):
+    with transaction.atomic():
+      # a concurrent drop of the same booking deletes nothing and keeps the seat count
+      deleted, _ = instance.delete()
+      if deleted:
+        instance.studio_class.free_seat()
\ No newline at end of file